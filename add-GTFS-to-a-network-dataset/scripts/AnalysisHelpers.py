@@ -17,9 +17,26 @@
    limitations under the License.'''
 ################################################################################
 
-import datetime
+import os, sys, math, datetime, pickle, shutil, subprocess, tempfile
+import numpy as np
 import arcpy
 
+# Each worker process gets about this many chunks of times of day, so the
+# work stays balanced when some times of day take longer to solve than others.
+ChunksPerWorker = 4
+
+# Calculate Accessibility Matrix reports the destinations reached at least this
+# percent of start times (DsAL10Perc, DsAL20Perc, ..., DsAL90Perc)
+AccessibilityPercentThresholds = range(10, 100, 10)
+# Number of origin-destination cells processed at once when calculating the
+# accessibility statistics, to limit the size of temporary arrays
+StatsBlockCells = 2 ** 20
+# Starting width of the travel time histogram bins in impedance units (usually
+# minutes) and the number of bins per key.  When a travel time doesn't fit, the
+# bin width is doubled, so each key always uses the same fixed number of bins.
+HistogramBinWidth = 1.0
+HistogramBins = 256
+
 def make_analysis_time_of_day_list(start_day_input, end_day_input, start_time_input, end_time_input, increment_input):
     '''Make a list of datetimes to use as input for a network analysis time of day run in a loop'''
 
@@ -132,4 +149,246 @@ def add_TimeOfDay_field_to_sublayer(nalayer, sublayer_object, sublayer_name):
 def calculate_TimeOfDay_field(sublayer_object, time_field, time_of_day):
     '''Set the TimeOfDay field to a specific time of day'''
     expression = '"' + str(time_of_day) + '"' # Unclear why a DATE field requires a string expression, but it does.
-    arcpy.management.CalculateField(sublayer_object, time_field, expression, "PYTHON_9.3")
\ No newline at end of file
+    arcpy.management.CalculateField(sublayer_object, time_field, expression, "PYTHON_9.3")
+
+
+def make_od_count_matrix(num_origins, num_destinations, num_times):
+    '''Return a zeroed matrix for counting the number of times each destination
+    (column) is reached from each origin (row).  uint16 counts up to 65535
+    times of day using a fraction of the memory of nested dictionaries.'''
+    dtype = np.uint16 if num_times <= np.iinfo(np.uint16).max else np.uint32
+    return np.zeros((num_origins, num_destinations), dtype=dtype)
+
+
+def od_pair_indexes(lines_sublayer, origin_oids, destination_oids):
+    '''Return (origin indexes, destination indexes) as numpy arrays for the OD
+    pairs in a solved ODLines sublayer.  origin_oids and destination_oids are
+    sorted numpy arrays of the Origins and Destinations sublayer ObjectIDs, and
+    the index of an origin or destination is its position in these arrays.'''
+    lines = arcpy.da.TableToNumPyArray(lines_sublayer, ["OriginID", "DestinationID"])
+    return np.searchsorted(origin_oids, lines["OriginID"]), np.searchsorted(destination_oids, lines["DestinationID"])
+
+
+def calculate_accessibility_stats(od_counts, num_times, weights):
+    '''Return (reached, reached_perc) from a matrix of the number of times each
+    destination was reached from each origin.  weights is a numpy array with
+    the weight of each destination.  reached is the total weight of the
+    destinations each origin reached at least once, and reached_perc[o, j] is
+    the total weight of the destinations origin o reached at least
+    AccessibilityPercentThresholds[j] percent of the num_times start times.'''
+
+    thresholds = np.array(AccessibilityPercentThresholds, dtype=np.float64)
+    num_bins = len(thresholds) + 1
+    num_origins, num_dests = od_counts.shape
+    reached = np.zeros(num_origins, dtype=weights.dtype)
+    reached_perc = np.zeros((num_origins, len(thresholds)), dtype=weights.dtype)
+
+    block_size = max(1, StatsBlockCells // max(1, num_dests))
+    for start in range(0, num_origins, block_size):
+        block = od_counts[start:start + block_size]
+        num_rows = block.shape[0]
+        reached[start:start + num_rows] = (block > 0).dot(weights)
+        # Percent of start times when each destination was reachable, and the
+        # number of thresholds that percentage meets
+        percent_of_times_reachable = (block / float(num_times)) * 100
+        bins = np.searchsorted(thresholds, percent_of_times_reachable, side="right")
+        # Total weight of the destinations in each (origin, number of thresholds met) bin
+        bins += np.arange(num_rows)[:, np.newaxis] * num_bins
+        bin_weights = np.bincount(bins.ravel(), np.tile(weights, num_rows),
+                                  minlength=num_rows * num_bins).reshape(num_rows, num_bins)
+        # A destination that meets threshold j also meets all the lower thresholds
+        at_least = np.cumsum(bin_weights[:, ::-1], axis=1)[:, ::-1]
+        reached_perc[start:start + num_rows] = at_least[:, 1:]
+
+    return reached, reached_perc
+
+
+class TravelTimeHistograms(object):
+    '''Histograms of the travel times of many keys (OD pairs or route names),
+    for estimating the median and other percentiles of travel time over a time
+    window.  Each key has HistogramBins bins starting at 0.  The bins start
+    HistogramBinWidth wide, and their width doubles whenever a travel time is
+    too long to fit, so memory is a fixed 2 or 4 bytes per bin per key no matter
+    how many times of day are solved or what units the impedance is in.
+
+    A percentile is off by at most one bin width.  That's HistogramBinWidth if
+    all the travel times are under HistogramBins * HistogramBinWidth (for
+    example, 1 minute for travel times up to 256 minutes) and otherwise less
+    than the longest travel time / (HistogramBins / 2).  Histograms from
+    separate workers can be merged.'''
+
+    def __init__(self, num_times, bin_width=HistogramBinWidth):
+        self.bin_width = float(bin_width)
+        self.key_idx_dict = {} # {key: row in counts}
+        self.num_keys = 0
+        # counts[row, bin] = number of times the key's travel time fell in the bin
+        self.dtype = np.uint16 if num_times <= np.iinfo(np.uint16).max else np.uint32
+        self.counts = np.zeros((0, HistogramBins), dtype=self.dtype)
+
+    def _key_rows(self, keys):
+        '''Return the rows for keys, adding new keys as needed.'''
+        rows = []
+        for key in keys:
+            row = self.key_idx_dict.get(key)
+            if row is None:
+                row = self.num_keys
+                self.key_idx_dict[key] = row
+                self.num_keys += 1
+            rows.append(row)
+        return np.array(rows, dtype=np.int64)
+
+    def _grow(self):
+        '''Make room for all the keys.  Rows grow by doubling so repeated
+        additions stay cheap.'''
+        num_rows = self.counts.shape[0]
+        if self.num_keys <= num_rows:
+            return
+        new_rows = max(num_rows, 1)
+        while new_rows < self.num_keys:
+            new_rows *= 2
+        counts = np.zeros((new_rows, HistogramBins), dtype=self.dtype)
+        counts[:num_rows] = self.counts
+        self.counts = counts
+
+    def _coarsen(self, counts):
+        '''Return counts with each pair of adjacent bins combined, in bins twice as wide.'''
+        coarse = np.zeros_like(counts)
+        coarse[:, :HistogramBins // 2] = counts[:, 0::2] + counts[:, 1::2]
+        return coarse
+
+    def add(self, keys, travel_times):
+        '''Add one travel time for each key from a single solve.  Each key must
+        appear only once per call.  Travel times that are None, NaN or infinite
+        mean the key wasn't reached and are skipped.'''
+        travel_times = np.array(travel_times, dtype=np.float64)
+        reached = np.isfinite(travel_times)
+        if not reached.all():
+            keys = [key for key, is_reached in zip(keys, reached) if is_reached]
+            travel_times = travel_times[reached]
+        if not len(keys):
+            return
+        rows = self._key_rows(keys)
+        self._grow()
+        travel_times = np.maximum(travel_times, 0)
+        while travel_times.max() >= HistogramBins * self.bin_width:
+            self.counts = self._coarsen(self.counts)
+            self.bin_width *= 2
+        bins = np.floor(travel_times / self.bin_width).astype(np.int64)
+        self.counts[rows, bins] += 1
+
+    def merge(self, other):
+        '''Add the histograms from another TravelTimeHistograms with the same
+        starting bin width.  The finer of the two is coarsened to match.'''
+        if not other.num_keys:
+            return
+        keys = sorted(other.key_idx_dict, key=other.key_idx_dict.get)
+        rows = self._key_rows(keys)
+        self._grow()
+        while self.bin_width < other.bin_width:
+            self.counts = self._coarsen(self.counts)
+            self.bin_width *= 2
+        other_counts = other.counts[:other.num_keys]
+        other_width = other.bin_width
+        while other_width < self.bin_width:
+            other_counts = self._coarsen(other_counts)
+            other_width *= 2
+        self.counts[rows] += other_counts.astype(self.dtype)
+
+    def percentiles(self, keys, q):
+        '''Return a numpy array with the estimated q-th percentile (0-100) of
+        travel time for each key, interpolating linearly within the bin.  All
+        the keys must have been added.'''
+        rows = np.array([self.key_idx_dict[key] for key in keys], dtype=np.int64)
+        result = np.zeros(len(rows), dtype=np.float64)
+        num_bins = self.counts.shape[1]
+        block_rows = max(1, StatsBlockCells // max(num_bins, 1))
+        for start in range(0, len(rows), block_rows):
+            block = rows[start:start + block_rows]
+            cum_counts = np.cumsum(self.counts[block], axis=1, dtype=np.float64)
+            target = cum_counts[:, -1] * (q / 100.0)
+            # First bin where the cumulative count reaches the target
+            bins = np.minimum((cum_counts < target[:, np.newaxis]).sum(axis=1), num_bins - 1)
+            row_range = np.arange(len(block))
+            before = np.where(bins > 0, cum_counts[row_range, np.maximum(bins - 1, 0)], 0.0)
+            in_bin = cum_counts[row_range, bins] - before
+            fraction = (target - before) / np.where(in_bin > 0, in_bin, 1.0)
+            result[start:start + len(block)] = (bins + fraction) * self.bin_width
+        return result
+
+
+def get_num_workers(param_index):
+    '''Return the number of parallel processes from an optional script
+    argument, or 1 if it's blank or missing.  The tool dialogs don't have this
+    parameter, so it is only used when the script is run with the extra
+    argument, for example from a Python window or a custom toolbox.'''
+    if arcpy.GetArgumentCount() > param_index and arcpy.GetParameterAsText(param_index):
+        return max(1, int(arcpy.GetParameterAsText(param_index)))
+    return 1
+
+
+def solve_in_parallel(nalayer, task, timelist, num_workers, task_args=None, output_feature_class=None):
+    '''Solve nalayer at each time of day in timelist using num_workers
+    processes, and return the partial results from ParallelSolve.py for each
+    chunk of times in time order.  If output_feature_class is given, the
+    features each chunk saved are combined into it in time order.'''
+
+    arcpy.AddMessage("Solving %i times of day with %i parallel processes..." % (len(timelist), num_workers))
+    job_folder = tempfile.mkdtemp(prefix="ParallelSolve_", dir=arcpy.env.scratchFolder)
+    try:
+        # Workers load their own copy of the layer, including the locations already loaded in it
+        layer_file = os.path.join(job_folder, "NALayer.lyr")
+        arcpy.management.SaveToLayerFile(nalayer, layer_file, "ABSOLUTE")
+
+        num_chunks = min(len(timelist), num_workers * ChunksPerWorker)
+        chunk_size = int(math.ceil(len(timelist) / float(num_chunks)))
+        job = {
+            "task": task,
+            "task_args": task_args,
+            "num_workers": num_workers,
+            "layer_file": layer_file,
+            "job_folder": job_folder,
+            "chunks": [timelist[i:i + chunk_size] for i in range(0, len(timelist), chunk_size)],
+            "result_file": os.path.join(job_folder, "Results.pkl")
+        }
+        job_file = os.path.join(job_folder, "Job.pkl")
+        with open(job_file, "wb") as f:
+            pickle.dump(job, f, 2)
+
+        # Run the worker pool in its own Python process.  Inside ArcMap,
+        # sys.executable is ArcMap.exe, so use the python.exe it ships with.
+        python_exe = os.path.join(sys.exec_prefix, "python.exe")
+        worker_script = os.path.join(os.path.dirname(os.path.abspath(__file__)), "ParallelSolve.py")
+        # stderr goes to a file so that a lot of warnings or tracebacks from the
+        # workers can't fill a pipe and block the process while stdout is read.
+        err_file = os.path.join(job_folder, "Errors.txt")
+        with open(err_file, "w") as err_f:
+            proc = subprocess.Popen([python_exe, worker_script, job_file], stdout=subprocess.PIPE,
+                                    stderr=err_f, universal_newlines=True)
+            # Report progress as the chunks finish
+            for line in iter(proc.stdout.readline, ""):
+                arcpy.AddMessage(line.rstrip())
+            returncode = proc.wait()
+        if returncode != 0:
+            with open(err_file) as err_f:
+                errs = err_f.read()
+            arcpy.AddError("The parallel solve failed.  Errors: %s" % errs)
+            raise RuntimeError(errs)
+
+        with open(job["result_file"], "rb") as f:
+            chunk_results = pickle.load(f)
+
+        if output_feature_class:
+            first = True
+            for result, chunk_fc in chunk_results:
+                if not chunk_fc:
+                    continue
+                if first:
+                    arcpy.management.CopyFeatures(chunk_fc, output_feature_class)
+                else:
+                    arcpy.management.Append(chunk_fc, output_feature_class)
+                first = False
+
+        return [result for result, chunk_fc in chunk_results]
+
+    finally:
+        shutil.rmtree(job_folder, ignore_errors=True)
@@ -26,6 +26,7 @@ calculates the percentage of total destinations reachable.'''
    limitations under the License.'''
 ################################################################################
 
+import numpy as np
 import arcpy
 import AnalysisHelpers
 arcpy.env.overwriteOutput = True
@@ -66,6 +67,9 @@ try:
     end_time_input = arcpy.GetParameterAsText(7)
     increment_input = arcpy.GetParameter(8)
 
+    # Number of parallel processes to solve with (optional)
+    num_workers = AnalysisHelpers.get_num_workers(9)
+
     # Make sure origins and destinations aren't empty
     empty_error = u"Your %s feature class is empty.  Please choose a feature class containing points you wish to analyze."
     if int(arcpy.management.GetCount(origins_feature_class).getOutput(0)) == 0:
@@ -139,42 +143,50 @@ try:
 
     # ----- Solve NA layer in a loop for each time of day -----
 
-    # Initialize a dictionary for counting the number of times each destination is reached by each origin
-    OD_count_dict = {} # {Origin OID: {Destination OID: Number of times reached}}
+    # Compact origin and destination indexes: the position of the sublayer ObjectID in these sorted arrays
+    origin_oids = np.array(sorted(origin_ids), dtype=np.int64)
+    destination_oids = np.array(sorted(destinations_oid_dict), dtype=np.int64)
+
+    # Initialize a matrix for counting the number of times each destination is reached by each origin
+    # OD_counts[origin index, destination index] = Number of times reached
+    OD_counts = AnalysisHelpers.make_od_count_matrix(len(origin_oids), len(destination_oids), len(timelist))
 
     # Grab the solver properties object from the NA layer so we can set the time of day
     solverProps = arcpy.na.GetSolverProperties(input_network_analyst_layer)
 
-    # Solve for each time of day and save output
-    arcpy.AddMessage("Solving OD Cost matrix at time...")
-    for t in timelist:
-        arcpy.AddMessage(str(t))
+    if num_workers > 1:
+        # Solve the times of day in parallel and add up the counts from each chunk of times.  Each chunk
+        # returns the positions of the OD pairs it reached in the flattened matrix and how many times.
+        task_args = {"Origin OIDs": origin_oids, "Destination OIDs": destination_oids}
+        flat_counts = OD_counts.reshape(-1)
+        for pair_positions, pair_counts in AnalysisHelpers.solve_in_parallel(
+                input_network_analyst_layer, "count_od_pairs", timelist, num_workers, task_args):
+            flat_counts[pair_positions] += pair_counts.astype(OD_counts.dtype)
+    else:
+        # Solve for each time of day and save output
+        arcpy.AddMessage("Solving OD Cost matrix at time...")
+        for t in timelist:
+            arcpy.AddMessage(str(t))
         
-        # Switch the time of day
-        solverProps.timeOfDay = t
+            # Switch the time of day
+            solverProps.timeOfDay = t
         
-        # Solve the OD Cost Matrix
-        try:
-            arcpy.na.Solve(input_network_analyst_layer)
-        except:
-            # Solve failed.  It could be that no destinations were reachable within the time limit,
-            # or it could be another error.  Running out of memory is a distinct possibility.
-            errs = arcpy.GetMessages(2)
-            if "No solution found" not in errs:
-                # Only alert them if it's some weird error.
-                arcpy.AddMessage("Solve failed.  Errors: %s. Continuing to next time of day." % errs)
-            continue
-
-        # Read the OD matrix output and increment the dictionary
-        # There is one entry in Lines for each OD pair that was reached within the cutoff time
-        with arcpy.da.SearchCursor(lines_subLayer, ["OriginID", "DestinationID"]) as cur:
-            for line in cur:
-                if line[0] not in OD_count_dict:
-                    OD_count_dict[line[0]] = {}
-                if line[1] not in OD_count_dict[line[0]]:
-                    OD_count_dict[line[0]][line[1]] = 1
-                else:
-                    OD_count_dict[line[0]][line[1]] += 1
+            # Solve the OD Cost Matrix
+            try:
+                arcpy.na.Solve(input_network_analyst_layer)
+            except:
+                # Solve failed.  It could be that no destinations were reachable within the time limit,
+                # or it could be another error.  Running out of memory is a distinct possibility.
+                errs = arcpy.GetMessages(2)
+                if "No solution found" not in errs:
+                    # Only alert them if it's some weird error.
+                    arcpy.AddMessage("Solve failed.  Errors: %s. Continuing to next time of day." % errs)
+                continue
+
+            # Read the OD matrix output and increment the counts
+            # There is one entry in Lines for each OD pair that was reached within the cutoff time
+            origin_idxs, destination_idxs = AnalysisHelpers.od_pair_indexes(lines_subLayer, origin_oids, destination_oids)
+            OD_counts[origin_idxs, destination_idxs] += 1
 
 
     # ----- Calculate statistics and generate output -----
@@ -189,8 +201,11 @@ try:
             for row in cur:
                 destination_weight_dict[row[0]] = row[1]
                 num_dests += row[1]
+        weights = np.array([destination_weight_dict[destinations_oid_dict[oid]] for oid in destination_oids.tolist()])
     else:
         num_dests = len(destinations_oid_dict)
+        # Otherwise, each destination counts as 1
+        weights = np.ones(len(destination_oids), dtype=np.int64)
 
     # Add fields to input origins for output statistics. If the fields already exist, this will do nothing.
     arcpy.management.AddField(origins_feature_class, "TotalDests", "LONG")
@@ -204,33 +219,20 @@ try:
         arcpy.management.AddField(origins_feature_class, dest_field, "LONG")
         arcpy.management.AddField(origins_feature_class, perc_field, "DOUBLE")
     
-    # For each origin, calculate statistics
+    # Total weight of the destinations reached by each origin at least once, and at least 10%, 20%, ...90% of
+    # start times, for all origins at once
+    reached, reached_perc = AnalysisHelpers.calculate_accessibility_stats(OD_counts, len(timelist), weights)
+    reached = reached.tolist()
+    reached_perc = reached_perc.tolist()
+    origin_idx_dict = dict((oid, idx) for idx, oid in enumerate(origin_oids.tolist())) # {Origins sublayer OID: index}
+
+    # For each origin, write the statistics
     with arcpy.da.UpdateCursor(origins_feature_class, ["OID@"] + stats_fields) as cur:
         for row in cur:
-            origin_OID = origins_oid_dict[row[0]]
-            reachable_dests = 0
-            # Dictionary to track not just whether a destination was ever reachable, but how frequently it was reachable
+            origin_idx = origin_idx_dict[origins_oid_dict[row[0]]]
+            reachable_dests = reached[origin_idx]
             # Keys are percentage of times reachable, 10% of times, 20% of times, etc.
-            reachable_dests_perc = {i:0 for i in range(10, 100, 10)}
-            # Loop through all destinations
-            if origin_OID in OD_count_dict: # If it's not present, that means no destinations were ever found for this origin
-                for dest in OD_count_dict[origin_OID]:
-                    if OD_count_dict[origin_OID][dest] > 0: # If this destination was ever reachable by this origin
-                        # Calculate the percentage of start times when this destination was reachable
-                        percent_of_times_reachable = (float(OD_count_dict[origin_OID][dest]) / float(len(timelist))) * 100
-                        if destination_weight_dict:
-                            # If using a weight field, determine how much weight reaching this destination contributes to the total
-                            dests_to_add = destination_weight_dict[destinations_oid_dict[dest]]
-                        else:
-                            # Otherwise, just count it as 1
-                            dests_to_add = 1
-                        # Increment the total number of destinations that were ever reached by this origin
-                        reachable_dests += dests_to_add
-                        # Also increment the percentage counters
-                        for perc in reachable_dests_perc:
-                            # If the actual percent of times reached is greater than the counter threshold, increment the counter
-                            if percent_of_times_reachable >= perc:
-                                reachable_dests_perc[perc] += dests_to_add
+            reachable_dests_perc = dict(zip(AnalysisHelpers.AccessibilityPercentThresholds, reached_perc[origin_idx]))
             # Calculate the percentage of all destinations that were ever reached
             percent_dests = (float(reachable_dests) / float(num_dests)) * 100
             row[1] = reachable_dests
@@ -11,6 +11,7 @@ origin-destination pair or route:
 - maximum travel time
 - mean travel time
 - number of times the origin-destination pair or route was considered
+- optionally, the median and 85th percentile travel time
 '''
 ################################################################################
 '''Copyright 2018 Esri
@@ -26,6 +27,7 @@ origin-destination pair or route:
 ################################################################################
 
 import os
+import numpy as np
 import arcpy
 import AnalysisHelpers
 arcpy.env.overwriteOutput = True
@@ -87,6 +89,13 @@ try:
             )
         save_combined_output = False
 
+    # Number of parallel processes to solve with (optional)
+    num_workers = AnalysisHelpers.get_num_workers(9)
+
+    # Whether to add median and 85th percentile travel time fields (optional).  The tool dialog doesn't have
+    # this parameter, so it is only used when the script is run with the extra argument.
+    save_percentiles = arcpy.GetArgumentCount() > 10 and arcpy.GetParameter(10)
+
     # Make list of times of day to run the analysis
     try:
         timelist = AnalysisHelpers.make_analysis_time_of_day_list(start_day_input, end_day_input, start_time_input, end_time_input, increment_input)
@@ -136,61 +145,105 @@ try:
     # RT key: Name
     travelTimeStatsDict = {}
 
-    # Solve for each time of day and save output
-    arcpy.AddMessage("Solving %s at time..." % solver_opts["Friendly Name"])
-    first = True
-    for t in timelist:
-        arcpy.AddMessage(str(t))
-
-        # Switch the time of day
-        solverProps.timeOfDay = t
-
-        # Solve the OD Cost Matrix
-        try:
-            arcpy.na.Solve(input_network_analyst_layer)
-        except:
-            # Solve failed.  It could be that no destinations were reachable within the time limit,
-            # or it could be another error.  Running out of memory is a distinct possibility.
-            errs = arcpy.GetMessages(2)
-            if "No solution found" not in errs:
-                # Only alert them if it's some weird error.
-                arcpy.AddMessage("Solve failed.  Errors: %s. Continuing to next time of day." % errs)
-            continue
-
-        if save_combined_output:
-            # Calculate the TimeOfDay field
-            AnalysisHelpers.calculate_TimeOfDay_field(output_subLayer, time_field, t)
-            #Append the polygons to the output feature class. If this was the first
-            #solve, create the feature class.
-            if first:
-                arcpy.management.CopyFeatures(output_subLayer, combined_output)
-            else:
-                arcpy.management.Append(output_subLayer, combined_output)
-            first = False
-
-        # Read the OD matrix output and populate the dictionary with the min travel time for each OD pair
-        cur_fields = ["Total_" + solverProps.impedance] + [kf[0] for kf in solver_opts["Key fields"]]
-        with arcpy.da.SearchCursor(output_subLayer, cur_fields) as cur:
-            for line in cur:
-                # The key is a tuple of all the designated key fields for this solver type
-                # Example: (1, 2) for OriginID 1 and DestinationID 2
-                key = tuple([line[i] for i in range(1, len(cur_fields))])
+    # Histograms of the travel times of each key for the median and 85th percentile
+    travelTimeHistograms = AnalysisHelpers.TravelTimeHistograms(len(timelist)) if save_percentiles else None
+
+    if num_workers > 1:
+        # Solve the times of day in parallel.  Each chunk of times returns
+        # {key: [Min travel time, Max travel time, Num times reached, Sum of travel times]}
+        # and, if requested, the chunk's travel time histograms.
+        task_args = {
+            "Output Sublayer Name": solver_opts["Output Sublayer Name"],
+            "Impedance": solverProps.impedance,
+            "Key fields": [kf[0] for kf in solver_opts["Key fields"]],
+            "Time field": time_field if save_combined_output else None,
+            "Percentiles": save_percentiles
+        }
+        chunk_results = AnalysisHelpers.solve_in_parallel(
+            input_network_analyst_layer,
+            "travel_time_stats",
+            timelist,
+            num_workers,
+            task_args,
+            combined_output if save_combined_output else None
+            )
+        for chunk_stats, chunk_histograms in chunk_results:
+            if save_percentiles:
+                travelTimeHistograms.merge(chunk_histograms)
+            for key, stats in chunk_stats.items():
                 if key not in travelTimeStatsDict:
-                    # Initialize the stats dictionary entry for this OD pair or Route Name
-                    travelTimeStatsDict[key] = [line[0], line[0], 1, line[0]]
+                    travelTimeStatsDict[key] = stats
                 else:
-                    # Update the currently stored value if needed
-                    # [Min travel time, Max travel time, Num times reached, Mean travel time]
-                    # Minimum travel time
-                    travelTimeStatsDict[key][0] = min(travelTimeStatsDict[key][0], line[0])
-                    # Maximum travel time
-                    travelTimeStatsDict[key][1] = max(travelTimeStatsDict[key][1], line[0])
-                    # Mean travel time
-                    numTimesSoFar = travelTimeStatsDict[key][2]
-                    currentMean = travelTimeStatsDict[key][3]
-                    travelTimeStatsDict[key][3] = ((numTimesSoFar * currentMean) + line[0]) / (numTimesSoFar + 1)
-                    # Number of times this pair has been reached
-                    travelTimeStatsDict[key][2] += 1
+                    travelTimeStatsDict[key][0] = min(travelTimeStatsDict[key][0], stats[0])
+                    travelTimeStatsDict[key][1] = max(travelTimeStatsDict[key][1], stats[1])
+                    travelTimeStatsDict[key][2] += stats[2]
+                    travelTimeStatsDict[key][3] += stats[3]
+        # Turn the sums into the mean travel time
+        for stats in travelTimeStatsDict.values():
+            stats[3] = float(stats[3]) / stats[2]
+    else:
+        # Solve for each time of day and save output
+        arcpy.AddMessage("Solving %s at time..." % solver_opts["Friendly Name"])
+        first = True
+        for t in timelist:
+            arcpy.AddMessage(str(t))
+
+            # Switch the time of day
+            solverProps.timeOfDay = t
+
+            # Solve the OD Cost Matrix
+            try:
+                arcpy.na.Solve(input_network_analyst_layer)
+            except:
+                # Solve failed.  It could be that no destinations were reachable within the time limit,
+                # or it could be another error.  Running out of memory is a distinct possibility.
+                errs = arcpy.GetMessages(2)
+                if "No solution found" not in errs:
+                    # Only alert them if it's some weird error.
+                    arcpy.AddMessage("Solve failed.  Errors: %s. Continuing to next time of day." % errs)
+                continue
+
+            if save_combined_output:
+                # Calculate the TimeOfDay field
+                AnalysisHelpers.calculate_TimeOfDay_field(output_subLayer, time_field, t)
+                #Append the polygons to the output feature class. If this was the first
+                #solve, create the feature class.
+                if first:
+                    arcpy.management.CopyFeatures(output_subLayer, combined_output)
+                else:
+                    arcpy.management.Append(output_subLayer, combined_output)
+                first = False
+
+            # Read the OD matrix output and populate the dictionary with the min travel time for each OD pair
+            cur_fields = ["Total_" + solverProps.impedance] + [kf[0] for kf in solver_opts["Key fields"]]
+            solve_keys = []
+            solve_times = []
+            with arcpy.da.SearchCursor(output_subLayer, cur_fields) as cur:
+                for line in cur:
+                    # The key is a tuple of all the designated key fields for this solver type
+                    # Example: (1, 2) for OriginID 1 and DestinationID 2
+                    key = tuple([line[i] for i in range(1, len(cur_fields))])
+                    if save_percentiles:
+                        solve_keys.append(key)
+                        solve_times.append(line[0])
+                    if key not in travelTimeStatsDict:
+                        # Initialize the stats dictionary entry for this OD pair or Route Name
+                        travelTimeStatsDict[key] = [line[0], line[0], 1, line[0]]
+                    else:
+                        # Update the currently stored value if needed
+                        # [Min travel time, Max travel time, Num times reached, Mean travel time]
+                        # Minimum travel time
+                        travelTimeStatsDict[key][0] = min(travelTimeStatsDict[key][0], line[0])
+                        # Maximum travel time
+                        travelTimeStatsDict[key][1] = max(travelTimeStatsDict[key][1], line[0])
+                        # Mean travel time
+                        numTimesSoFar = travelTimeStatsDict[key][2]
+                        currentMean = travelTimeStatsDict[key][3]
+                        travelTimeStatsDict[key][3] = ((numTimesSoFar * currentMean) + line[0]) / (numTimesSoFar + 1)
+                        # Number of times this pair has been reached
+                        travelTimeStatsDict[key][2] += 1
+            if save_percentiles:
+                travelTimeHistograms.add(solve_keys, solve_times)
 
     # ----- Generate output -----
 
@@ -203,18 +256,33 @@ try:
         ("Mean_" + solverProps.impedance, "DOUBLE", None),
         ("NumTimes", "SHORT", None)
     ]
+    if save_percentiles:
+        out_fields += [
+            ("Median_" + solverProps.impedance, "DOUBLE", None),
+            ("P85_" + solverProps.impedance, "DOUBLE", None)
+        ]
     for field in out_fields:
         arcpy.management.AddField(output_table, field[0], field[1], field_length=field[2])
 
+    sorted_keys = sorted(travelTimeStatsDict.keys())
+    if save_percentiles:
+        # Estimate the percentiles from the histograms, keeping them within the exact min and max
+        min_times = np.array([travelTimeStatsDict[key][0] for key in sorted_keys], dtype=np.float64)
+        max_times = np.array([travelTimeStatsDict[key][1] for key in sorted_keys], dtype=np.float64)
+        medians = np.clip(travelTimeHistograms.percentiles(sorted_keys, 50), min_times, max_times).tolist()
+        p85s = np.clip(travelTimeHistograms.percentiles(sorted_keys, 85), min_times, max_times).tolist()
+
     # For each origin, calculate statistics
     with arcpy.da.InsertCursor(output_table, [f[0] for f in out_fields]) as cur:
-        for key in sorted(travelTimeStatsDict.keys()):
+        for i, key in enumerate(sorted_keys):
             row = list(key) + [
                 travelTimeStatsDict[key][0],
                 travelTimeStatsDict[key][1],
                 travelTimeStatsDict[key][3],
                 travelTimeStatsDict[key][2]
                 ]
+            if save_percentiles:
+                row += [medians[i], p85s[i]]
             cur.insertRow(row)
 
     arcpy.AddMessage("Done!")
@@ -0,0 +1,298 @@
+################################################################################
+## Toolbox: Add GTFS to a Network Dataset / Transit Analysis Tools
+################################################################################
+'''Earliest-arrival transit routing with the Connection Scan Algorithm (CSA)
+directly on the GTFS SQL database, without Network Analyst.
+
+The timetable is flattened into one array of connections (a trip traveling
+from one stop to the next stop), sorted by departure time.  A query scans the
+connections once, in time order, and takes every connection that can be
+boarded.
+
+profile() evaluates many departure times in the same scan.  Each stop keeps a
+vector of arrival times, one per departure time in increasing order.  Because
+a traveler can always wait for a later departure, these vectors never
+decrease, so the departure times that have reached a stop by a given time
+are always a prefix of the vector.  Boarding a connection and updating the
+arrival times are then a bisect and a slice assignment instead of a loop
+over the departures, so sampling every minute of a two-hour window costs
+about one scan.
+
+Zero-duration connections (common in schedules rounded to the minute) can
+chain trips together at a single instant.  When a later connection in a group
+with the same departure time could be boarded from an earlier one's arrival,
+the group is scanned again until nothing changes, so the result doesn't depend
+on the order of the ties.
+
+There is no limit on the number of transfers, unlike RaptorRouter.  The
+point-to-point and matrix methods are inherited from RaptorRouter.
+
+Typical use:
+    timetable = TransitTimetable.load_timetable(SQLDbase, day)
+    router = ConnectionScanRouter(timetable)
+    profiles = router.travel_time_profile(origins, destinations, range(7 * 3600, 9 * 3600 + 1, 60))
+'''
+################################################################################
+'''Copyright 2018 Esri
+   Licensed under the Apache License, Version 2.0 (the "License");
+   you may not use this file except in compliance with the License.
+   You may obtain a copy of the License at
+       http://www.apache.org/licenses/LICENSE-2.0
+   Unless required by applicable law or agreed to in writing, software
+   distributed under the License is distributed on an "AS IS" BASIS,
+   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+   See the License for the specific language governing permissions and
+   limitations under the License.'''
+################################################################################
+
+import bisect, itertools
+import numpy as np
+import RaptorRouter
+
+INF = RaptorRouter.INF
+
+
+class ConnectionScanRouter(RaptorRouter.RaptorRouter):
+    '''Answers earliest-arrival queries on a TransitTimetable.Timetable by
+    scanning its connections.'''
+
+    def __init__(self, timetable):
+        RaptorRouter.RaptorRouter.__init__(self, timetable)
+        # [(departure_time, arrival_time, trip number, position along the trip,
+        #   from stop index, to stop index), ...]
+        connections = []
+        trip_num = 0
+        for pattern in timetable.patterns:
+            stops = pattern.stops
+            for trip in range(len(pattern.trip_ids)):
+                for position in range(len(stops) - 1):
+                    connections.append((pattern.departures[position][trip], pattern.arrivals[position + 1][trip],
+                                        trip_num, position, stops[position], stops[position + 1]))
+                trip_num += 1
+        # Connections with the same departure and arrival time are ordered by
+        # trip and position along the trip, so a trip's chain of zero-duration
+        # connections is scanned in travel order, whatever the stop indexes are.
+        connections.sort()
+        # [(departure_time, arrival_time, from stop index, to stop index, trip number,
+        #   position along the trip, end of the tie group starting here or 0), ...]
+        connections = [(dep, arr, from_stop, to_stop, trip, position, 0) for
+                       dep, arr, trip, position, from_stop, to_stop in connections]
+        for start, end in self._find_tie_groups(connections, timetable.transfers):
+            connections[start] = connections[start][:6] + (end,)
+        self.connections = connections
+        self.connection_departures = np.array([conn[0] for conn in connections], dtype=np.float64)
+        self.num_trips = trip_num
+
+    def _find_tie_groups(self, connections, transfers):
+        '''Return [(start, end), ...] for the groups of connections[start:end]
+        with the same departure time where a zero-duration connection reaches
+        a stop that an earlier connection in the group departs from, so one
+        pass in order isn't enough.'''
+        tie_groups = []
+        departures = np.array([conn[0] for conn in connections], dtype=np.float64)
+        arrivals = np.array([conn[1] for conn in connections], dtype=np.float64)
+        # Only the groups with a zero-duration connection and more than one connection need checking
+        group_starts = np.searchsorted(departures, departures[arrivals == departures], side="left")
+        group_ends = np.searchsorted(departures, departures[arrivals == departures], side="right")
+        for start, end in sorted(set(zip(group_starts.tolist(), group_ends.tolist()))):
+            if end - start < 2:
+                continue
+            departs_from = set()
+            for dep, arr, from_stop, to_stop, trip, position, tie_end in connections[start:end]:
+                if arr == dep:
+                    reached = [to_stop] + [walk_stop for walk_stop, walk_time in transfers[to_stop] if walk_time == 0]
+                    if departs_from.intersection(reached):
+                        tie_groups.append((start, end))
+                        break
+                departs_from.add(from_stop)
+        return tie_groups
+
+    def _first_connection(self, departure_time):
+        '''Index of the first connection departing at or after departure_time.'''
+        return int(np.searchsorted(self.connection_departures, departure_time, side="left"))
+
+    def earliest_arrival(self, access, departure_time, max_duration=None):
+        '''Return a numpy array of the earliest arrival time (seconds since
+        midnight) at each stop, or inf if the stop can't be reached.  access is
+        {stop index: walk time in seconds} from the origin.  This scans for a
+        single departure time.'''
+
+        transfers = self.timetable.transfers
+        arrivals = [INF] * self.num_stops
+        # Walking is only allowed from a stop reached by transit, as in RaptorRouter
+        transit_arrivals = [INF] * self.num_stops
+        for stop_idx, walk_time in access.items():
+            arrivals[stop_idx] = min(arrivals[stop_idx], departure_time + walk_time)
+        time_limit = departure_time + max_duration if max_duration is not None else INF
+        on_trip = bytearray(self.num_trips)
+
+        first = self._first_connection(departure_time)
+        skip_to = first
+        for idx, (dep_time, arr_time, from_stop, to_stop, trip, position, tie_end) in enumerate(
+                itertools.islice(self.connections, first, None), first):
+            if idx < skip_to:
+                continue
+            if dep_time > time_limit:
+                break
+            if tie_end:
+                self._settle_group(idx, tie_end, arrivals, transit_arrivals, on_trip)
+                skip_to = tie_end
+                continue
+            if on_trip[trip] or arrivals[from_stop] <= dep_time:
+                on_trip[trip] = 1
+                if arr_time < transit_arrivals[to_stop]:
+                    transit_arrivals[to_stop] = arr_time
+                    if arr_time < arrivals[to_stop]:
+                        arrivals[to_stop] = arr_time
+                    for walk_stop, walk_time in transfers[to_stop]:
+                        if arr_time + walk_time < arrivals[walk_stop]:
+                            arrivals[walk_stop] = arr_time + walk_time
+
+        arrivals = np.array(arrivals, dtype=np.float64)
+        arrivals[arrivals > time_limit] = INF
+        return arrivals
+
+    def _settle_group(self, start, end, arrivals, transit_arrivals, on_trip):
+        '''Scan the tie group connections[start:end] for earliest_arrival()
+        until nothing changes.  A trip boarded within the group can only be
+        ridden from the position where it was boarded.'''
+        transfers = self.timetable.transfers
+        group = self.connections[start:end]
+        board_positions = {} # {trip: earliest position boarded in the group}
+        changed = True
+        while changed:
+            changed = False
+            for dep_time, arr_time, from_stop, to_stop, trip, position, tie_end in group:
+                if not on_trip[trip] and board_positions.get(trip, position + 1) > position:
+                    if arrivals[from_stop] > dep_time:
+                        continue
+                    board_positions[trip] = position
+                    changed = True
+                if arr_time < transit_arrivals[to_stop]:
+                    transit_arrivals[to_stop] = arr_time
+                    changed = True
+                    if arr_time < arrivals[to_stop]:
+                        arrivals[to_stop] = arr_time
+                    for walk_stop, walk_time in transfers[to_stop]:
+                        if arr_time + walk_time < arrivals[walk_stop]:
+                            arrivals[walk_stop] = arr_time + walk_time
+        for trip in board_positions:
+            on_trip[trip] = 1
+
+    def profile(self, access, departure_times, max_duration=None):
+        '''Return a numpy array with the earliest arrival time at each stop
+        (one row per departure time, in the order given), or inf if the stop
+        can't be reached, from a single scan of the connections.'''
+
+        num_deps = len(departure_times)
+        order = sorted(range(num_deps), key=lambda i: departure_times[i])
+        sorted_deps = [departure_times[i] for i in order]
+        transfers = self.timetable.transfers
+        bisect_right = bisect.bisect_right
+
+        # arrivals[s][d] is the earliest arrival at stop s for the d-th earliest
+        # departure time.  None means not reached for any departure time.
+        arrivals = [None] * self.num_stops
+        transit_arrivals = [None] * self.num_stops
+        for stop_idx, walk_time in access.items():
+            access_arrivals = [dep + walk_time for dep in sorted_deps]
+            if arrivals[stop_idx] is not None:
+                access_arrivals = [min(a1, a2) for a1, a2 in zip(access_arrivals, arrivals[stop_idx])]
+            arrivals[stop_idx] = access_arrivals
+        # trip_reach[trip] = n means the n earliest departure times can be on the trip
+        trip_reach = [0] * self.num_trips
+        scan_end = sorted_deps[-1] + max_duration if max_duration is not None else INF
+
+        first_conn = self._first_connection(sorted_deps[0])
+        skip_to = first_conn
+        for idx, (dep_time, arr_time, from_stop, to_stop, trip, position, tie_end) in enumerate(
+                itertools.islice(self.connections, first_conn, None), first_conn):
+            if idx < skip_to:
+                continue
+            if dep_time > scan_end:
+                break
+            if tie_end:
+                self._settle_profile_group(idx, tie_end, arrivals, transit_arrivals, trip_reach, num_deps)
+                skip_to = tie_end
+                continue
+            from_arrivals = arrivals[from_stop]
+            reach = trip_reach[trip]
+            if from_arrivals is not None:
+                # The departure times that are at the stop by dep_time
+                boarding = bisect_right(from_arrivals, dep_time)
+                if boarding > reach:
+                    trip_reach[trip] = reach = boarding
+            if not reach:
+                continue
+
+            # Arrive at to_stop for the departure times that are on the trip
+            to_transit = transit_arrivals[to_stop]
+            if to_transit is None:
+                to_transit = transit_arrivals[to_stop] = [INF] * num_deps
+            first = bisect_right(to_transit, arr_time)
+            if first >= reach:
+                continue
+            to_transit[first:reach] = [arr_time] * (reach - first)
+            update_list = [(to_stop, arr_time)] + [(walk_stop, arr_time + walk_time)
+                                                   for walk_stop, walk_time in transfers[to_stop]]
+            for stop_idx, arrival in update_list:
+                stop_arrivals = arrivals[stop_idx]
+                if stop_arrivals is None:
+                    stop_arrivals = arrivals[stop_idx] = [INF] * num_deps
+                first = bisect_right(stop_arrivals, arrival)
+                if first < reach:
+                    stop_arrivals[first:reach] = [arrival] * (reach - first)
+
+        result = np.full((num_deps, self.num_stops), INF)
+        for stop_idx, stop_arrivals in enumerate(arrivals):
+            if stop_arrivals is not None:
+                result[order, stop_idx] = stop_arrivals
+        if max_duration is not None:
+            limits = np.array(departure_times, dtype=np.float64)[:, np.newaxis] + max_duration
+            result[result > limits] = INF
+        return result
+
+    def _settle_profile_group(self, start, end, arrivals, transit_arrivals, trip_reach, num_deps):
+        '''Scan the tie group connections[start:end] for profile() until
+        nothing changes.  A trip boarded within the group can only be ridden
+        from the position where it was boarded.'''
+        transfers = self.timetable.transfers
+        bisect_right = bisect.bisect_right
+        group = self.connections[start:end]
+        boardings = {} # {trip: [(position, number of departure times boarding there), ...]}
+        changed = True
+        while changed:
+            changed = False
+            for dep_time, arr_time, from_stop, to_stop, trip, position, tie_end in group:
+                reach = trip_reach[trip]
+                for board_position, board_reach in boardings.get(trip, []):
+                    if board_position <= position and board_reach > reach:
+                        reach = board_reach
+                from_arrivals = arrivals[from_stop]
+                if from_arrivals is not None:
+                    boarding = bisect_right(from_arrivals, dep_time)
+                    if boarding > reach:
+                        boardings.setdefault(trip, []).append((position, boarding))
+                        reach = boarding
+                        changed = True
+                if not reach:
+                    continue
+                to_transit = transit_arrivals[to_stop]
+                if to_transit is None:
+                    to_transit = transit_arrivals[to_stop] = [INF] * num_deps
+                first = bisect_right(to_transit, arr_time)
+                if first >= reach:
+                    continue
+                to_transit[first:reach] = [arr_time] * (reach - first)
+                changed = True
+                update_list = [(to_stop, arr_time)] + [(walk_stop, arr_time + walk_time)
+                                                       for walk_stop, walk_time in transfers[to_stop]]
+                for stop_idx, arrival in update_list:
+                    stop_arrivals = arrivals[stop_idx]
+                    if stop_arrivals is None:
+                        stop_arrivals = arrivals[stop_idx] = [INF] * num_deps
+                    first = bisect_right(stop_arrivals, arrival)
+                    if first < reach:
+                        stop_arrivals[first:reach] = [arrival] * (reach - first)
+        for trip, trip_boardings in boardings.items():
+            trip_reach[trip] = max([trip_reach[trip]] + [board_reach for board_position, board_reach in trip_boardings])
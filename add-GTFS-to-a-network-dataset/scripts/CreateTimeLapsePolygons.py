@@ -58,6 +58,9 @@ try:
     end_time_input = arcpy.GetParameterAsText(5)
     increment_input = arcpy.GetParameter(6)
 
+    # Number of parallel processes to solve with (optional)
+    num_workers = AnalysisHelpers.get_num_workers(7)
+
     # Make list of times of day to run the analysis
     try:
         timelist = AnalysisHelpers.make_analysis_time_of_day_list(start_day_input, end_day_input, start_time_input, end_time_input, increment_input)
@@ -83,28 +86,39 @@ try:
     # Grab the solver properties object from the NA layer so we can set the time of day
     solverProps = arcpy.na.GetSolverProperties(input_network_analyst_layer)
 
-    # Solve for each time of day and save output
-    arcpy.AddMessage("Solving Service Area at time...")
-    first = True
-    for t in timelist:
-        arcpy.AddMessage(str(t))
+    if num_workers > 1:
+        # Solve the times of day in parallel and combine the polygons in time order
+        AnalysisHelpers.solve_in_parallel(
+            input_network_analyst_layer,
+            "time_lapse_polygons",
+            timelist,
+            num_workers,
+            {"Time field": time_field},
+            output_feature_class
+            )
+    else:
+        # Solve for each time of day and save output
+        arcpy.AddMessage("Solving Service Area at time...")
+        first = True
+        for t in timelist:
+            arcpy.AddMessage(str(t))
         
-        # Switch the time of day
-        solverProps.timeOfDay = t
+            # Switch the time of day
+            solverProps.timeOfDay = t
         
-        # Solve the Service Area
-        arcpy.na.Solve(input_network_analyst_layer)
+            # Solve the Service Area
+            arcpy.na.Solve(input_network_analyst_layer)
         
-        # Calculate the TimeOfDay field
-        AnalysisHelpers.calculate_TimeOfDay_field(polygons_subLayer, time_field, t)
+            # Calculate the TimeOfDay field
+            AnalysisHelpers.calculate_TimeOfDay_field(polygons_subLayer, time_field, t)
         
-        #Append the polygons to the output feature class. If this was the first
-        #solve, create the feature class.
-        if first:
-            arcpy.management.CopyFeatures(polygons_subLayer, output_feature_class)
-        else:
-            arcpy.management.Append(polygons_subLayer, output_feature_class)
-        first = False
+            #Append the polygons to the output feature class. If this was the first
+            #solve, create the feature class.
+            if first:
+                arcpy.management.CopyFeatures(polygons_subLayer, output_feature_class)
+            else:
+                arcpy.management.Append(polygons_subLayer, output_feature_class)
+            first = False
 
 except CustomError:
     pass
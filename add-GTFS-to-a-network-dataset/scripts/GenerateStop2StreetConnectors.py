@@ -26,6 +26,7 @@ locations or station interior geometry.'''
 
 import os, sqlite3
 import arcpy
+import StopTransfers
 
 class CustomError(Exception):
     pass
@@ -59,6 +60,16 @@ try:
     snapdist = arcpy.GetParameterAsText(3) # Default: 40m
     # Units of snap distance
     snapunits = arcpy.GetParameterAsText(4) # Default: meters
+    # Optional: Max straight-line distance (meters) between stops for walking transfers. 0 means don't generate them.
+    # The tool dialog doesn't have these parameters, so the tool always uses the defaults.  They are only read when
+    # the script is run with the extra arguments.
+    TransferDistance = StopTransfers.DefaultMaxTransferDistance
+    DetourFactor = StopTransfers.DefaultDetourFactor
+    if arcpy.GetArgumentCount() > 5 and arcpy.GetParameterAsText(5):
+        TransferDistance = float(arcpy.GetParameterAsText(5)) # Default: 400
+    # Optional: Walking distance along streets divided by the straight-line distance
+    if arcpy.GetArgumentCount() > 6 and arcpy.GetParameterAsText(6):
+        DetourFactor = float(arcpy.GetParameterAsText(6)) # Default: 1.3
 
     outGDB = os.path.dirname(outFD)
     # Stops must exist.  Check is in tool validation
@@ -270,6 +281,17 @@ following is true: " + SelectExpression
                 cur.updateRow(row)
 
 
+# ----- Precompute walking transfers between nearby stops -----
+
+    if TransferDistance > 0:
+        arcpy.AddMessage("Generating walking transfers between stops...")
+        transfers = StopTransfers.compute_stop_transfers(conn, TransferDistance, DetourFactor)
+        StopTransfers.write_transfers_table(conn, transfers)
+        arcpy.AddMessage("%i stop-to-stop transfers written to the %s table in %s." % (
+            len(transfers), StopTransfers.TransfersTableName, SQLDbase))
+    conn.close()
+
+
 # ----- Create vertices in steets at locations of snapped stops
 
     arcpy.AddMessage("Creating vertices in streets at location of stops...")
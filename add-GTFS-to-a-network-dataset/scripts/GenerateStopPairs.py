@@ -28,7 +28,7 @@ dataset for schedule lookups.'''
 
 import sqlite3, os, operator, itertools, csv, re
 import arcpy
-import sqlize_csv, hms
+import sqlize_csv, hms, ScheduleIndex
 
 class CustomError(Exception):
     pass
@@ -39,6 +39,10 @@ class CustomError(Exception):
 inGTFSdir = arcpy.GetParameterAsText(0)
 # Feature dataset where the network will be built
 outFD = arcpy.GetParameterAsText(1)
+# Optional: Write the binary schedule index next to the SQL database.  The
+# tool dialog doesn't have this parameter, so it is only used when the script
+# is run with the extra argument.
+WriteScheduleIndex = arcpy.GetArgumentCount() > 2 and arcpy.GetParameter(2)
 
 # Derived inputs
 outGDB = os.path.dirname(outFD)
@@ -64,6 +68,9 @@ PRIMEM['Greenwich',0.0],UNIT['Degree',0.0174532925199433]]; \
 # Output files must be written in the coordinate system of the output FD.
 outFD_SR = arcpy.Describe(outFD).spatialReference
 
+# Number of schedule rows to hold in memory and insert into the SQL database at once
+ScheduleInsertBatchSize = 250000
+
 # GTFS route_type information
 #0 - Tram, Streetcar, Light rail. Any light rail or street level system within a metropolitan area.
 #1 - Subway, Metro. Any underground rail system within a metropolitan area.
@@ -264,33 +271,56 @@ This is invalid, so trips with this id will not be included in your network." %
     arcpy.AddMessage("Obtaining and processing transit schedule and line information...")
     arcpy.AddMessage("(This will take a few minutes for large datasets.)")
 
+    # Stops and line segments are identified by integers while the schedule
+    # is built.  stop_id_list[i] is the stop_id with index i, and
+    # segment_list[j] is the (start_stop_idx, end_stop_idx, route_type) tuple
+    # for the segment with id j.  The segment id is written to the
+    # schedules_staging table and is used as the pair_id of the transit lines.
+    stop_id_list = []
+    stop_index_dict = {}
+    segment_list = []
+    segment_dict = {}
+
+    def Get_Stop_Index(stop_id):
+        '''Return the integer index for this stop_id, assigning a new one if needed.'''
+        stop_idx = stop_index_dict.get(stop_id)
+        if stop_idx is None:
+            stop_idx = len(stop_id_list)
+            stop_index_dict[stop_id] = stop_idx
+            stop_id_list.append(stop_id)
+        return stop_idx
+
+    def Get_Segment_IDs(stop_times, route_type):
+        '''Return the segment ids of the stop-stop segments along a trip.'''
+        stop_idxs = [Get_Stop_Index(st[1]) for st in stop_times]
+        segment_ids = []
+        for start_stop_idx, end_stop_idx in zip(stop_idxs[:-1], stop_idxs[1:]):
+            segment = (start_stop_idx, end_stop_idx, route_type)
+            segment_id = segment_dict.get(segment)
+            if segment_id is None:
+                segment_id = len(segment_list)
+                segment_dict[segment] = segment_id
+                segment_list.append(segment)
+            segment_ids.append(segment_id)
+        return segment_ids
+
     def Make_Frequency_Rows(trip_id, stop_times):
         '''If the trip uses the frequencies.txt file, extrapolate the stop_times
         throughout the day using the relative time between the stops given in
-        stop_times and the headways listed in frequencies. Construct rows of 
-        (SourceOIDkey, start_time, end_time, trip_id) to insert into schedule table'''
+        stop_times and the headways listed in frequencies. Construct rows of
+        (segment_id, start_time, end_time, trip_id) to insert into schedule table'''
 
         if len(stop_times) < 2: # No complete stop-stop segments for this trip
             return []
 
-        global linefeature_dict
-        route_type = trip_routetype_dict[trip_id]
+        segment_ids = Get_Segment_IDs(stop_times, trip_routetype_dict[trip_id])
 
         stop_times_current_trip = []
-        first_trip_initial_start_time = stop_times[0][2] # First start time of trip is departure_time of first stop
-        previous_stop = stop_times[0][0] # Initialize as the first stop
-        start_time = stop_times[0][2] # Initialize as the departure_time of first stop
+        first_trip_initial_start_time = stop_times[0][3] # First start time of trip is departure_time of first stop
         # Loop over stop_times entries for this trip and convert to a line-based model
-        for st in stop_times[1:]:
-            stop_id = st[0]
-            arrival_time = st[1]
-            departure_time = st[2]
-            start_stop = previous_stop
-            end_stop = stop_id
-            start_time_along_trip = start_time - first_trip_initial_start_time # Start time of line segment is departure time of first stop
-            end_time_along_trip = arrival_time - first_trip_initial_start_time # End time of line segment is arrival time at second stop
-            SourceOIDkey = "%s , %s , %s" % (start_stop, end_stop, route_type)
-            linefeature_dict[SourceOIDkey] = True
+        for segment_id, prev_st, st in zip(segment_ids, stop_times[:-1], stop_times[1:]):
+            start_time_along_trip = prev_st[3] - first_trip_initial_start_time # Start time of line segment is departure time of first stop
+            end_time_along_trip = st[2] - first_trip_initial_start_time # End time of line segment is arrival time at second stop
             # Loop over all time windows in frequencies.txt for this trip
             for window in frequencies_dict[trip_id]: # {trip_id: [start_time, end_time, headway_secs]}
                 start_timeofday = window[0]
@@ -300,72 +330,69 @@ This is invalid, so trips with this id will not be included in your network." %
                 for i in range(int(round(start_timeofday, 0)), int(round(end_timeofday, 0)), headway):
                     start_time_extrapolated = i + start_time_along_trip # current trip initial start time + time along trip
                     end_time_extrapolated = i + end_time_along_trip # current trip initial start time + time along trip
-                    stop_times_current_trip.append((SourceOIDkey, start_time_extrapolated, end_time_extrapolated, trip_id))
-            previous_stop = stop_id # Increment previous_stop
-            start_time = departure_time # Reset start_time to current stop's departure_time
+                    stop_times_current_trip.append((segment_id, start_time_extrapolated, end_time_extrapolated, trip_id))
 
         return stop_times_current_trip
 
     def Make_StopsTimes_Rows(trip_id, stop_times):
-        '''Using values from stop_times for a particular trip, construct rows of 
-        (SourceOIDkey, start_time, end_time, trip_id) to insert into schedule table'''
-        
+        '''Using values from stop_times for a particular trip, construct rows of
+        (segment_id, start_time, end_time, trip_id) to insert into schedule table'''
+
         if len(stop_times) < 2: # No complete stop-stop segments for this trip
             return []
 
-        global linefeature_dict
-        route_type = trip_routetype_dict[trip_id]
-
-        stop_times_current_trip = []
-        current_trip_initial_start_time = stop_times[0][2] # First start time of trip is departure_time of first stop
-        previous_stop = stop_times[0][0] # Initialize as the first stop
-        start_time = stop_times[0][2] # Initialize as the departure_time of first stop
-        # Loop over stop_times entries for this trip and convert to a line-based model
-        for st in stop_times[1:]:
-            stop_id = st[0]
-            arrival_time = st[1]
-            departure_time = st[2]
-            start_stop = previous_stop
-            end_stop = stop_id
-            end_time = arrival_time # End time of line segment is arrival time at second stop
-            SourceOIDkey = "%s , %s , %s" % (start_stop, end_stop, route_type)
-            linefeature_dict[SourceOIDkey] = True
-            stop_times_current_trip.append((SourceOIDkey, start_time, end_time, trip_id))
-            previous_stop = stop_id # Increment previous_stop
-            start_time = departure_time # Reset start_time to current stop's departure_time
-
-        return stop_times_current_trip
+        segment_ids = Get_Segment_IDs(stop_times, trip_routetype_dict[trip_id])
 
-    def Insert_Schedules(rows):
-        '''Insert into schedules table'''
-        c2 = conn.cursor()
-        columns = ["SourceOIDKey", "start_time", "end_time", "trip_id"]
-        values_placeholders = ["?"] * len(columns)
-        c2.executemany("INSERT INTO schedules (%s) VALUES (%s);" %
-                        (",".join(columns), ",".join(values_placeholders)), rows)
+        # Start time of line segment is departure time of first stop. End time
+        # of line segment is arrival time at second stop.
+        return [(segment_id, prev_st[3], st[2], trip_id) for segment_id, prev_st, st in
+                zip(segment_ids, stop_times[:-1], stop_times[1:])]
 
-    def Make_Rows_For_Trip(trip_id):
+    def Make_Rows_For_Trip(trip_group):
         '''Find pairs of directly-connected stops for this trip and prepare to insert in schedule table'''
-
-        stoptimefetch = '''
-        SELECT stop_id, arrival_time, departure_time
-        FROM stop_times
-        WHERE trip_id = '%s'
-        ORDER BY stop_sequence
-        ;''' % trip_id
-        c.execute(stoptimefetch)
-        stop_time_data = c.fetchall()
+        trip_id, stop_time_data = trip_group
+        if trip_id not in trip_routetype_dict:
+            # The trip isn't in trips.txt, so it has no route_type. Skip it.
+            return []
+        # [(trip_id, stop_id, arrival_time, departure_time), ...] in stop_sequence order
+        stop_time_data = list(stop_time_data)
         if trip_id in frequencies_dict:
             stop_times_current_trip = Make_Frequency_Rows(trip_id, stop_time_data)
         else:
             stop_times_current_trip = Make_StopsTimes_Rows(trip_id, stop_time_data)
         return stop_times_current_trip
 
+    def Insert_Schedules(rows):
+        '''Insert into schedules_staging table in batches of ScheduleInsertBatchSize rows'''
+        c2 = conn.cursor()
+        columns = ["segment_id", "start_time", "end_time", "trip_id"]
+        values_placeholders = ["?"] * len(columns)
+        insertstmt = "INSERT INTO schedules_staging (%s) VALUES (%s);" % (",".join(columns), ",".join(values_placeholders))
+        while True:
+            batch = list(itertools.islice(rows, ScheduleInsertBatchSize))
+            if not batch:
+                break
+            c2.executemany(insertstmt, batch)
+
+    # Read stop_times in a single pass ordered by trip and stop_sequence (this
+    # walks the stopTimes_index_tripIdsSeq index) and group the records by trip
+    stoptimefetch = '''
+        SELECT trip_id, stop_id, arrival_time, departure_time
+        FROM stop_times
+        ORDER BY trip_id, stop_sequence
+        ;'''
+    c.execute(stoptimefetch)
+    stop_times_by_trip = itertools.groupby(c, key=operator.itemgetter(0))
+
+    # The schedule rows reference line segments by segment_id until the
+    # TransitLines features exist. They are copied into the schedules table
+    # with the real SourceOID values at the end.
+    c2 = conn.cursor()
+    c2.execute("DROP TABLE IF EXISTS schedules_staging;")
+    c2.execute("CREATE TABLE schedules_staging (segment_id INTEGER, trip_id TEXT, start_time REAL, end_time REAL);")
 
-    global linefeature_dict
-    linefeature_dict = {}
     # Insert the trip schedules into the table
-    rows = itertools.chain.from_iterable(itertools.imap(Make_Rows_For_Trip, trip_routetype_dict.keys()))
+    rows = itertools.chain.from_iterable(itertools.imap(Make_Rows_For_Trip, stop_times_by_trip))
     Insert_Schedules(rows)
     conn.commit()
 
@@ -385,28 +412,28 @@ This is invalid, so trips with this id will not be included in your network." %
 
     # Add pairs of stops to the feature class in preparation for generating line features
     badStops = []
-    badkeys = []
+    # {segment_id: SourceOID}. The SourceOID values are filled in once the lines are generated.
+    linefeature_dict = {}
     with arcpy.da.InsertCursor(outStopPairsFC, ["SHAPE@", "stop_id", "pair_id", "sequence"]) as cur:
-        # linefeature_dict = {"start_stop , end_stop , route_type": True}
-        for SourceOIDkey in linefeature_dict:
-            stopPair = SourceOIDkey.split(" , ")
-            # {stop_id: [stop_lat, stop_lon]}
+        # segment_list = [(start_stop_idx, end_stop_idx, route_type), ...]
+        for segment_id, segment in enumerate(segment_list):
+            stop1 = stop_id_list[segment[0]]
+            stop2 = stop_id_list[segment[1]]
+            # {stop_id: <stop geometry object>}
             try:
-                stop1 = stopPair[0]
                 stop1_geom = stoplatlon_dict[stop1]
             except KeyError:
                 badStops.append(stop1)
-                badkeys.append(SourceOIDkey)
                 continue
             try:
-                stop2 = stopPair[1]
                 stop2_geom = stoplatlon_dict[stop2]
             except KeyError:
                 badStops.append(stop2)
-                badkeys.append(SourceOIDkey)
                 continue
-            cur.insertRow((stop1_geom, stop1, SourceOIDkey, 1))
-            cur.insertRow((stop2_geom, stop2, SourceOIDkey, 2))
+            pair_id = unicode(segment_id)
+            cur.insertRow((stop1_geom, stop1, pair_id, 1))
+            cur.insertRow((stop2_geom, stop2, pair_id, 2))
+            linefeature_dict[segment_id] = None
 
     if badStops:
         badStops = list(set(badStops))
@@ -414,12 +441,6 @@ This is invalid, so trips with this id will not be included in your network." %
 stops which are not included in your stops.txt file. Schedule information for \
 these stops will be ignored. " + unicode(badStops))
 
-    # Remove these entries from the linefeatures dictionary so it doesn't cause false records later
-    if badkeys:
-        badkeys = list(set(badkeys))
-        for key in badkeys:
-            del linefeature_dict[key]
-
 
 # ----- Generate lines between all stops (for the final ND) -----
 
@@ -435,21 +456,21 @@ these stops will be ignored. " + unicode(badStops))
     expression = """"Shape_Length" = 0"""
     with arcpy.da.UpdateCursor(outLinesFC, ["pair_id"], expression) as cur2:
         for row in cur2:
-            del linefeature_dict[row[0]]
+            del linefeature_dict[int(row[0])]
             cur2.deleteRow()
 
     # Insert the route type into the output lines
     with arcpy.da.UpdateCursor(outLinesFC, ["pair_id", "route_type", "route_type_text", "OID@"]) as cur4:
-        # StopPairs: {pairID: [firstStop_id, secondStop_id, route_type]}
+        # The pair_id is the segment_id, an index into segment_list
         for row in cur4:
-            pair_id_list = row[0].split(" , ")
+            segment_id = int(row[0])
             try:
-                route_type = int(pair_id_list[2])
+                route_type = int(segment_list[segment_id][2])
             except ValueError:
                 # The route_type has an invalid non-integer value.  If that's the case, just leave it as a string for now.
-                route_type = pair_id_list[2]
+                route_type = segment_list[segment_id][2]
             # While we're at it, add the line's ObjectID value to the linefeature_dict dictionary
-            linefeature_dict[row[0]] = long(row[3])
+            linefeature_dict[segment_id] = long(row[3])
             try:
                 route_type_text = route_type_dict[route_type]
             except KeyError: # The user's data isn't a standard type from the GTFS spec
@@ -464,14 +485,14 @@ these stops will be ignored. " + unicode(badStops))
 
 # ----- Add transit line feature information to the SQL database -----
 
-    def retrieve_linefeatures_info(in_key):
+    def retrieve_linefeatures_info(segment_id):
         '''Creates the correct rows for insertion into the linefeatures table.'''
-        SourceOID = linefeature_dict[in_key]
-        pair_id_list = in_key.split(" , ")
-        from_stop = pair_id_list[0]
-        to_stop = pair_id_list[1]
+        SourceOID = linefeature_dict[segment_id]
+        segment = segment_list[segment_id]
+        from_stop = stop_id_list[segment[0]]
+        to_stop = stop_id_list[segment[1]]
         try:
-            route_type = int(pair_id_list[2])
+            route_type = int(segment[2])
         except ValueError:
             # The route_type field has an invalid non-integer value, so just set it to a dummy value
             route_type = "NULL"
@@ -497,10 +518,37 @@ these stops will be ignored. " + unicode(badStops))
 
 # ----- Add the TransitLines feature class OID values to the schedules table for future reference -----
 
-    conn.create_function("getSourceOID", 1, lambda v: linefeature_dict[v] if v in linefeature_dict else -1)
-    c.execute("UPDATE schedules SET SourceOID = getSourceOID(SourceOIDKey)")
+    # Load the {segment_id: SourceOID} mapping into an indexed table and join
+    # it to the staged schedule rows.  Rows for segments that did not become
+    # lines (stops missing from stops.txt, zero-length lines) are dropped.
+    c.execute("DROP TABLE IF EXISTS segment_sourceoids;")
+    c.execute("CREATE TABLE segment_sourceoids (segment_id INTEGER PRIMARY KEY, SourceOID INTEGER);")
+    c.executemany("INSERT INTO segment_sourceoids (segment_id, SourceOID) VALUES (?, ?);",
+                    linefeature_dict.iteritems())
+    c.execute('''
+        INSERT INTO schedules (SourceOID, trip_id, start_time, end_time)
+        SELECT segment_sourceoids.SourceOID, schedules_staging.trip_id,
+            schedules_staging.start_time, schedules_staging.end_time
+        FROM schedules_staging
+        JOIN segment_sourceoids ON schedules_staging.segment_id = segment_sourceoids.segment_id
+        ;''')
+    c.execute("DROP TABLE schedules_staging;")
+    c.execute("DROP TABLE segment_sourceoids;")
     conn.commit()
 
+    # Reclaim the space from the dropped stop_times and staging tables so the
+    # database the network uses is as small as possible.
+    arcpy.AddMessage("Compacting the SQL database...")
+    c.execute("VACUUM;")
+
+
+# ----- Write the binary schedule index for fast departure lookups -----
+
+    if WriteScheduleIndex:
+        arcpy.AddMessage("Writing the schedule index...")
+        ScheduleIndexFolder = ScheduleIndex.get_index_folder(SQLDbase)
+        ScheduleIndex.write_schedule_index(conn, ScheduleIndexFolder)
+
 
 # ----- Finish up. -----
 
@@ -513,6 +561,9 @@ these stops will be ignored. " + unicode(badStops))
     arcpy.AddMessage("Finished!")
     arcpy.AddMessage("Your SQL table of GTFS data is:")
     arcpy.AddMessage("- " + SQLDbase)
+    if WriteScheduleIndex:
+        arcpy.AddMessage("Your schedule index is:")
+        arcpy.AddMessage("- " + ScheduleIndexFolder)
     arcpy.AddMessage("Your transit stops feature class is:")
     arcpy.AddMessage("- " + outStopsFC)
     arcpy.AddMessage("Your transit lines feature class is:")
@@ -0,0 +1,190 @@
+################################################################################
+## Toolbox: Add GTFS to a Network Dataset / Transit Analysis Tools
+################################################################################
+'''Solve a network analysis layer at many times of day using a pool of worker
+processes.  The analysis tools don't import this file.  They launch it as a
+separate Python process with AnalysisHelpers.solve_in_parallel(), so that the
+worker processes never re-run the tool script itself.
+
+Each worker process loads its own copy of the saved layer file and writes any
+output feature classes to its own scratch geodatabase.  The times of day are
+split into contiguous chunks, and each chunk returns a partial result:
+- count_od_pairs: (positions of the reached OD pairs in the flattened count
+  matrix, number of times each was reached)
+- travel_time_stats: ({key: [min, max, number of times reached, sum]},
+  AnalysisHelpers.TravelTimeHistograms or None)
+- time_lapse_polygons: nothing (the polygons are in the chunk's feature class)
+The partial results are pickled to the job's result file in time order.
+'''
+################################################################################
+'''Copyright 2018 Esri
+   Licensed under the Apache License, Version 2.0 (the "License");
+   you may not use this file except in compliance with the License.
+   You may obtain a copy of the License at
+       http://www.apache.org/licenses/LICENSE-2.0
+   Unless required by applicable law or agreed to in writing, software
+   distributed under the License is distributed on an "AS IS" BASIS,
+   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+   See the License for the specific language governing permissions and
+   limitations under the License.'''
+################################################################################
+
+import os, sys, shutil, pickle, multiprocessing
+import numpy as np
+import arcpy
+import AnalysisHelpers
+
+# Set in each worker process by init_worker()
+worker_layer = None
+worker_gdb = None
+
+
+def init_worker(layer_file, job_folder):
+    '''Give this worker process its own copy of the layer and a scratch workspace.'''
+    global worker_layer, worker_gdb
+    arcpy.CheckOutExtension("Network")
+    arcpy.env.overwriteOutput = True
+    worker_folder = os.path.join(job_folder, "Worker_%i" % os.getpid())
+    os.makedirs(worker_folder)
+    worker_layer_file = os.path.join(worker_folder, os.path.basename(layer_file))
+    shutil.copyfile(layer_file, worker_layer_file)
+    worker_layer = arcpy.mapping.Layer(worker_layer_file)
+    arcpy.management.CreateFileGDB(worker_folder, "Scratch.gdb")
+    worker_gdb = os.path.join(worker_folder, "Scratch.gdb")
+    arcpy.env.scratchWorkspace = worker_gdb
+
+
+def get_sublayer(sublayer_key):
+    '''Return the worker layer's sublayer object for a sublayer such as "ODLines".'''
+    sublayer_names = arcpy.na.GetNAClassNames(worker_layer) # To ensure compatibility with localized software
+    return arcpy.mapping.ListLayers(worker_layer, sublayer_names[sublayer_key])[0]
+
+
+def solve_at_time(t, messages):
+    '''Solve the worker layer at time of day t.  Return False if the solve
+    failed, adding a message unless there simply was no solution.'''
+    arcpy.na.GetSolverProperties(worker_layer).timeOfDay = t
+    try:
+        arcpy.na.Solve(worker_layer)
+    except:
+        # Solve failed.  It could be that no destinations were reachable within the time limit,
+        # or it could be another error.  Running out of memory is a distinct possibility.
+        errs = arcpy.GetMessages(2)
+        if "No solution found" not in errs:
+            # Only alert them if it's some weird error.
+            messages.append("Solve at %s failed.  Errors: %s. Continuing to next time of day." % (str(t), errs))
+        return False
+    return True
+
+
+def save_output(sublayer, time_field, t, output_fc, first):
+    '''Stamp the sublayer with the time of day and add it to the chunk's output feature class.'''
+    AnalysisHelpers.calculate_TimeOfDay_field(sublayer, time_field, t)
+    if first:
+        arcpy.management.CopyFeatures(sublayer, output_fc)
+    else:
+        arcpy.management.Append(sublayer, output_fc)
+
+
+def count_od_pairs(times, task_args, output_fc, messages):
+    lines_subLayer = get_sublayer("ODLines")
+    origin_oids = task_args["Origin OIDs"]
+    destination_oids = task_args["Destination OIDs"]
+    # Only the reached pairs are kept, so a worker doesn't need a whole count matrix
+    pair_positions = []
+    for t in times:
+        if not solve_at_time(t, messages):
+            continue
+        origin_idxs, destination_idxs = AnalysisHelpers.od_pair_indexes(lines_subLayer, origin_oids, destination_oids)
+        pair_positions.append(origin_idxs * len(destination_oids) + destination_idxs)
+    if not pair_positions:
+        return (np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)), None
+    return np.unique(np.concatenate(pair_positions), return_counts=True), None
+
+
+def travel_time_stats(times, task_args, output_fc, messages):
+    output_subLayer = get_sublayer(task_args["Output Sublayer Name"])
+    cur_fields = ["Total_" + task_args["Impedance"]] + task_args["Key fields"]
+    stats_dict = {} # {key: [Min travel time, Max travel time, Num times reached, Sum of travel times]}
+    histograms = AnalysisHelpers.TravelTimeHistograms(len(times)) if task_args["Percentiles"] else None
+    first = True
+    for t in times:
+        if not solve_at_time(t, messages):
+            continue
+        if task_args["Time field"]:
+            save_output(output_subLayer, task_args["Time field"], t, output_fc, first)
+            first = False
+        solve_keys = []
+        solve_times = []
+        with arcpy.da.SearchCursor(output_subLayer, cur_fields) as cur:
+            for line in cur:
+                key = tuple(line[1:])
+                if histograms is not None:
+                    solve_keys.append(key)
+                    solve_times.append(line[0])
+                stats = stats_dict.get(key)
+                if stats is None:
+                    stats_dict[key] = [line[0], line[0], 1, line[0]]
+                else:
+                    stats[0] = min(stats[0], line[0])
+                    stats[1] = max(stats[1], line[0])
+                    stats[2] += 1
+                    stats[3] += line[0]
+        if histograms is not None:
+            histograms.add(solve_keys, solve_times)
+    return (stats_dict, histograms), (None if first else output_fc)
+
+
+def time_lapse_polygons(times, task_args, output_fc, messages):
+    polygons_subLayer = get_sublayer("SAPolygons")
+    first = True
+    for t in times:
+        arcpy.na.GetSolverProperties(worker_layer).timeOfDay = t
+        arcpy.na.Solve(worker_layer)
+        save_output(polygons_subLayer, task_args["Time field"], t, output_fc, first)
+        first = False
+    return None, (None if first else output_fc)
+
+
+Tasks = {
+    "count_od_pairs": count_od_pairs,
+    "travel_time_stats": travel_time_stats,
+    "time_lapse_polygons": time_lapse_polygons,
+}
+
+
+def run_chunk(chunk):
+    '''Solve one chunk of times of day in a worker process.'''
+    task, chunk_idx, times, task_args = chunk
+    messages = []
+    output_fc = os.path.join(worker_gdb, "Output_%i" % chunk_idx)
+    result = Tasks[task](times, task_args, output_fc, messages)
+    return chunk_idx, result, messages, len(times)
+
+
+def main(job_file):
+    with open(job_file, "rb") as f:
+        job = pickle.load(f)
+
+    pool = multiprocessing.Pool(job["num_workers"], init_worker, (job["layer_file"], job["job_folder"]))
+    chunks = [(job["task"], chunk_idx, times, job["task_args"]) for chunk_idx, times in enumerate(job["chunks"])]
+    num_times = sum([len(times) for times in job["chunks"]])
+    num_solved = 0
+    results = []
+    for chunk_idx, result, messages, num_chunk_times in pool.imap_unordered(run_chunk, chunks):
+        for message in messages:
+            print(message)
+        num_solved += num_chunk_times
+        print("Solved %i of %i times of day." % (num_solved, num_times))
+        sys.stdout.flush()
+        results.append((chunk_idx, result))
+    pool.close()
+    pool.join()
+
+    results.sort(key=lambda r: r[0])
+    with open(job["result_file"], "wb") as f:
+        pickle.dump([r[1] for r in results], f, 2)
+
+
+if __name__ == "__main__":
+    main(sys.argv[1])
@@ -0,0 +1,275 @@
+################################################################################
+## Toolbox: Add GTFS to a Network Dataset / Transit Analysis Tools
+################################################################################
+'''Earliest-arrival transit routing with RAPTOR (Round-bAsed Public Transit
+Optimized Router) directly on the GTFS SQL database, without Network Analyst.
+
+Each round k finds the earliest arrival at every stop using at most k transit
+trips.  A round scans every route pattern serving a stop that improved in the
+previous round, then relaxes the walking transfers from the stops that
+improved in this round.  Walking access and egress between points and stops
+are straight-line distances at a constant walking speed.
+
+Typical use:
+    timetable = TransitTimetable.load_timetable(SQLDbase, day)
+    router = RaptorRouter(timetable)
+    minutes = router.point_to_point((lon1, lat1), (lon2, lat2), 8 * 3600)
+'''
+################################################################################
+'''Copyright 2018 Esri
+   Licensed under the Apache License, Version 2.0 (the "License");
+   you may not use this file except in compliance with the License.
+   You may obtain a copy of the License at
+       http://www.apache.org/licenses/LICENSE-2.0
+   Unless required by applicable law or agreed to in writing, software
+   distributed under the License is distributed on an "AS IS" BASIS,
+   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+   See the License for the specific language governing permissions and
+   limitations under the License.'''
+################################################################################
+
+import bisect, math
+import numpy as np
+
+INF = float("inf")
+# Maximum number of transit trips in a journey
+DefaultMaxRounds = 5
+# Farthest you'll walk between a point and a stop (meters)
+DefaultMaxWalkDistance = 800.0
+
+
+class RaptorRouter(object):
+    '''Answers earliest-arrival queries on a TransitTimetable.Timetable.'''
+
+    def __init__(self, timetable, max_rounds=DefaultMaxRounds):
+        self.timetable = timetable
+        self.max_rounds = max_rounds
+        self.num_stops = len(timetable.stop_ids)
+        # Per-round labels from the most recent query: labels[k][s] is the
+        # earliest arrival at stop s using at most k trips.
+        self.labels = None
+
+    def earliest_arrival(self, access, departure_time, max_duration=None):
+        '''Return a numpy array of the earliest arrival time (seconds since
+        midnight) at each stop, or inf if the stop can't be reached.  access is
+        {stop index: walk time in seconds} from the origin.  If max_duration
+        (seconds) is given, arrivals later than departure_time + max_duration
+        are not explored.'''
+        return self.profile(access, [departure_time], max_duration)[0]
+
+    def profile(self, access, departure_times, max_duration=None):
+        '''Return a numpy array with the earliest arrival time at each stop
+        (one row per departure time, in the order given), or inf if the stop
+        can't be reached.  This is rRAPTOR: the departure times are processed
+        from latest to earliest, and the labels from later departures are kept
+        as upper bounds for earlier ones, since a traveler can always wait for
+        the later departure.  Only the journeys that improve on the later
+        departures are explored, so a whole window of departures costs little
+        more than a few single queries.  The labels are compared round by
+        round, so a later departure's journey with more trips never hides an
+        earlier departure's journey with fewer trips.'''
+
+        labels = np.full((self.max_rounds + 1, self.num_stops), INF)
+        # The transfers are not transitively closed, so walking is only allowed
+        # from a stop reached by transit.  Arrivals by transit are tracked
+        # separately so that reaching a stop on foot doesn't prevent walking
+        # on from a later transit arrival there.
+        transit_labels = np.full((self.max_rounds + 1, self.num_stops), INF)
+
+        arrivals = np.empty((len(departure_times), self.num_stops))
+        order = sorted(range(len(departure_times)), key=lambda i: departure_times[i], reverse=True)
+        for i in order:
+            departure_time = departure_times[i]
+            marked = set()
+            for stop_idx, walk_time in access.items():
+                arrival = departure_time + walk_time
+                if arrival < labels[0][stop_idx]:
+                    labels[0][stop_idx] = arrival
+                    marked.add(stop_idx)
+            time_limit = departure_time + max_duration if max_duration is not None else INF
+            self._run_rounds(labels, transit_labels, marked, time_limit)
+            arrivals[i] = labels[self.max_rounds]
+            if max_duration is not None:
+                # Labels kept from later departures may exceed this departure's limit
+                arrivals[i][arrivals[i] > time_limit] = INF
+
+        self.labels = labels
+        return arrivals
+
+    def _run_rounds(self, labels, transit_labels, marked, time_limit):
+        '''Run the RAPTOR rounds.  labels[k] and transit_labels[k] are the
+        earliest arrivals at each stop overall and by transit using at most k
+        trips, labels[0] holds the round 0 (walking) labels, and marked is the
+        set of stops whose labels improved in round 0.  labels and
+        transit_labels are updated in place.'''
+
+        patterns = self.timetable.patterns
+        stop_patterns = self.timetable.stop_patterns
+        transfers = self.timetable.transfers
+        bisect_left = bisect.bisect_left
+
+        prev = labels[0].tolist()
+        for k in range(1, self.max_rounds + 1):
+            if not marked:
+                labels[k:] = np.minimum(labels[k:], labels[k - 1])
+                transit_labels[k:] = np.minimum(transit_labels[k:], transit_labels[k - 1])
+                break
+
+            # Collect the patterns serving marked stops, with the earliest
+            # position along each pattern where a marked stop occurs
+            queue = {}
+            for stop_idx in marked:
+                for pattern_idx, position in stop_patterns[stop_idx]:
+                    if position < queue.get(pattern_idx, len(patterns[pattern_idx].stops)):
+                        queue[pattern_idx] = position
+            marked = set()
+            transit_marked = set()
+            # Round k labels kept from a later departure are still valid
+            cur = np.minimum(labels[k], labels[k - 1]).tolist()
+            cur_transit = np.minimum(transit_labels[k], transit_labels[k - 1]).tolist()
+            # Scan the patterns
+            for pattern_idx, start_position in queue.items():
+                pattern = patterns[pattern_idx]
+                stops = pattern.stops
+                arrivals = pattern.arrivals
+                departures = pattern.departures
+                trip = -1 # Trip currently ridden, as an index into the pattern's trips
+                for position in range(start_position, len(stops)):
+                    stop_idx = stops[position]
+                    if trip >= 0:
+                        arrival = arrivals[position][trip]
+                        if arrival < cur_transit[stop_idx] and arrival <= time_limit:
+                            cur_transit[stop_idx] = arrival
+                            transit_marked.add(stop_idx)
+                            if arrival < cur[stop_idx]:
+                                cur[stop_idx] = arrival
+                                marked.add(stop_idx)
+                    # Can an earlier trip be boarded here?
+                    ready_time = prev[stop_idx]
+                    if ready_time < INF and (trip < 0 or ready_time <= departures[position][trip]):
+                        hi = len(departures[position]) if trip < 0 else trip
+                        new_trip = bisect_left(departures[position], ready_time, 0, hi)
+                        if new_trip < hi:
+                            trip = new_trip
+
+            # Walking transfers from the stops reached by transit in this round
+            for stop_idx in transit_marked:
+                arrival = cur_transit[stop_idx]
+                for to_stop, walk_time in transfers[stop_idx]:
+                    transfer_arrival = arrival + walk_time
+                    if transfer_arrival < cur[to_stop] and transfer_arrival <= time_limit:
+                        cur[to_stop] = transfer_arrival
+                        marked.add(to_stop)
+
+            labels[k] = cur
+            transit_labels[k] = cur_transit
+            prev = cur
+
+    def access_times(self, lon, lat, max_walk_distance=DefaultMaxWalkDistance):
+        '''Return {stop index: walk time in seconds} for the stops within
+        max_walk_distance meters of a lon/lat point.'''
+        stop_idxs, dists = self.timetable.stops_near(lon, lat, max_walk_distance)
+        walk_times = np.ceil(self.timetable.walk_time(dists))
+        return dict(zip(stop_idxs.tolist(), walk_times.tolist()))
+
+    def stop_to_stop(self, from_stop_id, to_stop_id, departure_time, max_duration=None):
+        '''Return the travel time in minutes from one GTFS stop_id to another,
+        leaving at departure_time (seconds since midnight), or None if the
+        destination can't be reached.'''
+        from_idx = self.timetable.stop_idx_dict[from_stop_id]
+        to_idx = self.timetable.stop_idx_dict[to_stop_id]
+        best = self.earliest_arrival({from_idx: 0}, departure_time, max_duration)
+        if best[to_idx] == INF:
+            return None
+        return (best[to_idx] - departure_time) / 60.0
+
+    def point_to_point(self, origin, destination, departure_time, max_walk_distance=DefaultMaxWalkDistance,
+                       max_duration=None):
+        '''Return the travel time in minutes between two (lon, lat) points,
+        leaving at departure_time (seconds since midnight), or None if the
+        destination can't be reached.  Walking the whole way is allowed if the
+        points are within max_walk_distance meters of each other.'''
+        times = self.travel_time_matrix([(0, origin[0], origin[1])], [(0, destination[0], destination[1])],
+                                        departure_time, max_walk_distance, max_duration)
+        return times.get((0, 0))
+
+    def egress_arrays(self, destinations, max_walk_distance=DefaultMaxWalkDistance):
+        '''Return [(stop indices, walk times in seconds), ...] for destinations,
+        a list of (id, lon, lat).'''
+        egress = []
+        for dest_id, lon, lat in destinations:
+            stop_idxs, dists = self.timetable.stops_near(lon, lat, max_walk_distance)
+            egress.append((stop_idxs, np.ceil(self.timetable.walk_time(dists))))
+        return egress
+
+    def travel_time_matrix(self, origins, destinations, departure_time, max_walk_distance=DefaultMaxWalkDistance,
+                           max_duration=None, egress=None):
+        '''Return {(origin id, destination id): travel time in minutes} from each
+        origin to each reachable destination, leaving at departure_time
+        (seconds since midnight).  origins and destinations are lists of
+        (id, lon, lat).  egress can be passed in from egress_arrays() to avoid
+        recomputing it for repeated calls with the same destinations.'''
+        profiles = self.travel_time_profile(origins, destinations, [departure_time], max_walk_distance,
+                                            max_duration, egress)
+        return dict((key, float(times[0])) for key, times in profiles.items())
+
+    def travel_time_profile(self, origins, destinations, departure_times, max_walk_distance=DefaultMaxWalkDistance,
+                            max_duration=None, egress=None):
+        '''Return {(origin id, destination id): numpy array of travel times in
+        minutes} with one travel time per departure time (seconds since
+        midnight, in the order given), or nan where the destination can't be
+        reached.  Only pairs that are reachable at least once are included.
+        Each origin is solved with a single profile() pass over all the
+        departure times.'''
+
+        if egress is None:
+            egress = self.egress_arrays(destinations, max_walk_distance)
+        timetable = self.timetable
+        dest_xs, dest_ys = timetable.project(np.array([dest[1] for dest in destinations], dtype=np.float64),
+                                             np.array([dest[2] for dest in destinations], dtype=np.float64))
+        departures = np.array(departure_times, dtype=np.float64)
+
+        results = {}
+        for orig_id, lon, lat in origins:
+            stop_arrivals = self.profile(self.access_times(lon, lat, max_walk_distance), departure_times, max_duration)
+            # Walking directly from the origin to the destination
+            orig_x, orig_y = timetable.project(np.array([lon], dtype=np.float64), np.array([lat], dtype=np.float64))
+            direct_dists = np.hypot(dest_xs - orig_x[0], dest_ys - orig_y[0])
+            for dest_num, dest in enumerate(destinations):
+                stop_idxs, walk_times = egress[dest_num]
+                arrivals = np.full(len(departures), INF)
+                if len(stop_idxs):
+                    arrivals = np.min(stop_arrivals[:, stop_idxs] + walk_times, axis=1)
+                if direct_dists[dest_num] <= max_walk_distance:
+                    arrivals = np.minimum(arrivals, departures + math.ceil(timetable.walk_time(direct_dists[dest_num])))
+                travel_times = (arrivals - departures) / 60.0
+                travel_times[np.isinf(travel_times)] = np.nan
+                if max_duration is not None:
+                    travel_times[travel_times > max_duration / 60.0] = np.nan
+                if np.isnan(travel_times).all():
+                    continue
+                results[(orig_id, dest[0])] = travel_times
+        return results
+
+
+def profile_statistics(travel_times, cutoff=None):
+    '''Summarize a travel time profile (numpy array with nan where the
+    destination wasn't reached) as (min, max, mean, number of times reached,
+    percent of times reached).  If cutoff is given, travel times greater than
+    cutoff count as not reached.  min, max and mean are None if the
+    destination was never reached.'''
+    reached = ~np.isnan(travel_times)
+    if cutoff is not None:
+        reached[reached] = travel_times[reached] <= cutoff
+    num_reached = int(np.count_nonzero(reached))
+    percent_reached = 100.0 * num_reached / len(travel_times) if len(travel_times) else 0.0
+    if not num_reached:
+        return None, None, None, 0, percent_reached
+    times = travel_times[reached]
+    return float(times.min()), float(times.max()), float(times.mean()), num_reached, percent_reached
+
+
+def seconds_since_midnight(time_of_day):
+    '''Convert a datetime (such as the times from
+    AnalysisHelpers.make_analysis_time_of_day_list) to seconds since midnight.'''
+    return time_of_day.hour * 3600 + time_of_day.minute * 60 + time_of_day.second
@@ -0,0 +1,167 @@
+################################################################################
+## Toolbox: Add GTFS to a Network Dataset
+################################################################################
+'''Write and read a binary, memory-mappable index of the transit schedules in
+the GTFS SQL database so departures on a TransitLines edge can be looked up
+without querying SQL.
+'''
+################################################################################
+'''Copyright 2018 Esri
+   Licensed under the Apache License, Version 2.0 (the "License");
+   you may not use this file except in compliance with the License.
+   You may obtain a copy of the License at
+       http://www.apache.org/licenses/LICENSE-2.0
+   Unless required by applicable law or agreed to in writing, software
+   distributed under the License is distributed on an "AS IS" BASIS,
+   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+   See the License for the specific language governing permissions and
+   limitations under the License.'''
+################################################################################
+# The index is a folder of .npy files:
+#   sourceoids.npy      Sorted SourceOID of every TransitLines edge with a schedule
+#   offsets.npy         offsets[i]:offsets[i+1] is the slice of the schedule
+#                       arrays that belongs to sourceoids[i]
+#   start_times.npy     float64 start_time (seconds since midnight), sorted within each edge
+#   end_times.npy       float64 end_time of the same trip on the edge
+#   trip_idxs.npy       int32 index into trip_ids.npy
+#   trip_ids.npy        trip_id of each trip
+#   trip_services.npy   int32 index into service_ids.npy for each trip
+#   service_ids.npy     service_id values
+#
+# Times are stored exactly as in the schedules table.  All arrays are opened
+# with mmap_mode="r", so only the pages that are actually used are read from disk.
+################################################################################
+
+import os, bisect
+import numpy as np
+
+ScheduleIndexFolderName = "GTFS_ScheduleIndex"
+IndexArrays = ["sourceoids", "offsets", "start_times", "end_times", "trip_idxs",
+               "trip_ids", "trip_services", "service_ids"]
+
+
+def get_index_folder(SQLDbase):
+    '''Return the default location of the schedule index for a GTFS SQL database.'''
+    return os.path.join(os.path.dirname(SQLDbase), ScheduleIndexFolderName)
+
+
+def write_schedule_index(conn, out_folder):
+    '''Write the schedule index for the schedules table in the GTFS SQL
+    database connection conn to out_folder.'''
+
+    c = conn.cursor()
+
+    # Number the trips and their service_ids
+    trip_ids = []
+    trip_services = []
+    trip_idx_dict = {}
+    service_ids = []
+    service_idx_dict = {}
+    c.execute("SELECT trip_id, service_id FROM trips;")
+    for trip_id, service_id in c:
+        service_idx = service_idx_dict.get(service_id)
+        if service_idx is None:
+            service_idx = len(service_ids)
+            service_idx_dict[service_id] = service_idx
+            service_ids.append(service_id)
+        trip_idx_dict[trip_id] = len(trip_ids)
+        trip_ids.append(trip_id)
+        trip_services.append(service_idx)
+
+    # Read the schedules in edge and start time order
+    sourceoid_list = []
+    start_time_list = []
+    end_time_list = []
+    trip_idx_list = []
+    c.execute('''
+        SELECT SourceOID, start_time, end_time, trip_id
+        FROM schedules
+        ORDER BY SourceOID, start_time
+        ;''')
+    for SourceOID, start_time, end_time, trip_id in c:
+        trip_idx = trip_idx_dict.get(trip_id)
+        if trip_idx is None:
+            # Trip isn't in trips.txt, so we don't know when it runs.
+            continue
+        sourceoid_list.append(SourceOID)
+        start_time_list.append(start_time)
+        end_time_list.append(end_time)
+        trip_idx_list.append(trip_idx)
+
+    row_sourceoids = np.array(sourceoid_list, dtype=np.int64)
+    sourceoids, first_rows = np.unique(row_sourceoids, return_index=True)
+    offsets = np.append(first_rows, len(row_sourceoids)).astype(np.int64)
+
+    arrays = {
+        "sourceoids": sourceoids,
+        "offsets": offsets,
+        "start_times": np.array(start_time_list, dtype=np.float64),
+        "end_times": np.array(end_time_list, dtype=np.float64),
+        "trip_idxs": np.array(trip_idx_list, dtype=np.int32),
+        "trip_ids": np.array(trip_ids, dtype="U"),
+        "trip_services": np.array(trip_services, dtype=np.int32),
+        "service_ids": np.array(service_ids, dtype="U"),
+    }
+
+    if not os.path.exists(out_folder):
+        os.makedirs(out_folder)
+    for name in IndexArrays:
+        np.save(os.path.join(out_folder, name + ".npy"), arrays[name])
+
+
+class ScheduleIndex(object):
+    '''Read-only lookups of transit departures on TransitLines edges from an
+    index written by write_schedule_index().'''
+
+    def __init__(self, index_folder):
+        for name in IndexArrays:
+            # Plain ndarray views of the memory maps are much cheaper to slice
+            # than np.memmap objects.
+            setattr(self, name, np.asarray(np.load(os.path.join(index_folder, name + ".npy"), mmap_mode="r")))
+        # Small enough to keep in memory and used for every lookup
+        self.edge_pos_dict = dict((SourceOID, pos) for pos, SourceOID in enumerate(self.sourceoids.tolist()))
+        self.offsets = self.offsets.tolist()
+        self.trip_services = np.array(self.trip_services)
+        self.service_idx_dict = dict((service_id, idx) for idx, service_id in enumerate(self.service_ids))
+
+    def service_mask(self, services):
+        '''Return a boolean array, one value per service_id in the index, that
+        is True for the service_ids in services.  Service_ids that aren't in
+        the index are ignored.'''
+        mask = np.zeros(len(self.service_ids), dtype=bool)
+        for service_id in services:
+            service_idx = self.service_idx_dict.get(service_id)
+            if service_idx is not None:
+                mask[service_idx] = True
+        return mask
+
+    def edge_slice(self, edge):
+        '''Return the (start, end) positions of an edge's schedule in the
+        schedule arrays.  Edges without a schedule get an empty slice.'''
+        pos = self.edge_pos_dict.get(edge)
+        if pos is None:
+            return 0, 0
+        return self.offsets[pos], self.offsets[pos + 1]
+
+    def next_departure(self, edge, t, services=None):
+        '''Return (start_time, end_time, trip_id) for the first trip that departs
+        on the edge (TransitLines SourceOID) at or after t seconds since midnight,
+        or None if there isn't one.  services limits the trips to those with
+        the given service_ids and can be a collection of service_ids or a mask
+        from service_mask().  If services is None, all trips are considered.'''
+        lo, hi = self.edge_slice(edge)
+        if lo == hi:
+            return None
+        # Per-edge schedules are short, so bisect is faster than np.searchsorted here
+        pos = bisect.bisect_left(self.start_times, t, lo, hi)
+        if services is not None:
+            if not isinstance(services, np.ndarray):
+                services = self.service_mask(services)
+            trip_idxs = self.trip_idxs
+            trip_services = self.trip_services
+            while pos < hi and not services[trip_services[trip_idxs[pos]]]:
+                pos += 1
+        if pos == hi:
+            return None
+        return (float(self.start_times[pos]), float(self.end_times[pos]),
+                self.trip_ids[self.trip_idxs[pos]])
@@ -0,0 +1,162 @@
+################################################################################
+## Toolbox: Add GTFS to a Network Dataset
+################################################################################
+'''Precompute walking transfers between nearby transit stops and store them in
+a transfers table in the GTFS SQL database.
+
+Every pair of boardable stops (location_type 0 or blank) within a radius of
+each other gets a transfer.  Candidate pairs are found with a grid spatial
+index, and the walking distance is the straight-line distance multiplied by a
+detour factor that accounts for the street network not running directly
+between the stops.
+
+The transfers table uses the columns of GTFS transfers.txt, so other GTFS
+software can read it:
+    from_stop_id, to_stop_id, transfer_type (always 2, meaning a minimum
+    transfer time is required), min_transfer_time (seconds)
+plus a distance column with the estimated walking distance in meters.
+
+Routing engines such as TransitTimetable.load_timetable() use this compact
+footpath graph for transfers instead of walking the streets.
+'''
+################################################################################
+'''Copyright 2018 Esri
+   Licensed under the Apache License, Version 2.0 (the "License");
+   you may not use this file except in compliance with the License.
+   You may obtain a copy of the License at
+       http://www.apache.org/licenses/LICENSE-2.0
+   Unless required by applicable law or agreed to in writing, software
+   distributed under the License is distributed on an "AS IS" BASIS,
+   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+   See the License for the specific language governing permissions and
+   limitations under the License.'''
+################################################################################
+
+import math
+import numpy as np
+
+EarthRadius = 6371000.0 # meters
+TransfersTableName = "transfers"
+# Farthest straight-line distance between two stops with a transfer (meters)
+DefaultMaxTransferDistance = 400.0
+# Walking distance along the streets divided by the straight-line distance
+DefaultDetourFactor = 1.3
+# Walking speed (km/h) used for min_transfer_time
+DefaultWalkSpeed = 5.0
+
+
+def project_points(lons, lats):
+    '''Project WGS84 lon/lat degrees (numpy arrays) to x/y meters on an
+    equirectangular plane centered on the points.  This is accurate enough for
+    walking distances within a city.'''
+    valid = ~(np.isnan(lons) | np.isnan(lats))
+    ref_lat = math.radians(float(np.mean(lats[valid]))) if valid.any() else 0.0
+    xs = EarthRadius * np.radians(lons) * math.cos(ref_lat)
+    ys = EarthRadius * np.radians(lats)
+    return xs, ys
+
+
+def find_near_pairs(xs, ys, max_distance):
+    '''Return (from indices, to indices, distances) as numpy arrays for every
+    ordered pair of distinct points within max_distance of each other.  Points
+    with nan coordinates are ignored.'''
+
+    from_list = []
+    to_list = []
+    dist_list = []
+    valid = np.nonzero(~(np.isnan(xs) | np.isnan(ys)))[0]
+    if max_distance > 0 and len(valid):
+        # Hash the points into square cells of max_distance meters, so every
+        # neighbor of a point is in its own cell or one of the eight around it.
+        cells_x = np.floor(xs[valid] / max_distance).astype(np.int64)
+        cells_y = np.floor(ys[valid] / max_distance).astype(np.int64)
+        grid = {}
+        for point_idx, cell in zip(valid.tolist(), zip(cells_x.tolist(), cells_y.tolist())):
+            grid.setdefault(cell, []).append(point_idx)
+
+        for (cell_x, cell_y), point_idxs in grid.items():
+            neighbors = []
+            for dx in (-1, 0, 1):
+                for dy in (-1, 0, 1):
+                    neighbors += grid.get((cell_x + dx, cell_y + dy), [])
+            neighbors = np.array(neighbors, dtype=np.int64)
+            point_idxs = np.array(point_idxs, dtype=np.int64)
+            # Distances from every point in the cell to every neighbor at once
+            dists = np.hypot(xs[point_idxs][:, np.newaxis] - xs[neighbors],
+                             ys[point_idxs][:, np.newaxis] - ys[neighbors])
+            near = (dists <= max_distance) & (point_idxs[:, np.newaxis] != neighbors)
+            rows, cols = np.nonzero(near)
+            from_list.append(point_idxs[rows])
+            to_list.append(neighbors[cols])
+            dist_list.append(dists[rows, cols])
+
+    if not from_list:
+        return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.float64)
+    return np.concatenate(from_list), np.concatenate(to_list), np.concatenate(dist_list)
+
+
+def compute_stop_transfers(conn, max_distance=DefaultMaxTransferDistance, detour_factor=DefaultDetourFactor,
+                           walk_speed=DefaultWalkSpeed):
+    '''Return a list of (from_stop_id, to_stop_id, min_transfer_time, distance)
+    for the stops in the GTFS SQL database connection conn.  max_distance is
+    the straight-line radius in meters, and distance is the straight-line
+    distance times detour_factor.'''
+
+    c = conn.cursor()
+    c.execute("PRAGMA table_info(stops)")
+    col_names = [col[1] for col in c.fetchall()]
+    if "location_type" in col_names:
+        # Parent stations and station entrances aren't boarded directly
+        c.execute("SELECT stop_id, stop_lon, stop_lat FROM stops WHERE location_type IS NULL OR location_type = '' OR location_type = 0;")
+    else:
+        c.execute("SELECT stop_id, stop_lon, stop_lat FROM stops;")
+    stops = c.fetchall()
+    if not stops:
+        return []
+
+    stop_ids = [stop[0] for stop in stops]
+    xs, ys = project_points(np.array([stop[1] for stop in stops], dtype=np.float64),
+                            np.array([stop[2] for stop in stops], dtype=np.float64))
+    from_idxs, to_idxs, dists = find_near_pairs(xs, ys, max_distance)
+    walk_dists = dists * detour_factor
+    walk_times = np.ceil(walk_dists / (walk_speed * 1000.0 / 3600.0)).astype(np.int64)
+    return [(stop_ids[from_idx], stop_ids[to_idx], walk_time, round(walk_dist, 1)) for
+            from_idx, to_idx, walk_time, walk_dist in
+            zip(from_idxs.tolist(), to_idxs.tolist(), walk_times.tolist(), walk_dists.tolist())]
+
+
+def write_transfers_table(conn, transfers):
+    '''Replace the transfers table in the GTFS SQL database connection conn
+    with the rows returned by compute_stop_transfers().'''
+    c = conn.cursor()
+    c.execute("DROP TABLE IF EXISTS %s;" % TransfersTableName)
+    c.execute('''
+        CREATE TABLE %s (from_stop_id TEXT, to_stop_id TEXT, transfer_type INTEGER,
+                         min_transfer_time INTEGER, distance REAL)
+        ;''' % TransfersTableName)
+    c.executemany("INSERT INTO %s VALUES (?, ?, 2, ?, ?);" % TransfersTableName, transfers)
+    c.execute("CREATE INDEX transfers_index_fromStopId ON %s (from_stop_id);" % TransfersTableName)
+    conn.commit()
+
+
+def has_transfers_table(conn):
+    '''True if the database has a transfers table written by write_transfers_table().'''
+    c = conn.cursor()
+    c.execute("SELECT name FROM sqlite_master WHERE type='table' AND name=?;", (TransfersTableName,))
+    if not c.fetchone():
+        return False
+    c.execute("PRAGMA table_info(%s)" % TransfersTableName)
+    return "distance" in [col[1] for col in c.fetchall()]
+
+
+def read_transfers(conn, max_distance=None):
+    '''Yield (from_stop_id, to_stop_id, distance) from the transfers table,
+    limited to walking distances of at most max_distance meters if given.'''
+    c = conn.cursor()
+    if max_distance is None:
+        c.execute("SELECT from_stop_id, to_stop_id, distance FROM %s;" % TransfersTableName)
+    else:
+        c.execute("SELECT from_stop_id, to_stop_id, distance FROM %s WHERE distance <= ?;" % TransfersTableName,
+                  (max_distance,))
+    for row in c:
+        yield row
@@ -0,0 +1,348 @@
+################################################################################
+## Toolbox: Add GTFS to a Network Dataset / Transit Analysis Tools
+################################################################################
+'''Build an in-memory timetable from the GTFS SQL database for routing engines
+that work directly on the transit schedules instead of solving the network
+dataset.
+
+The timetable contains:
+- Route patterns: groups of trips that visit the same sequence of stops.  The
+  trips in each pattern are sorted by departure time and never overtake one
+  another, as RAPTOR requires.
+- Walking transfers between stops that are near each other, from the
+  transfers table if the database has one (see StopTransfers.py).
+- A spatial grid of stops for finding walking access and egress stops near
+  arbitrary points.
+
+Times are integer seconds since midnight of the service day.  Trips that
+started on the previous service day and run past midnight are not included.
+'''
+################################################################################
+'''Copyright 2018 Esri
+   Licensed under the Apache License, Version 2.0 (the "License");
+   you may not use this file except in compliance with the License.
+   You may obtain a copy of the License at
+       http://www.apache.org/licenses/LICENSE-2.0
+   Unless required by applicable law or agreed to in writing, software
+   distributed under the License is distributed on an "AS IS" BASIS,
+   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+   See the License for the specific language governing permissions and
+   limitations under the License.'''
+################################################################################
+
+import sqlite3, datetime, math, itertools, operator
+import numpy as np
+import StopTransfers
+
+EarthRadius = 6371000.0 # meters
+# Default walking speed (km/h) and the farthest you'll walk to transfer between stops (meters)
+DefaultWalkSpeed = 5.0
+DefaultMaxTransferDistance = 400.0
+
+weekdays = ["monday", "tuesday", "wednesday", "thursday", "friday", "saturday", "sunday"]
+
+
+def get_service_ids(conn, day):
+    '''Return the set of service_ids running on day.  day is a datetime.  Dates
+    before 1901 are ArcMap's generic weekdays (for example, 1900-01-01 means
+    Monday), which use only the weekday columns in calendar.txt.  Specific
+    dates also use the calendar date ranges and calendar_dates.txt.'''
+
+    c = conn.cursor()
+    specificDates = day.year > 1900
+    weekday = weekdays[day.weekday()]
+    datestring = day.strftime("%Y%m%d")
+
+    c.execute("SELECT name FROM sqlite_master WHERE type='table';")
+    tables = [tbl[0] for tbl in c]
+
+    service_ids = set()
+    if "calendar" in tables:
+        c.execute("SELECT service_id, start_date, end_date FROM calendar WHERE %s == 1;" % weekday)
+        for service_id, start_date, end_date in c:
+            if not specificDates or start_date <= datestring <= end_date:
+                service_ids.add(service_id)
+
+    if specificDates and "calendar_dates" in tables:
+        c.execute("SELECT service_id, exception_type FROM calendar_dates WHERE date == ?;", (datestring,))
+        for service_id, exception_type in c:
+            if exception_type == 1:
+                service_ids.add(service_id)
+            elif exception_type == 2:
+                service_ids.discard(service_id)
+
+    return service_ids
+
+
+class Pattern(object):
+    '''A sequence of stops visited by a group of non-overtaking trips.
+    arrivals[i][j] and departures[i][j] are the times trip j reaches and leaves
+    stops[i].  Within each position the times are sorted, so the earliest trip
+    that can be boarded can be found with bisect.'''
+
+    def __init__(self, stops):
+        self.stops = stops
+        self.trip_ids = []
+        self.arrivals = [[] for stop in stops]
+        self.departures = [[] for stop in stops]
+
+    def can_append(self, arrivals, departures):
+        '''True if a trip with these times does not overtake the last trip in the pattern.'''
+        if not self.trip_ids:
+            return True
+        for i in range(len(self.stops)):
+            if arrivals[i] < self.arrivals[i][-1] or departures[i] < self.departures[i][-1]:
+                return False
+        return True
+
+    def append(self, trip_id, arrivals, departures):
+        self.trip_ids.append(trip_id)
+        for i in range(len(self.stops)):
+            self.arrivals[i].append(arrivals[i])
+            self.departures[i].append(departures[i])
+
+
+class Timetable(object):
+    '''Route patterns, transfers, and stop locations for one service day.'''
+
+    def __init__(self, stop_ids, stop_lons, stop_lats, walk_speed=DefaultWalkSpeed):
+        self.stop_ids = list(stop_ids)
+        self.stop_idx_dict = dict((stop_id, idx) for idx, stop_id in enumerate(self.stop_ids))
+        self.walk_speed = walk_speed * 1000.0 / 3600.0 # meters per second
+        self.patterns = []
+        # stop_patterns[s] = [(pattern index, position of s in the pattern), ...]
+        self.stop_patterns = [[] for stop_id in self.stop_ids]
+        # transfers[s] = [(stop index, walk time in seconds), ...]
+        self.transfers = [[] for stop_id in self.stop_ids]
+
+        # Project the stops to an equirectangular plane in meters. This is
+        # accurate enough for walking distances within a city.
+        lons = np.array(stop_lons, dtype=np.float64)
+        lats = np.array(stop_lats, dtype=np.float64)
+        valid = ~(np.isnan(lons) | np.isnan(lats))
+        self.ref_lat = math.radians(float(np.mean(lats[valid]))) if valid.any() else 0.0
+        self.stop_xs, self.stop_ys = self.project(lons, lats)
+        self.grid_size = None
+        self.grid = {}
+
+    def project(self, lons, lats):
+        '''Project WGS84 lon/lat degrees to x/y meters.'''
+        xs = EarthRadius * np.radians(lons) * math.cos(self.ref_lat)
+        ys = EarthRadius * np.radians(lats)
+        return xs, ys
+
+    def build_grid(self, grid_size):
+        '''Hash the stops into square cells of grid_size meters.'''
+        self.grid_size = float(grid_size)
+        self.grid = {}
+        valid = ~(np.isnan(self.stop_xs) | np.isnan(self.stop_ys))
+        cells_x = np.floor(self.stop_xs[valid] / self.grid_size).astype(np.int64)
+        cells_y = np.floor(self.stop_ys[valid] / self.grid_size).astype(np.int64)
+        for stop_idx, cell in zip(np.nonzero(valid)[0].tolist(), zip(cells_x.tolist(), cells_y.tolist())):
+            self.grid.setdefault(cell, []).append(stop_idx)
+
+    def stops_near(self, lon, lat, radius):
+        '''Return (stop indices, distances in meters) of the stops within radius
+        meters of the lon/lat point, as numpy arrays.'''
+        if radius <= 0:
+            return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.float64)
+        if self.grid_size is None or self.grid_size < radius:
+            self.build_grid(radius)
+        x, y = self.project(np.array([lon], dtype=np.float64), np.array([lat], dtype=np.float64))
+        x = float(x[0])
+        y = float(y[0])
+        cell_x = int(math.floor(x / self.grid_size))
+        cell_y = int(math.floor(y / self.grid_size))
+        candidates = []
+        for dx in (-1, 0, 1):
+            for dy in (-1, 0, 1):
+                candidates += self.grid.get((cell_x + dx, cell_y + dy), [])
+        candidates = np.array(candidates, dtype=np.int64)
+        dists = np.hypot(self.stop_xs[candidates] - x, self.stop_ys[candidates] - y)
+        near = dists <= radius
+        return candidates[near], dists[near]
+
+    def walk_time(self, distance):
+        '''Walk time in seconds for a distance in meters.'''
+        return distance / self.walk_speed
+
+    def add_trips(self, trips):
+        '''Group trips into patterns.  trips is an iterable of
+        (trip_id, [(stop_id, arrival_time, departure_time), ...]) with the stop
+        times in stop_sequence order.'''
+        pattern_trips = {}
+        for trip_id, stop_times in trips:
+            if len(stop_times) < 2:
+                continue
+            stops = tuple(self.stop_idx_dict[st[0]] for st in stop_times)
+            arrivals = [int(round(st[1])) for st in stop_times]
+            departures = [int(round(st[2])) for st in stop_times]
+            pattern_trips.setdefault(stops, []).append((departures[0], trip_id, arrivals, departures))
+
+        for stops, trip_list in pattern_trips.items():
+            trip_list.sort(key=operator.itemgetter(0))
+            # Split the trips into groups that don't overtake one another
+            patterns = []
+            for first_departure, trip_id, arrivals, departures in trip_list:
+                for pattern in patterns:
+                    if pattern.can_append(arrivals, departures):
+                        break
+                else:
+                    pattern = Pattern(list(stops))
+                    patterns.append(pattern)
+                pattern.append(trip_id, arrivals, departures)
+            for pattern in patterns:
+                pattern_idx = len(self.patterns)
+                self.patterns.append(pattern)
+                for position, stop_idx in enumerate(pattern.stops):
+                    self.stop_patterns[stop_idx].append((pattern_idx, position))
+
+    def add_proximity_transfers(self, max_distance=DefaultMaxTransferDistance):
+        '''Add walking transfers between all pairs of stops within max_distance
+        meters of each other (straight-line distance).'''
+        if not max_distance or max_distance <= 0:
+            return
+        from_idxs, to_idxs, dists = StopTransfers.find_near_pairs(self.stop_xs, self.stop_ys, max_distance)
+        for from_idx, to_idx, dist in zip(from_idxs.tolist(), to_idxs.tolist(), dists.tolist()):
+            self.transfers[from_idx].append((to_idx, int(math.ceil(self.walk_time(dist)))))
+
+    def add_table_transfers(self, transfers):
+        '''Add walking transfers from an iterable of (from_stop_id, to_stop_id,
+        walking distance in meters), such as StopTransfers.read_transfers().
+        Transfers involving stops that aren't in the timetable are skipped.'''
+        for from_stop_id, to_stop_id, distance in transfers:
+            from_idx = self.stop_idx_dict.get(from_stop_id)
+            to_idx = self.stop_idx_dict.get(to_stop_id)
+            if from_idx is None or to_idx is None or from_idx == to_idx:
+                continue
+            self.transfers[from_idx].append((to_idx, int(math.ceil(self.walk_time(distance)))))
+
+
+def make_runs(segments):
+    '''Reconstruct the stop times of vehicle runs from the line segments of
+    one trip_id in the schedules table.  segments is a list of
+    (start_time, end_time, from_stop, to_stop) sorted by start_time.
+    Frequency-based trips share a trip_id across several runs, and segments
+    dropped by Generate Transit Lines and Stops (such as zero-length lines)
+    leave gaps, so a trip_id can produce more than one run.'''
+    runs = []
+    waiting = {} # {stop_id: [runs whose last stop is stop_id]}
+    for start_time, end_time, from_stop, to_stop in segments:
+        run = None
+        for candidate in waiting.get(from_stop, []):
+            if candidate[-1][1] <= start_time:
+                run = candidate
+                waiting[from_stop].remove(candidate)
+                break
+        if run is None:
+            run = [[from_stop, start_time, start_time]]
+            runs.append(run)
+        else:
+            run[-1][2] = start_time
+        run.append([to_stop, end_time, end_time])
+        waiting.setdefault(to_stop, []).append(run)
+    return runs
+
+
+def read_trips_from_schedules(conn, trip_service_dict, service_ids):
+    '''Yield (trip_id, stop_times) for running trips from the schedules and
+    linefeatures tables written by Generate Transit Lines and Stops.'''
+    c = conn.cursor()
+    c.execute('''
+        SELECT schedules.trip_id, schedules.start_time, schedules.end_time,
+            linefeatures.from_stop, linefeatures.to_stop
+        FROM schedules
+        JOIN linefeatures ON schedules.SourceOID = linefeatures.SourceOID
+        ORDER BY schedules.trip_id, schedules.start_time
+        ;''')
+    for trip_id, rows in itertools.groupby(c, key=operator.itemgetter(0)):
+        if trip_service_dict.get(trip_id) not in service_ids:
+            continue
+        segments = [row[1:] for row in rows]
+        for run_num, run in enumerate(make_runs(segments)):
+            yield ("%s_%i" % (trip_id, run_num) if run_num else trip_id), run
+
+
+def read_trips_from_stop_times(conn, trip_service_dict, service_ids):
+    '''Yield (trip_id, stop_times) for running trips from the stop_times and
+    frequencies tables.'''
+    c = conn.cursor()
+    frequencies_dict = {}
+    c.execute("SELECT name FROM sqlite_master WHERE type='table' AND name='frequencies';")
+    if c.fetchone():
+        c.execute("SELECT trip_id, start_time, end_time, headway_secs FROM frequencies;")
+        for trip_id, start_time, end_time, headway_secs in c:
+            if headway_secs > 0:
+                frequencies_dict.setdefault(trip_id, []).append((start_time, end_time, headway_secs))
+
+    c.execute('''
+        SELECT trip_id, stop_id, arrival_time, departure_time
+        FROM stop_times
+        ORDER BY trip_id, stop_sequence
+        ;''')
+    for trip_id, rows in itertools.groupby(c, key=operator.itemgetter(0)):
+        if trip_service_dict.get(trip_id) not in service_ids:
+            continue
+        stop_times = [row[1:] for row in rows]
+        if trip_id not in frequencies_dict:
+            yield trip_id, stop_times
+            continue
+        # Shift the trip's relative stop times to each headway start time
+        first_departure = stop_times[0][2]
+        run_num = 0
+        for start_time, end_time, headway_secs in frequencies_dict[trip_id]:
+            for run_start in range(int(round(start_time)), int(round(end_time)), headway_secs):
+                shift = run_start - first_departure
+                yield "%s_%i" % (trip_id, run_num), [(st[0], st[1] + shift, st[2] + shift) for st in stop_times]
+                run_num += 1
+
+
+def load_timetable(SQLDbase, day, max_transfer_distance=DefaultMaxTransferDistance, walk_speed=DefaultWalkSpeed):
+    '''Build the Timetable for the trips running on day (a datetime) from a GTFS
+    SQL database.  Stop times come from the stop_times table if it exists,
+    otherwise from the schedules and linefeatures tables.  Walking transfers
+    come from the transfers table if it exists, otherwise they connect all
+    stops within max_transfer_distance meters.  A max_transfer_distance of 0
+    turns off transfers in both cases.'''
+
+    conn = sqlite3.connect(SQLDbase)
+    c = conn.cursor()
+    try:
+        c.execute("SELECT name FROM sqlite_master WHERE type='table';")
+        tables = [tbl[0] for tbl in c]
+
+        service_ids = get_service_ids(conn, day)
+        c.execute("SELECT trip_id, service_id FROM trips;")
+        trip_service_dict = dict(c.fetchall())
+
+        if "stop_times" in tables:
+            trips = list(read_trips_from_stop_times(conn, trip_service_dict, service_ids))
+        else:
+            trips = list(read_trips_from_schedules(conn, trip_service_dict, service_ids))
+
+        # Stops from stops.txt, plus any stop used by a trip but missing from
+        # stops.txt (these have no location, so they get no walking links).
+        stop_locs = {}
+        c.execute("SELECT stop_id, stop_lon, stop_lat FROM stops;")
+        for stop_id, stop_lon, stop_lat in c:
+            stop_locs[stop_id] = (float(stop_lon), float(stop_lat))
+        for trip_id, stop_times in trips:
+            for st in stop_times:
+                if st[0] not in stop_locs:
+                    stop_locs[st[0]] = (float("nan"), float("nan"))
+
+        table_transfers = None
+        if max_transfer_distance and StopTransfers.has_transfers_table(conn):
+            table_transfers = list(StopTransfers.read_transfers(conn))
+    finally:
+        conn.close()
+
+    stop_ids = sorted(stop_locs)
+    timetable = Timetable(stop_ids, [stop_locs[s][0] for s in stop_ids],
+                          [stop_locs[s][1] for s in stop_ids], walk_speed)
+    timetable.add_trips(trips)
+    if table_transfers is not None:
+        timetable.add_table_transfers(table_transfers)
+    else:
+        timetable.add_proximity_transfers(max_transfer_distance)
+    return timetable
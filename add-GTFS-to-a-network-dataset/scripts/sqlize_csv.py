@@ -130,7 +130,6 @@ sql_schema = {
                 "eid" :    (int, True)
             },
         "schedules" : { # Non-GTFS table for each instance of a transit trip crossing a line
-                "SourceOIDKey" :     (str, True),
                 "SourceOID" :     (int, True),
                 "trip_id" :     (str, True),
                 "start_time" :  (float, True),
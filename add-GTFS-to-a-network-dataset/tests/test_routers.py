@@ -0,0 +1,109 @@
+'''Tests for the routing engines that work directly on the GTFS timetable.'''
+
+import os, sys, random
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "scripts"))
+import TransitTimetable, RaptorRouter, ConnectionScanRouter
+
+INF = RaptorRouter.INF
+
+
+def make_timetable(stop_ids, trips, transfers=None):
+    '''trips is [(trip_id, [(stop_id, time), ...]), ...] with equal arrival and
+    departure times.  transfers is [(from_stop_id, to_stop_id, walk time), ...].'''
+    timetable = TransitTimetable.Timetable(stop_ids, [0.0] * len(stop_ids), [0.0] * len(stop_ids))
+    timetable.add_trips([(trip_id, [(stop_id, t, t) for stop_id, t in stop_times]) for trip_id, stop_times in trips])
+    for from_stop, to_stop, walk_time in transfers or []:
+        timetable.transfers[timetable.stop_idx_dict[from_stop]].append((timetable.stop_idx_dict[to_stop], walk_time))
+    return timetable
+
+
+def random_timetable(seed, zero_duration_share=0.5):
+    '''A small random timetable with many zero-duration hops and transfers.'''
+    rng = random.Random(seed)
+    stop_ids = ["S%i" % i for i in range(12)]
+    rng.shuffle(stop_ids)
+    trips = []
+    for trip_num in range(25):
+        t = rng.randrange(0, 3000, 60)
+        stop_times = []
+        for stop_id in rng.sample(stop_ids, rng.randint(2, 5)):
+            stop_times.append((stop_id, t))
+            if rng.random() >= zero_duration_share:
+                t += rng.choice([60, 120, 180])
+        trips.append(("T%i" % trip_num, stop_times))
+    transfers = []
+    for i in range(8):
+        from_stop, to_stop = rng.sample(stop_ids, 2)
+        transfers.append((from_stop, to_stop, rng.choice([60, 120])))
+    return make_timetable(stop_ids, trips, transfers)
+
+
+def test_raptor_profile_keeps_journeys_with_fewer_trips():
+    # A->X directly (1 trip) arrives later than A->B->X (2 trips), and only
+    # the direct trip leaves room for X->Y within two trips.
+    timetable = make_timetable(["A", "X", "B", "Y"], [
+        ("R1", [("A", 100), ("X", 1000)]),
+        ("R2", [("A", 200), ("B", 300)]),
+        ("R3", [("B", 350), ("X", 500)]),
+        ("R4", [("X", 1100), ("Y", 1200)])])
+    router = RaptorRouter.RaptorRouter(timetable, max_rounds=2)
+    a, y = timetable.stop_idx_dict["A"], timetable.stop_idx_dict["Y"]
+    assert router.earliest_arrival({a: 0}, 50)[y] == 1200
+    assert router.profile({a: 0}, [50, 150])[:, y].tolist() == [1200, INF]
+
+
+def test_raptor_profile_matches_single_departures():
+    departure_times = list(range(0, 1500, 120))
+    for seed in range(100):
+        timetable = random_timetable(seed)
+        router = RaptorRouter.RaptorRouter(timetable, max_rounds=2)
+        access = {seed % len(timetable.stop_ids): 0}
+        singles = np.array([router.earliest_arrival(access, t) for t in departure_times])
+        assert np.array_equal(router.profile(access, departure_times), singles), seed
+
+
+def test_csa_chains_zero_duration_connections_in_any_order():
+    # A->B->C all at the same instant, with B indexed (and so sorted) before A.
+    timetable = make_timetable(["B", "A", "C"], [
+        ("T1", [("A", 100), ("B", 100), ("C", 100)])])
+    router = ConnectionScanRouter.ConnectionScanRouter(timetable)
+    a, c = timetable.stop_idx_dict["A"], timetable.stop_idx_dict["C"]
+    assert router.earliest_arrival({a: 0}, 50)[c] == 100
+    assert router.profile({a: 0}, [50, 150])[:, c].tolist() == [100, INF]
+    assert router.stop_to_stop("A", "C", 40) == 1.0
+
+
+def test_csa_transfers_between_trips_at_the_same_instant():
+    timetable = make_timetable(["C", "B", "A"], [
+        ("T2", [("B", 100), ("C", 100)]),
+        ("T1", [("A", 100), ("B", 100)])])
+    router = ConnectionScanRouter.ConnectionScanRouter(timetable)
+    a, c = timetable.stop_idx_dict["A"], timetable.stop_idx_dict["C"]
+    assert router.earliest_arrival({a: 0}, 0)[c] == 100
+    assert router.profile({a: 0}, [0, 100])[:, c].tolist() == [100, 100]
+
+
+def test_csa_returns_float_arrivals():
+    timetable = make_timetable(["A", "B"], [("T1", [("A", 100), ("B", 200)])])
+    router = ConnectionScanRouter.ConnectionScanRouter(timetable)
+    arrivals = router.profile({0: 0}, [0, 150])
+    assert arrivals.dtype == np.float64
+    assert arrivals[:, 1].tolist() == [200, INF]
+    assert router.stop_to_stop("A", "B", 80) == 2.0
+    assert router.stop_to_stop("A", "B", 150) is None
+
+
+def test_csa_matches_raptor():
+    departure_times = list(range(0, 1500, 120))
+    for seed in range(100):
+        timetable = random_timetable(seed)
+        csa = ConnectionScanRouter.ConnectionScanRouter(timetable)
+        raptor = RaptorRouter.RaptorRouter(timetable, max_rounds=30)
+        access = {seed % len(timetable.stop_ids): 0}
+        profile = csa.profile(access, departure_times)
+        for i, t in enumerate(departure_times):
+            expected = raptor.earliest_arrival(access, t)
+            assert np.array_equal(csa.earliest_arrival(access, t), expected), seed
+            assert np.array_equal(profile[i], expected), seed
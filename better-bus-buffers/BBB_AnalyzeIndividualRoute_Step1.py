@@ -40,6 +40,101 @@ OverwriteOutput = None
 conn = None
 
 
+def MakeAllRoutesBuffers(outGDB, c, inNetworkDataset, imp, BufferSize, restrictions, TrimSettings):
+    '''Create the stops and service area polygons for every route-direction in the
+    GTFS data at once. Service areas are solved only once for the set of all
+    stops served by any route and then copied to each route-direction serving that
+    stop. Returns the paths to the output stops and polygons feature classes.'''
+
+    # ----- Get the set of stops served by each route-direction -----
+    try:
+        arcpy.AddMessage("Gathering route, trip, and stop information...")
+
+        # Some GTFS datasets use the same route_id to identify trips traveling in
+        # either direction along a route. Others identify it as a different route.
+        # We will consider each direction separately if there is more than one.
+        # If a stop is used for trips going in both directions, count them separately.
+        routestopsfetch = '''
+            SELECT DISTINCT trips.route_id, trips.direction_id, stop_times.stop_id
+            FROM trips
+            JOIN stop_times ON stop_times.trip_id = trips.trip_id
+            ;'''
+        c.execute(routestopsfetch)
+        stoplist = {} # {(route_id, direction_id): [stop_id, stop_id, ...]}
+        for route_stop in c:
+            stoplist.setdefault((route_stop[0], route_stop[1]), []).append(route_stop[2])
+        if not stoplist:
+            arcpy.AddError("There are no trips in the GTFS data.  Please fix your GTFS dataset.")
+            raise BBB_SharedFunctions.CustomError
+        allstops = sorted(set([stop for rtdir in stoplist for stop in stoplist[rtdir]]))
+        arcpy.AddMessage("Found %i route-direction pairs serving %i unique stops." % (len(stoplist), len(allstops)))
+
+    except:
+        arcpy.AddError("Error getting stops associated with routes.")
+        raise
+
+    # ----- Create a feature class of the unique stops and solve the service areas -----
+    try:
+        arcpy.AddMessage("Creating buffers around stops...")
+
+        uniqueStops = os.path.join("in_memory", "UniqueStops")
+        uniqueStops, outStopList = BBB_SharedFunctions.MakeStopsFeatureClass(uniqueStops, allstops)
+
+        TrimPolys, TrimPolysValue = BBB_SharedFunctions.CleanUpTrimSettings(TrimSettings)
+        polygons = BBB_SharedFunctions.MakeServiceAreasAroundStops(uniqueStops, inNetworkDataset, BBB_SharedFunctions.CleanUpImpedance(imp), BufferSize, restrictions, TrimPolys, TrimPolysValue)
+
+        # Join stop information to polygons
+        arcpy.management.AddJoin(polygons, "stop_id", uniqueStops, "stop_id")
+        uniquePolys = os.path.join("in_memory", "UniquePolys")
+        arcpy.management.CopyFeatures(polygons, uniquePolys)
+
+    except:
+        arcpy.AddError("Error creating buffers around stops.")
+        raise
+
+    # ----- Copy the stops and polygons to each route-direction serving them -----
+    try:
+        arcpy.AddMessage("Writing stops and buffers for each route-direction...")
+
+        outFCs = []
+        for inFC, outName in [(uniqueStops, "Stops_AllRoutes"), (uniquePolys, "Buffers_AllRoutes")]:
+            outFC = os.path.join(outGDB, arcpy.ValidateTableName(outName, outGDB))
+            desc = arcpy.Describe(inFC)
+            arcpy.management.CreateFeatureclass(outGDB, os.path.basename(outFC), desc.shapeType,
+                                                inFC, spatial_reference=desc.spatialReference)
+            arcpy.management.AddField(outFC, "route_id", "TEXT")
+            arcpy.management.AddField(outFC, "direction_id", "TEXT")
+
+            # Read the features for each stop once
+            fields = ["SHAPE@"] + [f.name for f in arcpy.ListFields(inFC) if f.type not in ["OID", "Geometry"]
+                                   and f.name.lower() not in ["shape_length", "shape_area"]]
+            stop_idx = fields.index("stop_id")
+            stop_rows = {} # {stop_id: [row, row, ...]}
+            with arcpy.da.SearchCursor(inFC, fields) as cur:
+                for row in cur:
+                    stop_rows.setdefault(row[stop_idx], []).append(row)
+
+            # Write a copy of them for each route-direction serving the stop
+            with arcpy.da.InsertCursor(outFC, fields + ["route_id", "direction_id"]) as cur:
+                for rtdir in sorted(stoplist, key=lambda rtdir: (str(rtdir[0]), str(rtdir[1]))):
+                    direction = rtdir[1]
+                    if direction is not None:
+                        direction = str(direction)
+                    for stop in stoplist[rtdir]:
+                        for row in stop_rows.get(stop, []):
+                            cur.insertRow(list(row) + [rtdir[0], direction])
+            outFCs.append(outFC)
+
+        arcpy.management.Delete(uniqueStops)
+        arcpy.management.Delete(uniquePolys)
+
+    except:
+        arcpy.AddError("Error writing stops and buffers for each route-direction.")
+        raise
+
+    return outFCs
+
+
 def runTool(outGDB, SQLDbase, RouteText, inNetworkDataset, imp, BufferSize, restrictions, TrimSettings):
     try:
         OverwriteOutput = arcpy.env.overwriteOutput # Get the orignal value so we can reset it.
@@ -52,6 +147,19 @@ def runTool(outGDB, SQLDbase, RouteText, inNetworkDataset, imp, BufferSize, rest
         BBB_SharedFunctions.CheckWorkspace()
         
         
+        # ===== Batch mode: analyze all routes at once =====
+        if RouteText == BBB_SharedFunctions.AllRoutesText:
+            conn = sqlite3.connect(SQLDbase)
+            c = BBB_SharedFunctions.c = conn.cursor()
+            outFClistwpaths = MakeAllRoutesBuffers(outGDB, c, inNetworkDataset, imp, BufferSize, restrictions, TrimSettings)
+            arcpy.AddMessage("Done!")
+            arcpy.AddMessage("Output written to %s is:" % outGDB)
+            for fc in outFClistwpaths:
+                arcpy.AddMessage("- " + os.path.basename(fc))
+            # Tell the tool that this is output. This will add the output to the map.
+            arcpy.SetParameterAsText(8, ';'.join(outFClistwpaths))
+            return
+
         # ===== Get trips and stops associated with this route =====
 
         # ----- Figure out which route the user wants to analyze based on the text input -----
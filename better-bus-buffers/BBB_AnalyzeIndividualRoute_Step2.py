@@ -128,16 +128,15 @@ fields %s. Please choose a valid feature class." % (FC, str(RequiredFields)))
 
         # ----- Get list of route_ids and direction_ids to analyze from input files -----
         try:
-            # We just check the first line in each file for this information.
-            FC_route_dir_dict = {} # {FC: [route_id, direction_id]}
+            # Feature classes created for all routes at once contain many route-direction
+            # pairs, so check every row.
             route_dir_list = [] # [[route_id, direction_id], ...]
             for FC in FCList:
                 with arcpy.da.SearchCursor(FC, ["route_id", "direction_id"]) as cur:
-                    rt_dir = cur.next()
-                route_dir_pair = [rt_dir[0], rt_dir[1]]
-                FC_route_dir_dict[FC] = route_dir_pair
-                if not route_dir_pair in route_dir_list:
-                    route_dir_list.append(route_dir_pair)
+                    for rt_dir in sorted(set(cur), key=lambda rt_dir: (str(rt_dir[0]), str(rt_dir[1]))):
+                        route_dir_pair = [rt_dir[0], rt_dir[1]]
+                        if not route_dir_pair in route_dir_list:
+                            route_dir_list.append(route_dir_pair)
 
         except:
             arcpy.AddError("Error getting route_id and direction_id values from input feature classes.")
@@ -58,43 +58,60 @@ def post_process_headways(avg_headway, number_of_trips_per_hour, trip_per_hr_thr
     return avg_headway
 
 
-def runTool(outStops, SQLDbase, day, start_time, end_time, DepOrArrChoice, FrequencyThreshold,
-            SnapToNearest5MinuteBool):
-    def RetrieveFrequencyStatsForStop(stop_id, rtdirtuple, snap_to_nearest_5_minutes=False):
-        '''For a given stop, query the stop_time_dictionaries {stop_id: [[trip_id, stop_time]]}
-        and return the NumTrips, NumTripsPerHr, MaxWaitTime, and AvgHeadway given a
-        specific route_id and direction. If snap to nearest five minutes is true, then
-        this function will return headways snapped to the closest 5 minute interval.'''
-        try:
-            stop_time_dictionaries = stoptimedict_rtedirpair[rtdirtuple]
-        except KeyError:
-            # We will get a KeyError if there were no trips found for the route/direction
-            # pair, which usually happens if the wrong SQL database was selected.
-            stop_time_dictionaries = {}
-
-        # Make a list of stop_times
-        StopTimesAtThisPoint = []
-        try:
-            for trip in stop_time_dictionaries[stop_id]:
-                StopTimesAtThisPoint.append(trip[1])
-        except KeyError:
-            pass
-        StopTimesAtThisPoint.sort()
-
-        # Calculate the number of trips
-        NumTrips = len(StopTimesAtThisPoint)
-        NumTripsPerHr = float(NumTrips) / TimeWindowLength
-        # Get the max wait time and the average headway
-        MaxWaitTime = BBB_SharedFunctions.CalculateMaxWaitTime(StopTimesAtThisPoint, start_sec, end_sec)
-        AvgHeadway = None
-        if NumTrips > 1:
-            AvgHeadway = max(1, int(round(float(
-                sum(abs(x - y) for (x, y) in zip(StopTimesAtThisPoint[1:], StopTimesAtThisPoint[:-1])) / (
-                    len(StopTimesAtThisPoint) - 1)) / 60, 0)))  # minutes
-            if snap_to_nearest_5_minutes:
-                AvgHeadway = round(AvgHeadway / 5.0) * 5
-        return NumTrips, NumTripsPerHr, MaxWaitTime, AvgHeadway
+def CalculateStopFrequencyStatistics(rtdirs, rtdir_idx, stop_ids, stop_times, start_sec, end_sec,
+                                     FrequencyThreshold, SnapToNearest5MinuteBool):
+    '''Calculate the frequency statistics for each stop from the stop visits of a
+    time window, tagged with their route-direction pair (see
+    BBB_SharedFunctions.GetStopTimeEventsByRouteDirection). Returns a pandas
+    dataframe indexed by stop_id.'''
+    import pandas as pd
+
+    # Window of Time In Hours
+    TimeWindowLength = (end_sec - start_sec) / 3600
+
+    # Group the stop visits by stop and route-direction pair and calculate
+    # the statistics for all groups at once
+    stop_names, stop_idx = np.unique(stop_ids, return_inverse=True)
+    nstops = max(len(stop_names), 1)
+    group_keys, group_idx = np.unique(rtdir_idx * nstops + stop_idx, return_inverse=True)
+    trip_idx = np.zeros(len(group_idx), dtype=np.int64) # Trips are not needed here
+    NumTrips, NumVisits, MaxWaitTime, AvgHeadway = BBB_SharedFunctions.CalculateGroupedTimeStats(
+        group_idx, trip_idx, stop_times, len(group_keys), start_sec, end_sec)
+    # Each stop visit counts as a trip
+    NumTrips = NumVisits
+    NumTripsPerHr = NumTrips / float(TimeWindowLength)
+    MaxWaitTime = BBB_SharedFunctions.SecondsToMinutes(MaxWaitTime)
+    AvgHeadway = np.maximum(1, BBB_SharedFunctions.SecondsToMinutes(AvgHeadway))
+    if SnapToNearest5MinuteBool:
+        # Snap headways to the nearest 5 minutes
+        AvgHeadway = np.round(AvgHeadway / 5.0) * 5
+    AvgHeadway = np.array([post_process_headways(h, n) for h, n in zip(AvgHeadway, NumTripsPerHr)])
+
+    frequency_dataframe = pd.DataFrame(collections.OrderedDict([
+        ("rte_count", [rtdirs[i][0] for i in group_keys // nstops]),
+        ("stop_id", stop_names[group_keys % nstops]),
+        ("NumTrips", NumTrips),
+        ("NumTripsPerHr", NumTripsPerHr),
+        ("MaxWaitTime", MaxWaitTime),
+        ("AvgHeadway", AvgHeadway)]))
+    # Count the number of routes that meet threshold
+    frequency_dataframe["MetHdWyLim"] = 1
+    frequency_dataframe["MetHdWyLim"] = frequency_dataframe["MetHdWyLim"].where(
+        frequency_dataframe["AvgHeadway"] <= FrequencyThreshold, np.nan)
+    # Add Fields for frequency aggregation
+    frequency_dataframe["MinHeadway"] = frequency_dataframe["AvgHeadway"]
+    frequency_dataframe["MaxHeadway"] = frequency_dataframe["AvgHeadway"]
+    output_stats = collections.OrderedDict([("NumTrips", ("sum")), ("NumTripsPerHr", ("sum")),
+                                            ("MaxWaitTime", ("max")), ("rte_count", ("count")),
+                                            ("AvgHeadway", ("mean")),
+                                            ("MinHeadway", ("min")), ("MaxHeadway", ("max")),
+                                            ("MetHdWyLim", ("sum"))])
+    stop_groups = frequency_dataframe.groupby("stop_id")
+    return stop_groups.agg(output_stats)
 
+
+def runTool(outStops, SQLDbase, day, start_time, end_time, DepOrArrChoice, FrequencyThreshold,
+            SnapToNearest5MinuteBool, TimePeriods=None):
     try:
         # ------ Get input parameters and set things up. -----
         try:
@@ -114,10 +131,16 @@ def runTool(outStops, SQLDbase, day, start_time, end_time, DepOrArrChoice, Frequ
             conn = BBB_SharedFunctions.conn = sqlite3.connect(SQLDbase)
             c = BBB_SharedFunctions.c = conn.cursor()
 
-            Specific, day = BBB_SharedFunctions.CheckSpecificDate(day)
-            start_sec, end_sec = BBB_SharedFunctions.ConvertTimeWindowToSeconds(start_time, end_time)
-            # Window of Time In Hours
-            TimeWindowLength = (end_sec - start_sec) / 3600
+            # The main time window, plus any additional named time periods. The statistics
+            # for the additional periods go in fields suffixed with the period name.
+            # [[period name, day, start_time, end_time]]
+            time_periods = [["", day, start_time, end_time]]
+            if TimePeriods:
+                time_periods += [list(period) for period in TimePeriods]
+                if ".shp" in outStops:
+                    arcpy.AddError("Multiple time periods cannot be written to a shapefile because the \
+field names would be too long. Please use a file geodatabase feature class or a table file instead.")
+                    raise BBB_SharedFunctions.CustomError
 
             # threshold for headways to be counted
             FrequencyThreshold = float(FrequencyThreshold)
@@ -125,194 +148,115 @@ def runTool(outStops, SQLDbase, day, start_time, end_time, DepOrArrChoice, Frequ
             SnapToNearest5MinuteBool = bool(SnapToNearest5MinuteBool)
             # Does the user want to count arrivals or departures at the stops?
             DepOrArr = BBB_SharedFunctions.CleanUpDepOrArr(DepOrArrChoice)
-            time_period = start_time + ":" + end_time
 
         except:
             arcpy.AddError("Error getting user inputs.")
             raise
 
+        # Write a columnar table instead of a feature class?
+        OutTableType = BBB_SharedFunctions.GetOutputTableType(outStops)
+
         # ----- Create a feature class of stops and add fields for transit trip counts ------
         try:
-            arcpy.AddMessage("Creating feature class of GTFS stops...")
-            # Create a feature class of transit stops
-            outStops, StopIDList = BBB_SharedFunctions.MakeStopsFeatureClass(outStops)
+            if not OutTableType:
+                arcpy.AddMessage("Creating feature class of GTFS stops...")
+                # Create a feature class of transit stops
+                outStops, StopIDList = BBB_SharedFunctions.MakeStopsFeatureClass(outStops)
         except:
             arcpy.AddError("Error creating feature class of GTFS stops.")
             raise
 
-        # ----- Query the GTFS data to count the trips at each stop -----
-        try:
-            arcpy.AddMessage("Calculating the determining trips for route-direction pairs...")
-
-            # Get the service_ids serving the correct days
-            serviceidlist, serviceidlist_yest, serviceidlist_tom = \
-                BBB_SharedFunctions.GetServiceIDListsAndNonOverlaps(day, start_sec, end_sec, DepOrArr, Specific)
-
-            # Assemble Route and Direction IDS
-            triproutefetch = '''SELECT DISTINCT route_id,direction_id FROM trips;'''
-            c.execute(triproutefetch)
-            # route_dir_list = c.fetchall()
-
-            # Some GTFS datasets use the same route_id to identify trips traveling in
-            # either direction along a route. Others identify it as a different route.
-            # We will consider each direction separately if there is more than one.
-            trip_route_warning_counter = 0
-            trip_route_dict = {}  # {(route_id, direction_id): [trip_id, trip_id,..]}
-            trip_route_dict_yest = {}
-            trip_route_dict_tom = {}
-            triproutelist = []
-            c2 = conn.cursor()
-            for rtpair in c:
-                key = tuple(rtpair)
-                route_id = rtpair[0]
-                direction_id = rtpair[1]
-                # Get list of trips
-                # Ignore direction if this route doesn't have a direction
-                if direction_id not in [None, ""]:  # GTFS can have direction IDs of zero
-                    triproutefetch = '''
-                            SELECT trip_id, service_id FROM trips
-                            WHERE route_id='%s'
-                            AND direction_id=%s
-                            ;''' % (route_id, direction_id)
-                else:
-                    triproutefetch = '''
-                            SELECT trip_id, service_id FROM trips
-                            WHERE route_id='%s'
-                            ;''' % route_id
-                c2.execute(triproutefetch)
-                triproutelist = c2.fetchall()
-                if not triproutelist:
-                    arcpy.AddWarning("Your GTFS dataset does not contain any trips \
-corresponding to Route %s and Direction %s. Please ensure that \
-you have selected the correct GTFS SQL file for this input file or that your \
-GTFS data is good. Output fields will be generated, but \
-the values will be 0 or <Null>." % (route_id, str(direction_id)))
-
-                for triproute in triproutelist:
-                    # Only keep trips running on the correct day
-                    if triproute[1] in serviceidlist:
-                        trip_route_dict.setdefault(key, []).append(triproute[0])
-                    if triproute[1] in serviceidlist_tom:
-                        trip_route_dict_tom.setdefault(key, []).append(triproute[0])
-                    if triproute[1] in serviceidlist_yest:
-                        trip_route_dict_yest.setdefault(key, []).append(triproute[0])
-
-                if not trip_route_dict and not trip_route_dict_tom and not trip_route_dict_yest:
-                    arcpy.AddWarning("There is no service for route %s in direction %s \
-on %s during the time window you selected. Output fields will be generated, but \
-the values will be 0 or <Null>." % (route_id, str(direction_id), str(day)))
+        # ----- Query the GTFS data to get the stop visits for each route-direction pair -----
 
-        except:
-            arcpy.AddError("Error getting trips associated with route.")
-            raise
+        # Group the time periods by day so the stop visits for each day are extracted only
+        # once, for the smallest time window covering all that day's periods.
+        # {day: [[period name, start_sec, end_sec, "start_time-end_time"]]}
+        periods_by_day = collections.OrderedDict()
+        for period_name, period_day, period_start, period_end in time_periods:
+            period_start_sec, period_end_sec = BBB_SharedFunctions.ConvertTimeWindowToSeconds(period_start, period_end)
+            periods_by_day.setdefault(period_day, []).append([period_name, period_start_sec, period_end_sec,
+                                                              "%s-%s" % (period_start, period_end)])
 
-        # ----- Query the GTFS data to count the trips at each stop for this time period -----
-        try:
-            arcpy.AddMessage(
-                "Calculating the number of transit trips available during the time window of time period ID {0}...".format(
-                    str(time_period)))
-
-            frequencies_dict = BBB_SharedFunctions.MakeFrequenciesDict()
-
-            stoptimedict_rtedirpair = {}  # #{rtdir tuple:stoptimedict}}
-            stoptimedict_service_check_counter = 0
-            for rtdirpair in list(set([rt for rt in list(trip_route_dict.keys()) + 
-                                                    list(trip_route_dict_yest.keys()) + 
-                                                    list(trip_route_dict_tom.keys())])):
-
-                # Get the stop_times that occur during this time window
-                stoptimedict = {}
-                stoptimedict_yest = {}
-                stoptimedict_tom = {}
-                try:
-                    triplist = trip_route_dict[rtdirpair]
-                    stoptimedict = BBB_SharedFunctions.GetStopTimesForStopsInTimeWindow(start_sec, end_sec, DepOrArr,
-                                                                                        triplist, "today",
-                                                                                        frequencies_dict)
-                except KeyError:  # No trips
-                    pass
-                try:
-                    triplist_yest = trip_route_dict_yest[rtdirpair]
-                    stoptimedict_yest = BBB_SharedFunctions.GetStopTimesForStopsInTimeWindow(start_sec, end_sec,
-                                                                                             DepOrArr, triplist_yest,
-                                                                                             "yesterday",
-                                                                                             frequencies_dict)
-                except KeyError:  # No trips
-                    pass
-                try:
-                    triplist_tom = trip_route_dict_tom[rtdirpair]
-                    stoptimedict_tom = BBB_SharedFunctions.GetStopTimesForStopsInTimeWindow(start_sec, end_sec,
-                                                                                            DepOrArr, triplist_tom,
-                                                                                            "tomorrow",
-                                                                                            frequencies_dict)
-                except KeyError:  # No trips
-                    pass
-
-                # Combine the three dictionaries into one master
-                for stop in stoptimedict_yest:  # Update Dictionaries based on setdefault returns values.
-                    stoptimedict[stop] = stoptimedict.setdefault(stop, []) + stoptimedict_yest[stop]
-                for stop in stoptimedict_tom:
-                    stoptimedict[stop] = stoptimedict.setdefault(stop, []) + stoptimedict_tom[stop]
-                # PD here
-                stoptimedict_rtedirpair[rtdirpair] = stoptimedict  # {rtdir tuple:{stoptimedict}}
-                # Add a minor warning if there is no service for at least one route-direction combination.
-                if not stoptimedict:
-                    stoptimedict_service_check_counter += 1
-            if stoptimedict_service_check_counter > 0:
-                arcpy.AddWarning("There is no service for %s route-direction pair(s) \
-on %s during the time window you selected. Output fields will be generated, but \
-the values will be 0 or <Null>." % (str(stoptimedict_service_check_counter), str(day)))
+        c.execute("SELECT COUNT(*) FROM (SELECT DISTINCT route_id, direction_id FROM trips);")
+        num_rtdirs = c.fetchone()[0]
+        frequencies_dict = BBB_SharedFunctions.MakeFrequenciesDict()
+
+        period_statistics = []
+        for period_day in periods_by_day:
+            periods = periods_by_day[period_day]
+            try:
+                Specific, day = BBB_SharedFunctions.CheckSpecificDate(period_day)
+                start_sec = min([period[1] for period in periods])
+                end_sec = max([period[2] for period in periods])
+                arcpy.AddMessage("Calculating the number of transit trips available on %s during time period(s) %s..." % (
+                    str(period_day), ", ".join([period[3] for period in periods])))
+
+                # Get the service_ids serving the correct days
+                serviceidlist, serviceidlist_yest, serviceidlist_tom = \
+                    BBB_SharedFunctions.GetServiceIDListsAndNonOverlaps(day, start_sec, end_sec, DepOrArr, Specific)
+
+                # Get all stop visits in the time window, tagged with their route-direction pair.
+                # Some GTFS datasets use the same route_id to identify trips traveling in
+                # either direction along a route. Others identify it as a different route.
+                # We will consider each direction separately if there is more than one.
+                rtdirs, rtdir_idx, stop_ids, trip_ids, stop_times, from_frequencies = \
+                    BBB_SharedFunctions.GetStopTimeEventsByRouteDirection(start_sec, end_sec, DepOrArr, serviceidlist,
+                                                                          serviceidlist_yest, serviceidlist_tom,
+                                                                          frequencies_dict)
 
+            except:
+                arcpy.AddError("Error counting arrivals or departures at stop during time window.")
+                raise
 
-        except:
-            arcpy.AddError("Error counting arrivals or departures at stop during time window.")
-            raise
+            try:
+                arcpy.AddMessage("Calculating frequency statistics from route direction pairs...")
+                for period_name, period_start_sec, period_end_sec, period_label in periods:
+                    # Select the stop visits in this period's time window.  Use the same rule as a
+                    # single time window: scheduled visits at the ends of the window are included
+                    # and visits extrapolated from frequencies.txt are not.
+                    in_period = np.where(from_frequencies,
+                                         (stop_times > period_start_sec) & (stop_times < period_end_sec),
+                                         (stop_times >= period_start_sec) & (stop_times <= period_end_sec))
+
+                    # Add a minor warning if there is no service for at least one route-direction combination.
+                    num_no_service = num_rtdirs - len(np.unique(rtdir_idx[in_period]))
+                    if num_no_service > 0:
+                        arcpy.AddWarning("There is no service for %s route-direction pair(s) \
+on %s during the time window %s. Output fields will be generated, but \
+the values will be 0 or <Null>." % (str(num_no_service), str(period_day), period_label))
+
+                    stop_frequency_statistics = CalculateStopFrequencyStatistics(
+                        rtdirs, rtdir_idx[in_period], stop_ids[in_period], stop_times[in_period],
+                        period_start_sec, period_end_sec, FrequencyThreshold, SnapToNearest5MinuteBool)
+                    if period_name:
+                        stop_frequency_statistics = stop_frequency_statistics.add_suffix("_" + period_name)
+                    period_statistics.append(stop_frequency_statistics)
 
-        # ----- Write to output -----
+            except:
+                arcpy.AddError("Error calculating frequency statistics...")
+                raise
+
+        # Combine the periods into one table with one row per stop
+        stop_frequency_statistics = pd.concat(period_statistics, axis=1)
+        stop_frequency_statistics.index.name = "stop_id"
+        if ".shp" in outStops:
+            # Set up shapefile accommodations for long fields (>10 chars) & null values
+            stop_frequency_statistics.rename(columns={"NumTripsPerHr": "TripsPerHr", "MaxWaitTime": "MxWtTime"},
+                                             inplace=True)
+            stop_frequency_statistics = stop_frequency_statistics.fillna(value=-1)
 
-        try:
-            arcpy.AddMessage("Calculating frequency statistics from route direction pairs...")
-            frequency_record_table = []  # [(rtedirpair_id,route_id,direction_id,stop_id,NumTripsPerHr,MaxWaitTime,AvgHeadway)]
-            labels = ["rtedir_id", "rte_count", "stop_id", "NumTrips", "NumTripsPerHr", "MaxWaitTime", "AvgHeadway"]
-            for rtedirpair in stoptimedict_rtedirpair:
-                route_id = rtedirpair[0]
-                stops = stoptimedict_rtedirpair[rtedirpair].keys()
-                for stop_id in stops:
-                    NumTrips, NumTripsPerHr, MaxWaitTime, AvgHeadway = RetrieveFrequencyStatsForStop(stop_id,
-                                                                                                     rtedirpair,
-                                                                                                     snap_to_nearest_5_minutes=SnapToNearest5MinuteBool)
-                    AvgHeadway = post_process_headways(AvgHeadway, NumTripsPerHr)
-                    frequency_record_table.append((rtedirpair, route_id, stop_id, NumTrips, NumTripsPerHr,
-                                                   MaxWaitTime, AvgHeadway))
-            frequency_dataframe = pd.DataFrame.from_records(frequency_record_table, columns=labels)
-            # Count the number of routes that meet threshold
-            frequency_dataframe["MetHdWyLim"] = 1
-            frequency_dataframe["MetHdWyLim"].where(frequency_dataframe["AvgHeadway"] <= FrequencyThreshold, np.nan,
-                                                    inplace=True)
-            # Add Fields for frequency aggregation
-            frequency_dataframe["MinHeadway"] = frequency_dataframe["AvgHeadway"]
-            frequency_dataframe["MaxHeadway"] = frequency_dataframe["AvgHeadway"]
-            output_stats = collections.OrderedDict([("NumTrips", ("sum")), ("NumTripsPerHr", ("sum")),
-                                                    ("MaxWaitTime", ("max")), ("rte_count", ("count")),
-                                                    ("AvgHeadway", ("mean")),
-                                                    ("MinHeadway", ("min")), ("MaxHeadway", ("max")),
-                                                    ("MetHdWyLim", ("sum"))])
-            stop_groups = frequency_dataframe.groupby("stop_id")
-            stop_frequency_statistics = stop_groups.agg(output_stats)
-            if ".shp" in outStops:
-                # Set up shapefile accommodations for long fields (>10 chars) & null values
-                stop_frequency_statistics.rename(columns={"NumTripsPerHr": "TripsPerHr", "MaxWaitTime": "MxWtTime"},
-                                                 inplace=True)
-                stop_frequency_statistics = stop_frequency_statistics.fillna(value=-1)
+        # ----- Write to output -----
 
-        except:
-            arcpy.AddError("Error calculating frequency statistics...")
-            raise
         try:
             arcpy.AddMessage("Writing output data...")
             # Create an update cursor to add numtrips, trips/hr, maxwaittime, and headway stats to stops
-            frequency_records = stop_frequency_statistics.to_records()
-            arcpy.da.ExtendTable(outStops, "stop_id", frequency_records, "stop_id", append_only=False)
+            if OutTableType:
+                BBB_SharedFunctions.WriteStatsToTable(
+                    outStops, "stop_id", stop_frequency_statistics.index.values.astype("U"),
+                    [(col, stop_frequency_statistics[col].values) for col in stop_frequency_statistics.columns])
+            else:
+                frequency_records = stop_frequency_statistics.to_records()
+                arcpy.da.ExtendTable(outStops, "stop_id", frequency_records, "stop_id", append_only=False)
             arcpy.AddMessage("Script complete!")
         except:
             arcpy.AddError("Error writing to output.")
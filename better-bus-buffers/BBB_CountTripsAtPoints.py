@@ -28,12 +28,15 @@ subsequent trips, and the number of stops within range of the input point.
 ################################################################################
 
 import os
+import numpy as np
 import arcpy
-import BBB_SharedFunctions
+import BBB_SharedFunctions, BBB_Scenarios
 
 
 def runTool(outFile, SQLDbase, inPointsLayer, inLocUniqueID, day, start_time, end_time,
-            inNetworkDataset, imp, BufferSize, restrictions, DepOrArrChoice):
+            inNetworkDataset, imp, BufferSize, restrictions, DepOrArrChoice,
+            StopClusterTolerance=None, ClusterByParentStation=False, SnapPrecision=None,
+            AdditionalBufferSizes=None, ScenarioFile=None):
     try:
         # Source FC names are not prepended to field names.
         arcpy.env.qualifiedFieldNames = False
@@ -54,6 +57,11 @@ def runTool(outFile, SQLDbase, inPointsLayer, inLocUniqueID, day, start_time, en
         # Will we calculate the max wait time?
         CalcWaitTime = True
 
+        # What-if service changes to apply to the GTFS data
+        Scenario = None
+        if ScenarioFile:
+            Scenario = BBB_SharedFunctions.LoadScenario(ScenarioFile)
+
         impedanceAttribute = BBB_SharedFunctions.CleanUpImpedance(imp)
 
         # Hard-wired OD variables
@@ -67,8 +75,23 @@ def runTool(outFile, SQLDbase, inPointsLayer, inLocUniqueID, day, start_time, en
         outDir = os.path.dirname(outFile)
         outFilename = os.path.basename(outFile)
 
+        # Statistics can be calculated for several buffer sizes.  The OD matrix is
+        # solved once at the largest one, and the smaller ones filter its results.
+        BufferSizes = [BufferSize]
+        if AdditionalBufferSizes:
+            for AdditionalBuffer in sorted(set(float(b) for b in AdditionalBufferSizes)):
+                if AdditionalBuffer <= 0:
+                    arcpy.AddError("Additional buffer sizes must be greater than 0.")
+                    raise BBB_SharedFunctions.CustomError
+                if AdditionalBuffer != BufferSize:
+                    BufferSizes.append(AdditionalBuffer)
+            if len(BufferSizes) > 1 and ".shp" in outFilename:
+                arcpy.AddError("Shapefile output cannot hold the field names for additional buffer sizes. \
+Please use a feature class in a geodatabase or a table file.")
+                raise BBB_SharedFunctions.CustomError
+        ODCutoff = max(BufferSizes)
+
         inLocUniqueID = BBB_SharedFunctions.HandleOIDUniqueID(inPointsLayer, inLocUniqueID)
-        inLocUniqueID_qualified = inLocUniqueID + "_Input"
 
         arcpy.AddMessage("Run set up successfully.")
 
@@ -76,14 +99,58 @@ def runTool(outFile, SQLDbase, inPointsLayer, inLocUniqueID, day, start_time, en
         try:
             arcpy.AddMessage("Getting GTFS stops...")
             tempstopsname = "Temp_Stops"
+            tempstopsdir = outDir
             if ".shp" in outFilename:
                 tempstopsname += ".shp"
-            StopsLayer, StopList = BBB_SharedFunctions.MakeStopsFeatureClass(os.path.join(outDir, tempstopsname))
+            elif BBB_SharedFunctions.GetOutputTableType(outFile):
+                # The output directory is not a geodatabase
+                tempstopsdir = "in_memory"
+            # Stops very close together (platforms of the same station, stops on
+            # opposite sides of the street) are reached by nearly the same paths, so
+            # only add one representative stop per cluster to the OD matrix.
+            clusters = None
+            if (StopClusterTolerance and StopClusterTolerance > 0) or ClusterByParentStation:
+                arcpy.AddMessage("Clustering nearby stops...")
+                clusters = BBB_SharedFunctions.MakeStopClusters(StopClusterTolerance, ClusterByParentStation)
+                NumStops = sum(len(members) for members in clusters.values())
+                arcpy.AddMessage("%i stops were grouped into %i clusters. The OD matrix will \
+use %i stop locations instead of %i." % (NumStops, len(clusters), len(clusters), NumStops))
+                MetersPerUnit = BBB_SharedFunctions.GetMetersPerImpedanceUnit(imp)
+                if not MetersPerUnit:
+                    arcpy.AddMessage("Your impedance attribute is not a distance, so stops in a \
+cluster will use the travel time to the cluster's representative stop.")
+                StopsLayer, StopList = BBB_SharedFunctions.MakeStopsFeatureClass(
+                                            os.path.join(tempstopsdir, tempstopsname), list(clusters))
+            else:
+                StopsLayer, StopList = BBB_SharedFunctions.MakeStopsFeatureClass(os.path.join(tempstopsdir, tempstopsname))
         except:
             arcpy.AddError("Error creating feature class of GTFS stops.")
             raise
 
 
+        #----- Snap the input points and remove duplicate locations -----
+        # Many input points (apartment units, parcels) share nearly the same
+        # location, so solve the OD and calculate statistics once per location.
+        SnapPoints = SnapPrecision and SnapPrecision > 0
+        try:
+            if SnapPoints:
+                arcpy.AddMessage("Snapping input points to a %s meter grid..." % str(SnapPrecision))
+                ODPointsLayer = os.path.join("in_memory", "UniquePoints")
+                LocIDs, point_groups, NumGroups = BBB_SharedFunctions.MakeUniquePointLocations(
+                                                    inPointsLayer, inLocUniqueID, SnapPrecision, ODPointsLayer)
+                if LocIDs:
+                    arcpy.AddMessage("%i input points were reduced to %i unique locations (%.1f%% of the \
+original number)." % (len(LocIDs), NumGroups, 100.0 * NumGroups / len(LocIDs)))
+                ODLocUniqueID = "LocGroup"
+            else:
+                ODPointsLayer = inPointsLayer
+                ODLocUniqueID = inLocUniqueID
+            ODLocUniqueID_qualified = ODLocUniqueID + "_Input"
+        except:
+            arcpy.AddError("Error snapping input points.")
+            raise
+
+
         #----- Create OD Matrix between stops and user's points -----
         try:
             arcpy.AddMessage("Creating OD matrix between points and stops...")
@@ -94,7 +161,7 @@ def runTool(outFile, SQLDbase, inPointsLayer, inLocUniqueID, day, start_time, en
 
             # ODLayer is the NA Layer object returned by getOutput(0)
             ODLayer = arcpy.na.MakeODCostMatrixLayer(inNetworkDataset, outNALayer_OD,
-                                            impedanceAttribute, BufferSize, "",
+                                            impedanceAttribute, ODCutoff, "",
                                             accumulate, uturns, restrictions,
                                             hierarchy, "", PathShape).getOutput(0)
 
@@ -119,13 +186,13 @@ def runTool(outFile, SQLDbase, inPointsLayer, inLocUniqueID, day, start_time, en
 
             # Add a field for unique identifier for points.
             arcpy.na.AddFieldToAnalysisLayer(outNALayer_OD, points,
-                                            inLocUniqueID_qualified, "TEXT")
+                                            ODLocUniqueID_qualified, "TEXT")
             # Specify the field mappings for the unique id field.
             fieldMappingPoints = arcpy.na.NAClassFieldMappings(ODLayer, points)
-            fieldMappingPoints["Name"].mappedFieldName = inLocUniqueID
-            fieldMappingPoints[inLocUniqueID_qualified].mappedFieldName = inLocUniqueID
+            fieldMappingPoints["Name"].mappedFieldName = ODLocUniqueID
+            fieldMappingPoints[ODLocUniqueID_qualified].mappedFieldName = ODLocUniqueID
             # Add the input points as locations for the analysis.
-            arcpy.na.AddLocations(outNALayer_OD, points, inPointsLayer,
+            arcpy.na.AddLocations(outNALayer_OD, points, ODPointsLayer,
                                     fieldMappingPoints, "500 meters", "", "", "", "", "", "",
                                     ExcludeRestricted)
 
@@ -137,7 +204,7 @@ def runTool(outFile, SQLDbase, inPointsLayer, inLocUniqueID, day, start_time, en
                 if "No solution found" in errs:
                     impunits = imp.split(" (Units: ")[1].split(")")[0]
                     arcpy.AddError("No transit stops were found within a %s %s walk of any of your input points.  \
-Consequently, there is no transit service available to your input points, so no output will be generated." % (str(BufferSize), impunits))
+Consequently, there is no transit service available to your input points, so no output will be generated." % (str(ODCutoff), impunits))
                 else:
                     arcpy.AddError("Failed to calculate travel time or distance between transit stops and input points.  OD Cost Matrix error messages:")
                     arcpy.AddError(errs)
@@ -164,18 +231,36 @@ Consequently, there is no transit service available to your input points, so no
 
             # Join polygons layer with input facilities to port over the stop_id
             arcpy.management.JoinField(linesSubLayer, "OriginID", pointsSubLayer,
-                                        points_OID, [inLocUniqueID_qualified])
+                                        points_OID, [ODLocUniqueID_qualified])
             arcpy.management.JoinField(linesSubLayer, "DestinationID", stopsSubLayer,
                                         stops_OID, ["stop_id"])
 
             # Use searchcursor on lines to find the stops that are reachable from points.
             global PointsAndStops
-            # PointsAndStops = {LocID: [stop_1, stop_2, ...]}
+            # Keep the travel time or distance so smaller buffer sizes can be filtered out later.
+            # PointsAndStops = {LocID: [(stop_1, cost_1), (stop_2, cost_2), ...]}
             PointsAndStops = {}
-            ODCursor = arcpy.da.SearchCursor(linesSubLayer, [inLocUniqueID_qualified, "stop_id"])
-            for row in ODCursor:
-                PointsAndStops.setdefault(str(row[0]), []).append(str(row[1]))
+            ODCursor = arcpy.da.SearchCursor(linesSubLayer, [ODLocUniqueID_qualified, "stop_id",
+                                                            "Total_" + impedanceAttribute])
+            if clusters:
+                # Fan the cluster representatives back out to all their member stops.
+                # For distance impedances, add each member's offset from the
+                # representative and drop members that end up beyond the buffer size.
+                for row in ODCursor:
+                    StopsForPoint = PointsAndStops.setdefault(str(row[0]), [])
+                    for stop_id, dist in clusters[str(row[1])]:
+                        cost = row[2]
+                        if MetersPerUnit:
+                            cost += dist / MetersPerUnit
+                            if cost > ODCutoff:
+                                continue
+                        StopsForPoint.append((str(stop_id), cost))
+            else:
+                for row in ODCursor:
+                    PointsAndStops.setdefault(str(row[0]), []).append((str(row[1]), row[2]))
             del ODCursor
+            if SnapPoints:
+                arcpy.management.Delete(ODPointsLayer)
 
         except:
             arcpy.AddError("Error creating OD matrix between stops and input points.")
@@ -187,58 +272,81 @@ Consequently, there is no transit service available to your input points, so no
             arcpy.AddMessage("Calculating the number of transit trips available during the time window...")
 
             # Get a dictionary of stop times in our time window {stop_id: [[trip_id, stop_time]]}
-            stoptimedict = BBB_SharedFunctions.CountTripsAtStops(day, start_sec, end_sec, BBB_SharedFunctions.CleanUpDepOrArr(DepOrArrChoice), Specific)
+            # A scenario can move trips from outside the time window into it, so fetch those too.
+            fetch_start, fetch_end = BBB_Scenarios.GetScenarioTimeWindow(Scenario, start_sec, end_sec)
+            stoptimedict = BBB_SharedFunctions.CountTripsAtStops(day, fetch_start, fetch_end, BBB_SharedFunctions.CleanUpDepOrArr(DepOrArrChoice), Specific)
+
+            if Scenario:
+                # Apply the what-if service changes to the stop events
+                arcpy.AddMessage("Applying the service scenario...")
+                stoptimedict = BBB_SharedFunctions.ApplyScenario(stoptimedict, Scenario, start_sec, end_sec)
 
         except:
             arcpy.AddError("Error calculating the number of transit trips available during the time window.")
             raise
 
 
+        #----- Calculate statistics for all points at once -----
+        try:
+            if SnapPoints:
+                # Calculate the statistics once per unique location
+                LocKeys = [str(i) for i in range(NumGroups)]
+            else:
+                # Get the unique IDs of all the input points, including the ones with no stops in range
+                with arcpy.da.SearchCursor(inPointsLayer, [inLocUniqueID]) as cur:
+                    LocIDs = [row[0] for row in cur]
+                LocKeys = [str(LocID) for LocID in LocIDs]
+
+            # [[NumTrips, NumTripsPerHr, NumStopsInRange, MaxWaitTime] for each buffer size]
+            BufferStats = []
+            for BufferSizeToUse in BufferSizes:
+                point_idx, offsets, indices, stop_ids = BBB_SharedFunctions.MakeStopSetArrays(
+                    ((i, stop) for i, LocKey in enumerate(LocKeys) for stop, cost in PointsAndStops.get(LocKey, [])
+                        if cost <= BufferSizeToUse),
+                    all_feature_ids=np.arange(len(LocKeys)))
+                stats = BBB_SharedFunctions.RetrieveStatsForStopSets(
+                                offsets, indices, stop_ids, stoptimedict, CalcWaitTime,
+                                start_sec, end_sec)
+                if SnapPoints:
+                    # Broadcast the results back to all the input points at each location
+                    stats = [stat[point_groups] for stat in stats]
+                BufferStats.append(stats)
+        except:
+            arcpy.AddError("Error calculating statistics for input points.")
+            raise
+
+
         # ----- Generate output data -----
         try:
             arcpy.AddMessage("Writing output data...")
 
-            arcpy.management.CopyFeatures(inPointsLayer, outFile)
-            # Add a field to the output file for number of trips and num trips / hour.
             if ".shp" in outFilename:
-                arcpy.management.AddField(outFile, "NumTrips", "SHORT")
-                arcpy.management.AddField(outFile, "TripsPerHr", "DOUBLE")
-                arcpy.management.AddField(outFile, "NumStops", "SHORT")
-                arcpy.management.AddField(outFile, "MaxWaitTm", "SHORT")
+                fieldnames = ["NumTrips", "TripsPerHr", "NumStops", "MaxWaitTm"]
+                outLocUniqueID = inLocUniqueID[0:10]
             else:
-                arcpy.management.AddField(outFile, "NumTrips", "SHORT")
-                arcpy.management.AddField(outFile, "NumTripsPerHr", "DOUBLE")
-                arcpy.management.AddField(outFile, "NumStopsInRange", "SHORT")
-                arcpy.management.AddField(outFile, "MaxWaitTime", "SHORT")
-
-            if ".shp" in outFilename:
-                ucursor = arcpy.da.UpdateCursor(outFile,
-                                                [inLocUniqueID[0:10], "NumTrips",
-                                                "TripsPerHr", "NumStops",
-                                                "MaxWaitTm"])
+                fieldnames = ["NumTrips", "NumTripsPerHr", "NumStopsInRange", "MaxWaitTime"]
+                outLocUniqueID = inLocUniqueID
+            fields = []
+            for BufferSizeToUse, stats in zip(BufferSizes, BufferStats):
+                NumTrips, NumTripsPerHr, NumStopsInRange, MaxWaitTime = stats
+                # Fields for additional buffer sizes get the buffer size as a suffix
+                suffix = ""
+                if BufferSizeToUse != BufferSize:
+                    suffix = "_" + ("%g" % BufferSizeToUse).replace(".", "_")
+                fields += list(zip([fieldname + suffix for fieldname in fieldnames],
+                                   [NumTrips.astype("int32"), NumTripsPerHr,
+                                    NumStopsInRange.astype("int32"), MaxWaitTime]))
+            LocIDs = np.array(LocIDs)
+            if LocIDs.dtype == np.int64 and len(LocIDs) and np.abs(LocIDs).max() < 2**31:
+                # Match the type of a LONG unique ID field for the join
+                LocIDs = LocIDs.astype(np.int32)
+
+            if BBB_SharedFunctions.GetOutputTableType(outFile):
+                # Write a columnar table keyed by the unique ID. No geometry is copied.
+                BBB_SharedFunctions.WriteStatsToTable(outFile, inLocUniqueID, LocIDs, fields)
             else:
-                ucursor = arcpy.da.UpdateCursor(outFile,
-                                            [inLocUniqueID, "NumTrips",
-                                            "NumTripsPerHr", "NumStopsInRange",
-                                            "MaxWaitTime"])
-            for row in ucursor:
-                try:
-                    ImportantStops = PointsAndStops[str(row[0])]
-                except KeyError:
-                    # This point had no stops in range
-                    ImportantStops = []
-                NumTrips, NumTripsPerHr, NumStopsInRange, MaxWaitTime =\
-                                BBB_SharedFunctions.RetrieveStatsForSetOfStops(
-                                    ImportantStops, stoptimedict, CalcWaitTime,
-                                    start_sec, end_sec)
-                row[1] = NumTrips
-                row[2] = NumTripsPerHr
-                row[3] = NumStopsInRange
-                if ".shp" in outFilename and MaxWaitTime == None:
-                    row[4] = -1
-                else:
-                    row[4] = MaxWaitTime
-                ucursor.updateRow(row)
+                arcpy.management.CopyFeatures(inPointsLayer, outFile)
+                BBB_SharedFunctions.WriteStatsToFeatureClass(outFile, outLocUniqueID, LocIDs, fields)
 
         except:
             arcpy.AddError("Error writing output.")
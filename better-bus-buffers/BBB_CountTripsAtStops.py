@@ -26,11 +26,12 @@ during that time window.
    limitations under the License.'''
 ################################################################################
 
+import numpy as np
 import arcpy
-import BBB_SharedFunctions
+import BBB_SharedFunctions, BBB_Scenarios
 
 
-def runTool(outStops, SQLDbase, day, start_time, end_time, DepOrArrChoice):
+def runTool(outStops, SQLDbase, day, start_time, end_time, DepOrArrChoice, ScenarioFile=None):
     try:
             
         BBB_SharedFunctions.CheckArcVersion(min_version_pro="1.2")
@@ -42,23 +43,24 @@ def runTool(outStops, SQLDbase, day, start_time, end_time, DepOrArrChoice):
         # Will we calculate the max wait time?
         CalcWaitTime = True
 
-        # ----- Create a feature class of stops and add fields for transit trip counts ------
-        try:
-            arcpy.AddMessage("Creating feature class of GTFS stops...")
+        # What-if service changes to apply to the GTFS data
+        Scenario = None
+        if ScenarioFile:
+            Scenario = BBB_SharedFunctions.LoadScenario(ScenarioFile)
 
-            # Create a feature class of transit stops
-            outStops, StopIDList = BBB_SharedFunctions.MakeStopsFeatureClass(outStops)
+        # Write a columnar table instead of a feature class?
+        OutTableType = BBB_SharedFunctions.GetOutputTableType(outStops)
 
-            # Add a field to the output file for number of trips, num trips / hour, and max wait time
-            if ".shp" in outStops:
-                # Shapefiles can't have long field names
-                arcpy.management.AddField(outStops, "NumTrips", "SHORT")
-                arcpy.management.AddField(outStops, "TripsPerHr", "DOUBLE")
-                arcpy.management.AddField(outStops, "MaxWaitTm", "SHORT")
+        # ----- Create a feature class of stops ------
+        try:
+            if OutTableType:
+                # No geometry needed. Just get the list of stop_ids.
+                BBB_SharedFunctions.c.execute("SELECT stop_id FROM stops;")
+                StopIDList = [stop[0] for stop in BBB_SharedFunctions.c]
             else:
-                arcpy.management.AddField(outStops, "NumTrips", "SHORT")
-                arcpy.management.AddField(outStops, "NumTripsPerHr", "DOUBLE")
-                arcpy.management.AddField(outStops, "MaxWaitTime", "SHORT")
+                arcpy.AddMessage("Creating feature class of GTFS stops...")
+                # Create a feature class of transit stops
+                outStops, StopIDList = BBB_SharedFunctions.MakeStopsFeatureClass(outStops)
 
         except:
             arcpy.AddError("Error creating feature class of GTFS stops.")
@@ -70,7 +72,21 @@ def runTool(outStops, SQLDbase, day, start_time, end_time, DepOrArrChoice):
             arcpy.AddMessage("Calculating the number of transit trips available during the time window...")
 
             # Get a dictionary of {stop_id: [[trip_id, stop_time]]} for our time window
-            stoptimedict = BBB_SharedFunctions.CountTripsAtStops(day, start_sec, end_sec, BBB_SharedFunctions.CleanUpDepOrArr(DepOrArrChoice), Specific)
+            # A scenario can move trips from outside the time window into it, so fetch those too.
+            fetch_start, fetch_end = BBB_Scenarios.GetScenarioTimeWindow(Scenario, start_sec, end_sec)
+            stoptimedict = BBB_SharedFunctions.CountTripsAtStops(day, fetch_start, fetch_end, BBB_SharedFunctions.CleanUpDepOrArr(DepOrArrChoice), Specific)
+
+            if Scenario:
+                # Apply the what-if service changes to the stop events
+                arcpy.AddMessage("Applying the service scenario...")
+                stoptimedict = BBB_SharedFunctions.ApplyScenario(stoptimedict, Scenario, start_sec, end_sec)
+
+            # Calculate the statistics for all stops at once. Each stop is its own set of stops.
+            stop_idx, offsets, indices, stop_ids = BBB_SharedFunctions.MakeStopSetArrays(enumerate(StopIDList))
+            NumTrips, NumTripsPerHr, NumStopsInRange, MaxWaitTime = \
+                        BBB_SharedFunctions.RetrieveStatsForStopSets(
+                            offsets, indices, stop_ids, stoptimedict, CalcWaitTime,
+                            start_sec, end_sec)
 
         except:
             arcpy.AddError("Error counting arrivals or departures at stop during time window.")
@@ -81,29 +97,18 @@ def runTool(outStops, SQLDbase, day, start_time, end_time, DepOrArrChoice):
         try:
             arcpy.AddMessage("Writing output data...")
 
-            # Create an update cursor to add numtrips, trips/hr, and maxwaittime to stops
+            # Add numtrips, trips/hr, and maxwaittime to stops
             if ".shp" in outStops:
-                ucursor = arcpy.da.UpdateCursor(outStops,
-                                            ["stop_id", "NumTrips",
-                                            "TripsPerHr",
-                                            "MaxWaitTm"])
+                # Shapefiles can't have long field names
+                fieldnames = ["NumTrips", "TripsPerHr", "MaxWaitTm"]
+            else:
+                fieldnames = ["NumTrips", "NumTripsPerHr", "MaxWaitTime"]
+            fields = list(zip(fieldnames, [NumTrips.astype("int32"), NumTripsPerHr, MaxWaitTime]))
+            StopIDs = np.array(StopIDList, dtype="U")[stop_idx]
+            if OutTableType:
+                BBB_SharedFunctions.WriteStatsToTable(outStops, "stop_id", StopIDs, fields)
             else:
-                ucursor = arcpy.da.UpdateCursor(outStops,
-                                            ["stop_id", "NumTrips",
-                                            "NumTripsPerHr",
-                                            "MaxWaitTime"])
-            for row in ucursor:
-                NumTrips, NumTripsPerHr, NumStopsInRange, MaxWaitTime = \
-                            BBB_SharedFunctions.RetrieveStatsForSetOfStops(
-                                [str(row[0])], stoptimedict, CalcWaitTime,
-                                start_sec, end_sec)
-                row[1] = NumTrips
-                row[2] = NumTripsPerHr
-                if ".shp" in outStops and MaxWaitTime == None:
-                    row[3] = -1
-                else:
-                    row[3] = MaxWaitTime
-                ucursor.updateRow(row)
+                BBB_SharedFunctions.WriteStatsToFeatureClass(outStops, "stop_id", StopIDs, fields)
 
         except:
             arcpy.AddError("Error writing to output.")
@@ -37,6 +37,55 @@ import arcpy
 import BBB_SharedFunctions
 
 
+def BuildLineSchedules(conn):
+    '''Create the segments table, with one row per pair of directly-connected
+    stops, and the line-based schedules table, with the start and end time of
+    each trip along each segment.'''
+
+    c = conn.cursor()
+    c.execute("DROP TABLE IF EXISTS segments;")
+    c.execute("DROP TABLE IF EXISTS schedules;")
+    c.execute("CREATE TABLE segments (segment_id INTEGER PRIMARY KEY, from_stop TEXT, to_stop TEXT);")
+    c.execute("CREATE TABLE schedules (segment_id INTEGER, start_time REAL, end_time REAL, trip_id TEXT);")
+
+    # Walk through the ordered stop_times and find the pairs of directly-connected
+    # stops.  This is faster than pairing the stop_times with a LAG window function
+    # in sqlite and works with the older sqlite versions shipped with ArcMap.
+    c2 = conn.cursor()
+    stoptimefetch = '''
+    SELECT trip_id, stop_id, arrival_time, departure_time
+    FROM stop_times
+    ORDER BY trip_id, stop_sequence
+    ;'''
+    c.execute(stoptimefetch)
+    segment_dict = {} # {(from_stop, to_stop): segment_id}
+    rows = []
+    current_trip = None
+    previous_stop = None
+    start_time = None
+    for trip_id, stop_id, arrival_time, departure_time in c:
+        if trip_id != current_trip:
+            current_trip = trip_id
+            previous_stop = stop_id
+            start_time = departure_time # Start time of segment is the departure time from the stop
+            continue
+        segment_id = segment_dict.setdefault((previous_stop, stop_id), len(segment_dict) + 1)
+        rows.append((segment_id, start_time, arrival_time, trip_id))
+        if len(rows) >= 100000:
+            c2.executemany("INSERT INTO schedules (segment_id, start_time, end_time, trip_id) VALUES (?, ?, ?, ?);", rows)
+            rows = []
+        previous_stop = stop_id
+        start_time = departure_time
+    c2.executemany("INSERT INTO schedules (segment_id, start_time, end_time, trip_id) VALUES (?, ?, ?, ?);", rows)
+    c2.executemany("INSERT INTO segments (segment_id, from_stop, to_stop) VALUES (?, ?, ?);",
+                   [(segment_dict[pair], pair[0], pair[1]) for pair in segment_dict])
+    c2.execute("CREATE UNIQUE INDEX segments_index_stops ON segments (from_stop, to_stop);")
+
+    conn.commit()
+    c.execute("CREATE INDEX schedules_index_tripsstend ON schedules (trip_id, start_time, end_time);")
+    conn.commit()
+
+
 # ----- Collect user inputs -----
 
 def runTool(outLinesFC, SQLDbase, combine_corridors):
@@ -63,8 +112,6 @@ def runTool(outLinesFC, SQLDbase, combine_corridors):
 
         conn = BBB_SharedFunctions.conn = sqlite3.connect(SQLDbase)
 
-        triproute_dict = BBB_SharedFunctions.MakeTripRouteDict()
-
 
     # ----- Initialize a dictionary of stop geometry -----
 
@@ -97,84 +144,52 @@ def runTool(outLinesFC, SQLDbase, combine_corridors):
         arcpy.AddMessage("Obtaining and processing transit schedule and line information...")
         arcpy.AddMessage("(This will take a few minutes for large datasets.)")
 
-        # Create a line-based schedule table
-        c2 = conn.cursor()
-        c2.execute("DROP TABLE IF EXISTS schedules;")
-        c2.execute("CREATE TABLE schedules (key TEXT, start_time REAL, end_time REAL, trip_id TEXT);")
-
-        # Find pairs of directly-connected stops
+        # Create the segments and the line-based schedule tables
+        BuildLineSchedules(conn)
+
+        # Find the distinct lines to draw. Each line is a segment between two
+        # directly-connected stops, or, if we aren't combining corridors, a
+        # segment traveled by a particular route.
+        if combine_corridors:
+            linesfetch = "SELECT segment_id, from_stop, to_stop FROM segments;"
+        else:
+            linesfetch = '''
+            SELECT DISTINCT schedules.segment_id, segments.from_stop, segments.to_stop, trips.route_id
+            FROM schedules
+            JOIN segments ON schedules.segment_id = segments.segment_id
+            JOIN trips ON schedules.trip_id = trips.trip_id
+            ;'''
+        c.execute(linesfetch)
+        # {pair_id: (segment_id, from_stop, to_stop[, route_id])}
         linefeature_dict = {}
-        stoptimefetch = '''
-        SELECT trip_id, stop_id, arrival_time, departure_time
-        FROM stop_times
-        ORDER BY trip_id, stop_sequence
-        ;'''
-        c.execute(stoptimefetch)
-        current_trip = None
-        previous_stop = None
-        start_time = None
-        end_time = None
-        for st in c:
-            trip_id = st[0]
-            stop_id = st[1]
-            arrival_time = st[2]
-            departure_time = st[3]
-            if trip_id != current_trip:
-                current_trip = trip_id
-                previous_stop = stop_id
-                start_time = departure_time # Start time of segment is the departure time from the stop
-                continue
-            start_stop = previous_stop
-            end_stop = stop_id
-            end_time = arrival_time
-            SourceOIDkey = "%s , %s" % (start_stop, end_stop)
-            if combine_corridors:
-                # All trips between each pair of stops will be combined, regardless of route_id
-                linefeature_dict[SourceOIDkey] = True
-            else:
-                # A separate line will be created for each separate route between the same two stops
-                linefeature_dict[SourceOIDkey + " , " + triproute_dict[trip_id]] = True
-            stmt = """INSERT INTO schedules (key, start_time, end_time, trip_id) VALUES ('%s', %s, %s, '%s');""" % (SourceOIDkey, start_time, end_time, trip_id)
-            c2.execute(stmt)
-            previous_stop = stop_id
-            start_time = departure_time
-        conn.commit()
-        c2.execute("CREATE INDEX schedules_index_tripsstend ON schedules (trip_id, start_time, end_time);")
-        conn.commit()
+        for pair_id, line in enumerate(c, 1):
+            linefeature_dict[pair_id] = tuple(line)
 
 
         # ----- Write pairs to a points feature class (this is intermediate and will NOT go into the final output) -----
 
         # Create a points feature class for the point pairs.
         arcpy.management.CreateFeatureclass(outGDB, outStopPairsFCName, "POINT", "", "", "", BBB_SharedFunctions.WGSCoords)
-        arcpy.management.AddField(outStopPairsFC, "stop_id", "TEXT")
-        arcpy.management.AddField(outStopPairsFC, "pair_id", "TEXT")
+        arcpy.management.AddField(outStopPairsFC, "pair_id", "LONG")
         arcpy.management.AddField(outStopPairsFC, "sequence", "SHORT")
 
         # Add pairs of stops to the feature class in preparation for generating line features
         badStops = []
-        badkeys = []
-        with arcpy.da.InsertCursor(outStopPairsFC, ["SHAPE@", "stop_id", "pair_id", "sequence"]) as cur:
-            # linefeature_dict = {"start_stop , end_stop , route_type": True}
-            for SourceOIDkey in linefeature_dict:
-                stopPair = SourceOIDkey.split(" , ")
-                # {stop_id: [stop_lat, stop_lon]}
+        with arcpy.da.InsertCursor(outStopPairsFC, ["SHAPE@", "pair_id", "sequence"]) as cur:
+            for pair_id in linefeature_dict:
+                stop1, stop2 = linefeature_dict[pair_id][1:3]
                 try:
-                    stop1 = stopPair[0]
                     stop1_geom = stoplatlon_dict[stop1]
                 except KeyError:
                     badStops.append(stop1)
-                    badkeys.append(SourceOIDkey)
                     continue
                 try:
-                    stop2 = stopPair[1]
                     stop2_geom = stoplatlon_dict[stop2]
                 except KeyError:
                     badStops.append(stop2)
-                    badkeys.append(SourceOIDkey)
                     continue
-                cur.insertRow((stop1_geom, stop1, SourceOIDkey, 1))
-                cur.insertRow((stop2_geom, stop2, SourceOIDkey, 2))
+                cur.insertRow((stop1_geom, pair_id, 1))
+                cur.insertRow((stop2_geom, pair_id, 2))
 
         if badStops:
             badStops = list(set(badStops))
@@ -186,17 +201,9 @@ def runTool(outLinesFC, SQLDbase, combine_corridors):
 stops which are not included in your stops.txt file. Schedule information for \
 these stops will be ignored. " + badStops_str)
 
-        # Remove these entries from the linefeatures dictionary so it doesn't cause false records later
-        if badkeys:
-            badkeys = list(set(badkeys))
-            for key in badkeys:
-                del linefeature_dict[key]
-
     # ----- Generate lines between all stops (for the final output) -----
 
         arcpy.management.PointsToLine(outStopPairsFC, outLinesFC, "pair_id", "sequence")
-        if not combine_corridors:
-            arcpy.management.AddField(outLinesFC, "route_id", "TEXT")
 
         # We don't need the points for anything anymore, so delete them.
         arcpy.management.Delete(outStopPairsFC)
@@ -206,14 +213,19 @@ these stops will be ignored. " + badStops_str)
         expression = """"Shape_Length" = 0"""
         with arcpy.da.UpdateCursor(outLinesFC, ["pair_id"], expression) as cur2:
             for row in cur2:
-                del linefeature_dict[row[0]]
                 cur2.deleteRow()
 
+        # Add the segment and stop information to the lines
+        linefields = ["segment_id", "from_stop", "to_stop"]
+        arcpy.management.AddField(outLinesFC, "segment_id", "LONG")
+        arcpy.management.AddField(outLinesFC, "from_stop", "TEXT")
+        arcpy.management.AddField(outLinesFC, "to_stop", "TEXT")
         if not combine_corridors:
-            with arcpy.da.UpdateCursor(outLinesFC, ["pair_id", "route_id"]) as cur4:
-                for row in cur4:
-                    row[1] = row[0].split(" , ")[2]
-                    cur4.updateRow(row)
+            linefields.append("route_id")
+            arcpy.management.AddField(outLinesFC, "route_id", "TEXT")
+        with arcpy.da.UpdateCursor(outLinesFC, ["pair_id"] + linefields) as cur4:
+            for row in cur4:
+                cur4.updateRow([row[0]] + list(linefeature_dict[row[0]]))
 
 
     # ----- Finish up. -----
@@ -28,6 +28,7 @@ of Step 1 and counts the frequency of service during specific time windows.
 
 import arcpy
 import BBB_SharedFunctions
+import numpy as np
 
 
 def runTool(step1LinesFC, SQLDbase, linesFC, day, start_time, end_time):
@@ -46,6 +47,13 @@ def runTool(step1LinesFC, SQLDbase, linesFC, day, start_time, end_time):
         # GTFS SQL dbase - must be created ahead of time.
         BBB_SharedFunctions.ConnectToSQLDatabase(SQLDbase)
 
+        # Step 1 outputs from older versions of the tool don't have line segments
+        if "segment_id" not in [f.name for f in arcpy.ListFields(step1LinesFC)] or \
+                not BBB_SharedFunctions.HasLineSegmentSchedules():
+            arcpy.AddError("The Step 1 lines and SQL database were created with an older version of \
+Count Trips on Lines. Please run Step 1 again to prepare them for this tool.")
+            raise BBB_SharedFunctions.CustomError
+
         Specific, day = BBB_SharedFunctions.CheckSpecificDate(day)
         start_sec, end_sec = BBB_SharedFunctions.ConvertTimeWindowToSeconds(start_time, end_time)
 
@@ -53,10 +61,15 @@ def runTool(step1LinesFC, SQLDbase, linesFC, day, start_time, end_time):
         DepOrArr = "departure_time"
 
 
+        # Write a columnar table instead of a feature class?
+        OutTableType = BBB_SharedFunctions.GetOutputTableType(linesFC)
+
+
         # ----- Prepare output file -----
 
         try:
-            arcpy.management.Copy(step1LinesFC, linesFC)
+            if not OutTableType:
+                arcpy.management.Copy(step1LinesFC, linesFC)
         except:
             arcpy.AddError("Error copying template lines feature class to output %s," % linesFC)
             raise
@@ -66,8 +79,9 @@ def runTool(step1LinesFC, SQLDbase, linesFC, day, start_time, end_time):
         try:
             arcpy.AddMessage("Calculating the number of transit trips available during the time window...")
 
-            # Get a dictionary of {line_key: [[trip_id, start_time, end_time]]} for our time window
-            linetimedict = BBB_SharedFunctions.CountTripsOnLines(day, start_sec, end_sec, DepOrArr, Specific)
+            # Get arrays of (segment_id, route_id, trip_id, start_time) for every trip
+            # traversing a line segment in our time window
+            linetimearrays = BBB_SharedFunctions.MakeLineTimeArrays(day, start_sec, end_sec, DepOrArr, Specific)
 
         except:
             arcpy.AddError("Error counting arrivals or departures at during time window.")
@@ -78,30 +92,29 @@ def runTool(step1LinesFC, SQLDbase, linesFC, day, start_time, end_time):
         try:
             arcpy.AddMessage("Writing output data...")
 
-            combine_corridors = "route_id" not in [f.name for f in arcpy.ListFields(linesFC)]
+            combine_corridors = "route_id" not in [f.name for f in arcpy.ListFields(step1LinesFC)]
 
-            triproute_dict = None
+            # Read the segment (and route) of each line in the template
+            linefields = ["pair_id", "segment_id"]
             if not combine_corridors:
-                triproute_dict = BBB_SharedFunctions.MakeTripRouteDict()
-
-            arcpy.management.AddField(linesFC, "NumTrips", "SHORT")
-            arcpy.management.AddField(linesFC, "NumTripsPerHr", "DOUBLE")
-            arcpy.management.AddField(linesFC, "MaxWaitTime", "SHORT")
-            arcpy.management.AddField(linesFC, "AvgHeadway", "SHORT")
-
-            with arcpy.da.UpdateCursor(linesFC, ["pair_id", "NumTrips",
-                                                "NumTripsPerHr",
-                                                "MaxWaitTime", "AvgHeadway"]) as ucursor:
-                for row in ucursor:
-                    NumTrips, NumTripsPerHr, MaxWaitTime, AvgHeadway = \
-                                BBB_SharedFunctions.RetrieveStatsForLines(
-                                    str(row[0]), linetimedict,
-                                    start_sec, end_sec, combine_corridors, triproute_dict)
-                    row[1] = NumTrips
-                    row[2] = NumTripsPerHr
-                    row[3] = MaxWaitTime
-                    row[4] = AvgHeadway
-                    ucursor.updateRow(row)
+                linefields.append("route_id")
+            lines = arcpy.da.TableToNumPyArray(step1LinesFC, linefields)
+            pair_ids = lines["pair_id"].astype("int32")
+            line_routes = None if combine_corridors else lines["route_id"]
+
+            # Calculate the statistics for all lines at once
+            NumTrips, NumTripsPerHr, MaxWaitTime, AvgHeadway = \
+                        BBB_SharedFunctions.RetrieveStatsForLineFeatures(
+                            lines["segment_id"], line_routes, linetimearrays, start_sec, end_sec)
+            fields = [("NumTrips", NumTrips.astype("int32")),
+                      ("NumTripsPerHr", NumTripsPerHr),
+                      ("MaxWaitTime", MaxWaitTime),
+                      ("AvgHeadway", AvgHeadway)]
+
+            if OutTableType:
+                BBB_SharedFunctions.WriteStatsToTable(linesFC, "pair_id", pair_ids, fields)
+            else:
+                BBB_SharedFunctions.WriteStatsToFeatureClass(linesFC, "pair_id", pair_ids, fields)
 
         except:
             arcpy.AddError("Error writing to output.")
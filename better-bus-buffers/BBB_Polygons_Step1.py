@@ -19,7 +19,8 @@ BetterBusBuffers uses GTFS public transit data and ArcGIS Network Analyst.
 Step 1 does the following:
 - Creates service areas around your transit stops
 - Runs some post-processing on those service areas to prepare them for further
-  analysis
+  analysis.  The service areas are either flattened into non-overlapping
+  polygons or covered with a regular grid of square or hexagon cells.
 You should only have to run Step 1 once for the geography and buffer size you
 are analyzing.  Step 1 will take a while to run for larger transit systems.
 '''
@@ -42,7 +43,8 @@ import arcpy
 import BBB_SharedFunctions
 
 
-def runTool(outDir, outGDB, inSQLDbase, inNetworkDataset, imp, BufferSize, restrictions, TrimSettings):
+def runTool(outDir, outGDB, inSQLDbase, inNetworkDataset, imp, BufferSize, restrictions, TrimSettings, PolygonType=None, CellSize=None,
+            StopClusterTolerance=None, ClusterByParentStation=False):
     try:
 
     # ----- Set up the run -----
@@ -75,6 +77,14 @@ def runTool(outDir, outGDB, inSQLDbase, inNetworkDataset, imp, BufferSize, restr
             impedanceAttribute = BBB_SharedFunctions.CleanUpImpedance(imp)
             TrimPolys, TrimPolysValue = BBB_SharedFunctions.CleanUpTrimSettings(TrimSettings)
 
+            # Flattened service area polygons, or a regular grid of square or hexagon cells
+            GridShape = BBB_SharedFunctions.CleanUpPolygonType(PolygonType)
+            if GridShape:
+                if not CellSize or CellSize <= 0:
+                    arcpy.AddError("Please specify a grid cell size greater than 0 meters.")
+                    raise BBB_SharedFunctions.CustomError
+                CellSize = float(CellSize)
+
         except:
             arcpy.AddError("Error setting up run.")
             raise
@@ -85,6 +95,20 @@ def runTool(outDir, outGDB, inSQLDbase, inNetworkDataset, imp, BufferSize, restr
             # Create a feature class of transit stops
             arcpy.AddMessage("Creating a feature class of GTFS stops...")
             StopsLayer, StopIDList = BBB_SharedFunctions.MakeStopsFeatureClass(os.path.join(outGDBwPath, "Step1_Stops"))
+
+            # Stops very close together (platforms of the same station, stops on
+            # opposite sides of the street) produce nearly identical service areas,
+            # so only solve for one representative stop per cluster.
+            clusters = None
+            if (StopClusterTolerance and StopClusterTolerance > 0) or ClusterByParentStation:
+                arcpy.AddMessage("Clustering nearby stops...")
+                clusters = BBB_SharedFunctions.MakeStopClusters(StopClusterTolerance, ClusterByParentStation)
+                arcpy.AddMessage("%i stops were grouped into %i clusters. Service areas will be \
+calculated for %i locations instead of %i." % (len(StopIDList), len(clusters), len(clusters), len(StopIDList)))
+                SAStopsLayer = BBB_SharedFunctions.MakeStopsFeatureClass(
+                                    os.path.join("in_memory", "ClusterStops"), list(clusters))[0]
+            else:
+                SAStopsLayer = StopsLayer
         except:
             arcpy.AddError("Error creating a feature class of GTFS stops.")
             raise
@@ -94,135 +118,221 @@ def runTool(outDir, outGDB, inSQLDbase, inNetworkDataset, imp, BufferSize, restr
         try:
             arcpy.AddMessage("Creating service areas around stops...")
             arcpy.AddMessage("(This step will take a while for large networks.)")
-            polygons = BBB_SharedFunctions.MakeServiceAreasAroundStops(StopsLayer,
+            polygons = BBB_SharedFunctions.MakeServiceAreasAroundStops(SAStopsLayer,
                                 inNetworkDataset, impedanceAttribute, BufferSize,
                                 restrictions, TrimPolys, TrimPolysValue)
+            if clusters:
+                arcpy.management.Delete(SAStopsLayer)
         except:
             arcpy.AddError("Error creating service areas around stops.")
             raise
 
 
     #----- Post-process the polygons to prepare for Step 2 -----
-        try:
-
-            arcpy.AddMessage("Reformatting polygons for further analysis...")
-            arcpy.AddMessage("(This step will take a while for large networks.)")
-
-            # ----- Flatten the overlapping service area polygons -----
-
-            # Use World Cylindrical Equal Area (WKID 54034) to ensure proper use of cluster tolerance in meters
-            arcpy.env.outputCoordinateSystem = BBB_SharedFunctions.WorldCylindrical
-
-            # Flatten the overlapping polygons.  This will ultimately be our output.
-            # Dummy points to use in FeatureToPolygon to get rid of unnecessary fields.
-            dummypoints = arcpy.management.CreateFeatureclass("in_memory",
-                                                                "DummyPoints", "POINT")
-
-            # The flattened polygons will be our ultimate output in the end (final
-            # output of step 2).
-            FlatPolys = os.path.join(outGDBwPath, "Step1_FlatPolys")
-            # FeatureToPolygon flattens overalpping polys.
-            # Set a large cluster tolerance to eliminate small sliver polygons and to
-            # keep the output file size down.  Boundaries may move up to the distance
-            # specified in the cluster tolerance, but some amount of movement is
-            # acceptable, as service area polygons are inexact anyway.
-            # The large cluster tolerance may cause some geometry issues with the output
-            # later, but this is the best solution I've found so far that doesn't eat
-            # up too much analysis time and memory
-            clusTol = "5 meters"
-            arcpy.management.FeatureToPolygon(polygons, FlatPolys, clusTol, "", dummypoints)
-            arcpy.management.Delete(dummypoints)
-
-            # Add a field to the output file for number of trips and num trips / hour.
-            # Also create a polygon id field so we can keep track of them.
-            arcpy.management.AddField(FlatPolys, "PolyID", "LONG")
-            arcpy.management.AddField(FlatPolys, "NumTrips", "LONG")
-            arcpy.management.AddField(FlatPolys, "NumTripsPerHr", "DOUBLE")
-            arcpy.management.AddField(FlatPolys, "NumStopsInRange", "LONG")
-            arcpy.management.AddField(FlatPolys, "MaxWaitTime", "DOUBLE")
-
-
-            # ----- Create stacked points, one for each original SA polygon -----
-
-            # Create points for use in the Identity tool (one point per poly)
-            FlattenedPoints = os.path.join(outGDBwPath, "Step1_FlattenedPoints")
-            arcpy.management.FeatureToPoint(FlatPolys, FlattenedPoints, "INSIDE")
-
-            # Use Identity to stack points and keep the stop_ids from the original SAs.
-            # Results in a points layer with fields ORIG_FID for the IDs of the
-            # flattened polygons and a stop_id column with the stop ids.
-            # Points are stacked, and each has only one stop_id.
-            StackedPoints = os.path.join(outGDBwPath, "Step1_StackedPoints")
-            arcpy.analysis.Identity(FlattenedPoints, polygons, StackedPoints)
-            arcpy.management.Delete(FlattenedPoints)
-
-
-            # ----- Read the Stacked Points into an SQL table -----
-
-            # Create a SQL table associating the Polygon FID with the stop_ids that serve it.
-            c.execute("DROP TABLE IF EXISTS StackedPoints;")
-            schema = "Polygon_FID LONG, stop_id TEXT"
-            create_stmt = "CREATE TABLE StackedPoints (%s);" % schema
-            c.execute(create_stmt)
-
-            # Add data to the table. Track Polygon IDs with no associated stop_ids so we can delete them.
-            FIDsToDelete = []
-            AddToStackedPts = []
-            with arcpy.da.SearchCursor(StackedPoints, ["ORIG_FID", "stop_id"]) as StackedPtCursor:
-                for row in StackedPtCursor:
-                    if not row[1]:
-                        FIDsToDelete.append(row[0])
-                    else:
-                        AddToStackedPts.append((row[0], row[1],))
-            # Add the OD items to the SQL table
-            c.executemany('''INSERT INTO StackedPoints \
-                            (Polygon_FID, stop_id) \
-                            VALUES (?, ?);''', AddToStackedPts)
-            conn.commit()
-            arcpy.management.Delete(StackedPoints)
-            FIDsToDelete = set(FIDsToDelete)
-
-
-            # ----- Delete polygons not associated with any stop_ids -----
-            # These were generated by the FeatureToPolygon tool in areas completely
-            # surrounded by other polygons and aren't associated with any stops.
-
-            # Make feature layer containing only the polygons we want to delete.
-            desc2 = arcpy.Describe(FlatPolys)
-            OutputOIDName = desc2.OIDFieldName
-            # Anything with 0 area will just cause problems later.
-            WhereClause = '"Shape_Area" = 0'
-            if FIDsToDelete:
-                WhereClause += ' OR "' + OutputOIDName + '" IN ('
-                for FID in FIDsToDelete:
-                    WhereClause += str(FID) + ", "
-                WhereClause = WhereClause[:-2] + ")"
-            arcpy.management.MakeFeatureLayer(FlatPolys, "FlatPolysLayer", WhereClause)
-
-            # Delete the polygons that don't correspond to any stop_ids.
-            arcpy.management.DeleteFeatures("FlatPolysLayer")
-
-
-            # ----- Populate the PolyID field -----
-
-            # Set PolyID equal to the OID.
-            expression = "!" + OutputOIDName + "!"
-            arcpy.management.CalculateField(FlatPolys, "PolyID", expression, "PYTHON")
-
-
-        except:
-            arcpy.AddError("Error post-processing polygons")
-            raise
+        if GridShape:
+            try:
+
+                arcpy.AddMessage("Creating grid cells covering the service areas...")
+
+                # Use World Cylindrical Equal Area (WKID 54034) so the cell size is in meters
+                arcpy.env.outputCoordinateSystem = BBB_SharedFunctions.WorldCylindrical
+                ProjectedPolys = os.path.join("in_memory", "ProjectedServiceAreas")
+                arcpy.management.CopyFeatures(polygons, ProjectedPolys)
+                extent = arcpy.Describe(ProjectedPolys).extent
+
+                # ----- Cover the service areas with a regular grid -----
+                Tessellation = os.path.join("in_memory", "GridTessellation")
+                if hasattr(arcpy.management, "GenerateTessellation"):
+                    # Size is the area of each cell, so hexagons have the same area as the square cells
+                    arcpy.management.GenerateTessellation(Tessellation, extent, GridShape,
+                                        "%s SquareMeters" % str(CellSize * CellSize),
+                                        BBB_SharedFunctions.WorldCylindrical)
+                elif GridShape == "SQUARE":
+                    arcpy.management.CreateFishnet(Tessellation,
+                                        "%s %s" % (extent.XMin, extent.YMin),
+                                        "%s %s" % (extent.XMin, extent.YMin + 10),
+                                        CellSize, CellSize, 0, 0,
+                                        "%s %s" % (extent.XMax, extent.YMax),
+                                        "NO_LABELS", "#", "POLYGON")
+                else:
+                    arcpy.AddError("Hexagon grid cells require ArcGIS Pro 2.1 or ArcMap 10.6 or higher. \
+Please use square grid cells instead.")
+                    raise BBB_SharedFunctions.CustomError
+
+                # Keep only the cells whose center falls inside a service area.
+                # These cells will ultimately be our output (final output of step 2).
+                GridCells = os.path.join(outGDBwPath, "Step1_GridCells")
+                arcpy.management.MakeFeatureLayer(Tessellation, "GridTessellationLayer")
+                arcpy.management.SelectLayerByLocation("GridTessellationLayer", "HAVE_THEIR_CENTER_IN", ProjectedPolys)
+                arcpy.management.CopyFeatures("GridTessellationLayer", GridCells)
+                arcpy.management.Delete("GridTessellationLayer")
+                arcpy.management.Delete(Tessellation)
+
+                # Create a cell id field so we can keep track of them.
+                arcpy.management.AddField(GridCells, "CellID", "LONG")
+                expression = "!" + arcpy.Describe(GridCells).OIDFieldName + "!"
+                arcpy.management.CalculateField(GridCells, "CellID", expression, "PYTHON")
+
+
+                # ----- Find the stops serving each cell -----
+
+                # One point per cell at its center.  ORIG_FID holds the CellID.
+                CellPoints = os.path.join("in_memory", "GridCellPoints")
+                arcpy.management.FeatureToPoint(GridCells, CellPoints, "CENTROID")
+
+                # Join each cell center to every service area containing it.
+                CellStops = os.path.join("in_memory", "GridCellStops")
+                arcpy.analysis.SpatialJoin(CellPoints, ProjectedPolys, CellStops,
+                                        "JOIN_ONE_TO_MANY", "KEEP_COMMON", "", "INTERSECT")
+                with arcpy.da.SearchCursor(CellStops, ["ORIG_FID", "stop_id"]) as CellStopsCursor:
+                    CellStopPairs = ((row[0], row[1]) for row in CellStopsCursor if row[1])
+                    if clusters:
+                        # Fan the cluster representatives back out to all their member stops
+                        CellStopPairs = BBB_SharedFunctions.ExpandStopClusters(CellStopPairs, clusters)
+                    cell_ids, offsets, indices, stop_ids = BBB_SharedFunctions.MakeStopSetArrays(CellStopPairs)
+                for temp_fc in [CellPoints, CellStops, ProjectedPolys]:
+                    arcpy.management.Delete(temp_fc)
+
+
+                # ----- Save the cell->stop relation as integer arrays -----
+                BBB_SharedFunctions.SaveStopSetArrays(outGDBwPath, "Step1_GridCells",
+                                        cell_ids, offsets, indices, stop_ids)
+
+            except:
+                arcpy.AddError("Error creating grid cells")
+                raise
+
+        else:
+            try:
+
+                arcpy.AddMessage("Reformatting polygons for further analysis...")
+                arcpy.AddMessage("(This step will take a while for large networks.)")
+
+                # ----- Flatten the overlapping service area polygons -----
+
+                # Use World Cylindrical Equal Area (WKID 54034) to ensure proper use of cluster tolerance in meters
+                arcpy.env.outputCoordinateSystem = BBB_SharedFunctions.WorldCylindrical
+
+                # Flatten the overlapping polygons.  This will ultimately be our output.
+                # Dummy points to use in FeatureToPolygon to get rid of unnecessary fields.
+                dummypoints = arcpy.management.CreateFeatureclass("in_memory",
+                                                                    "DummyPoints", "POINT")
+
+                # The flattened polygons will be our ultimate output in the end (final
+                # output of step 2).
+                FlatPolys = os.path.join(outGDBwPath, "Step1_FlatPolys")
+                # FeatureToPolygon flattens overalpping polys.
+                # Set a large cluster tolerance to eliminate small sliver polygons and to
+                # keep the output file size down.  Boundaries may move up to the distance
+                # specified in the cluster tolerance, but some amount of movement is
+                # acceptable, as service area polygons are inexact anyway.
+                # The large cluster tolerance may cause some geometry issues with the output
+                # later, but this is the best solution I've found so far that doesn't eat
+                # up too much analysis time and memory
+                clusTol = "5 meters"
+                arcpy.management.FeatureToPolygon(polygons, FlatPolys, clusTol, "", dummypoints)
+                arcpy.management.Delete(dummypoints)
+
+                # Create a polygon id field so we can keep track of them.
+                # Step 2 adds the statistics fields.
+                arcpy.management.AddField(FlatPolys, "PolyID", "LONG")
+
+
+                # ----- Create stacked points, one for each original SA polygon -----
+
+                # Create points for use in the Identity tool (one point per poly)
+                FlattenedPoints = os.path.join(outGDBwPath, "Step1_FlattenedPoints")
+                arcpy.management.FeatureToPoint(FlatPolys, FlattenedPoints, "INSIDE")
+
+                # Use Identity to stack points and keep the stop_ids from the original SAs.
+                # Results in a points layer with fields ORIG_FID for the IDs of the
+                # flattened polygons and a stop_id column with the stop ids.
+                # Points are stacked, and each has only one stop_id.
+                StackedPoints = os.path.join(outGDBwPath, "Step1_StackedPoints")
+                arcpy.analysis.Identity(FlattenedPoints, polygons, StackedPoints)
+                arcpy.management.Delete(FlattenedPoints)
+
+
+                # ----- Read the Stacked Points into an SQL table -----
+
+                # Create a SQL table associating the Polygon FID with the stop_ids that serve it.
+                c.execute("DROP TABLE IF EXISTS StackedPoints;")
+                schema = "Polygon_FID LONG, stop_id TEXT"
+                create_stmt = "CREATE TABLE StackedPoints (%s);" % schema
+                c.execute(create_stmt)
+
+                # Add data to the table. Track Polygon IDs with no associated stop_ids so we can delete them.
+                FIDsToDelete = []
+                AddToStackedPts = []
+                with arcpy.da.SearchCursor(StackedPoints, ["ORIG_FID", "stop_id"]) as StackedPtCursor:
+                    for row in StackedPtCursor:
+                        if not row[1]:
+                            FIDsToDelete.append(row[0])
+                        else:
+                            AddToStackedPts.append((row[0], row[1],))
+                if clusters:
+                    # Fan the cluster representatives back out to all their member stops
+                    AddToStackedPts = list(BBB_SharedFunctions.ExpandStopClusters(AddToStackedPts, clusters))
+                # Add the OD items to the SQL table
+                c.executemany('''INSERT INTO StackedPoints \
+                                (Polygon_FID, stop_id) \
+                                VALUES (?, ?);''', AddToStackedPts)
+                conn.commit()
+                arcpy.management.Delete(StackedPoints)
+                FIDsToDelete = set(FIDsToDelete)
+
+                # Also save the polygon->stop relation as integer arrays so Step 2
+                # can load it directly.
+                poly_ids, offsets, indices, stop_ids = BBB_SharedFunctions.MakeStopSetArrays(AddToStackedPts)
+                BBB_SharedFunctions.SaveStopSetArrays(outGDBwPath, "Step1_FlatPolys",
+                                        poly_ids, offsets, indices, stop_ids)
+
+
+                # ----- Delete polygons not associated with any stop_ids -----
+                # These were generated by the FeatureToPolygon tool in areas completely
+                # surrounded by other polygons and aren't associated with any stops.
+
+                # Make feature layer containing only the polygons we want to delete.
+                desc2 = arcpy.Describe(FlatPolys)
+                OutputOIDName = desc2.OIDFieldName
+                # Anything with 0 area will just cause problems later.
+                WhereClause = '"Shape_Area" = 0'
+                if FIDsToDelete:
+                    WhereClause += ' OR "' + OutputOIDName + '" IN ('
+                    for FID in FIDsToDelete:
+                        WhereClause += str(FID) + ", "
+                    WhereClause = WhereClause[:-2] + ")"
+                arcpy.management.MakeFeatureLayer(FlatPolys, "FlatPolysLayer", WhereClause)
+
+                # Delete the polygons that don't correspond to any stop_ids.
+                arcpy.management.DeleteFeatures("FlatPolysLayer")
+
+
+                # ----- Populate the PolyID field -----
+
+                # Set PolyID equal to the OID.
+                expression = "!" + OutputOIDName + "!"
+                arcpy.management.CalculateField(FlatPolys, "PolyID", expression, "PYTHON")
+
+
+            except:
+                arcpy.AddError("Error post-processing polygons")
+                raise
+
+        if GridShape:
+            OutPolysName = "Step1_GridCells"
+        else:
+            OutPolysName = "Step1_FlatPolys"
 
         arcpy.AddMessage("Done!")
         arcpy.AddMessage("Files written to output geodatabase " + outGDBwPath + ":")
         arcpy.AddMessage("- Step1_Stops")
-        arcpy.AddMessage("- Step1_FlatPolys")
+        arcpy.AddMessage("- " + OutPolysName)
         arcpy.AddMessage("- Step1_GTFS.sql")
 
         # Tell the tool that this is output. This will add the output to the map.
         arcpy.SetParameterAsText(8, os.path.join(outGDBwPath, "Step1_Stops"))
-        arcpy.SetParameterAsText(9, os.path.join(outGDBwPath, "Step1_FlatPolys"))
+        arcpy.SetParameterAsText(9, os.path.join(outGDBwPath, OutPolysName))
         arcpy.SetParameterAsText(10, os.path.join(outGDBwPath, "Step1_GTFS.sql"))
 
 
@@ -32,8 +32,9 @@ Step 2: Count Trips in Buffers uses the template feature class created in Step
 ################################################################################
 
 import os, sqlite3
+import numpy as np
 import arcpy
-import BBB_SharedFunctions
+import BBB_SharedFunctions, BBB_Scenarios
 
 class CustomError(Exception):
     pass
@@ -41,7 +42,25 @@ class CustomError(Exception):
 OverwriteOutput = None
 
 
-def runTool(inStep1GDB, outFile, day, start_time, end_time, DepOrArrChoice):
+def OutputHasStep1Polygons(outFile, Polys, IDField):
+    '''Return True if outFile is an existing feature class with the same polygons
+    as the Step 1 polygons Polys, so its geometry can be reused instead of being
+    copied again. Only the ids and the extents are compared, so this is cheap.'''
+    if not arcpy.Exists(outFile) or IDField not in [f.name for f in arcpy.ListFields(outFile)]:
+        return False
+    out_extent = arcpy.Describe(outFile).extent
+    polys_extent = arcpy.Describe(Polys).extent
+    if [out_extent.XMin, out_extent.YMin, out_extent.XMax, out_extent.YMax] != \
+       [polys_extent.XMin, polys_extent.YMin, polys_extent.XMax, polys_extent.YMax]:
+        return False
+    with arcpy.da.SearchCursor(outFile, [IDField]) as cur:
+        out_ids = sorted(row[0] for row in cur)
+    with arcpy.da.SearchCursor(Polys, [IDField]) as cur:
+        poly_ids = sorted(row[0] for row in cur)
+    return out_ids == poly_ids
+
+
+def runTool(inStep1GDB, outFile, day, start_time, end_time, DepOrArrChoice, UpdatedSQLDbase=None, ScenarioFile=None):
     try:
 
         # ----- Set up the run -----
@@ -49,13 +68,29 @@ def runTool(inStep1GDB, outFile, day, start_time, end_time, DepOrArrChoice):
             BBB_SharedFunctions.CheckArcVersion(min_version_pro="1.2")
             
             # Get the files from Step 1 to work with.
-            # Step1_GTFS.sql and Step1_FlatPolys must exist in order for the tool to run.
+            # Step1_GTFS.sql and Step1_FlatPolys or Step1_GridCells must exist in order for the tool to run.
             # Their existence is checked in the GUI validation logic.
-            FlatPolys = os.path.join(inStep1GDB, "Step1_FlatPolys")
             SQLDbase = os.path.join(inStep1GDB, "Step1_GTFS.sql")
+            # Step 1 was run in grid mode if it saved the cell->stop arrays
+            if BBB_SharedFunctions.StopSetArraysExist(inStep1GDB, "Step1_GridCells"):
+                UseGrid = True
+                PolysName = "Step1_GridCells"
+                IDField = "CellID"
+            else:
+                UseGrid = False
+                PolysName = "Step1_FlatPolys"
+                IDField = "PolyID"
+            Polys = os.path.join(inStep1GDB, PolysName)
             # Connect to the SQL database
             conn = BBB_SharedFunctions.conn = sqlite3.connect(SQLDbase)
             c = BBB_SharedFunctions.c = conn.cursor()
+            # Keep a connection to the Step 1 SQL database for the Step 1 stops.
+            Step1Conn = conn
+            if UpdatedSQLDbase:
+                # Count trips using a newer version of the GTFS data.  The Step 1
+                # polygons and their stops are reused as is.
+                conn = BBB_SharedFunctions.conn = sqlite3.connect(UpdatedSQLDbase)
+                c = BBB_SharedFunctions.c = conn.cursor()
 
             # Output file designated by user
             outDir = os.path.dirname(outFile)
@@ -67,6 +102,16 @@ def runTool(inStep1GDB, outFile, day, start_time, end_time, DepOrArrChoice):
             # Will we calculate the max wait time? This slows down the calculation, so leave it optional.
             CalcWaitTime = True
 
+            # What-if service changes to apply to the GTFS data
+            Scenario = None
+            if ScenarioFile:
+                Scenario = BBB_SharedFunctions.LoadScenario(ScenarioFile)
+
+            # The stop event signatures of this output are recorded next to it,
+            # along with the time window they were calculated for.
+            SigFile = BBB_SharedFunctions.GetStopEventSignaturesFile(outFile)
+            TimeWindowKey = "|".join([str(day), str(start_sec), str(end_sec), DepOrArrChoice])
+
             # It's okay to overwrite stuff.
             OverwriteOutput = arcpy.env.overwriteOutput # Get the orignal value so we can reset it.
             arcpy.env.overwriteOutput = True
@@ -81,7 +126,41 @@ def runTool(inStep1GDB, outFile, day, start_time, end_time, DepOrArrChoice):
             arcpy.AddMessage("Counting transit trips during the time window...")
 
             # Get a dictionary of stop times in our time window {stop_id: [[trip_id, stop_time]]}
-            stoptimedict = BBB_SharedFunctions.CountTripsAtStops(day, start_sec, end_sec, BBB_SharedFunctions.CleanUpDepOrArr(DepOrArrChoice), Specific)
+            # A scenario can move trips from outside the time window into it, so fetch those too.
+            fetch_start, fetch_end = BBB_Scenarios.GetScenarioTimeWindow(Scenario, start_sec, end_sec)
+            stoptimedict = BBB_SharedFunctions.CountTripsAtStops(day, fetch_start, fetch_end, BBB_SharedFunctions.CleanUpDepOrArr(DepOrArrChoice), Specific)
+
+            if Scenario:
+                # Apply the what-if service changes to the stop events
+                arcpy.AddMessage("Applying the service scenario...")
+                stoptimedict = BBB_SharedFunctions.ApplyScenario(stoptimedict, Scenario, start_sec, end_sec)
+
+            # Record a signature of the events at each stop so that this output can
+            # be updated incrementally when the GTFS data changes.
+            signatures = BBB_SharedFunctions.MakeStopEventSignatures(stoptimedict, BBB_SharedFunctions.MakeTripRouteDict())
+
+            # Only recalculate the polygons served by changed stops if this output
+            # was already calculated for the same time window with older GTFS data.
+            Incremental = False
+            if UpdatedSQLDbase:
+                old_signatures = None
+                if not BBB_SharedFunctions.GetOutputTableType(outFile) and arcpy.Exists(outFile) and \
+                   os.path.exists(SigFile):
+                    SigConn = sqlite3.connect(SigFile)
+                    old_signatures = BBB_SharedFunctions.LoadStopEventSignatures(SigConn, TimeWindowKey)
+                    SigConn.close()
+                if old_signatures:
+                    Incremental = True
+                    changed_stops = BBB_SharedFunctions.FindChangedStops(old_signatures, signatures)
+                else:
+                    arcpy.AddMessage("No earlier results were found for this output and time window, \
+so all polygons will be calculated.")
+                Step1Stops = set(row[0] for row in Step1Conn.cursor().execute("SELECT stop_id FROM stops;"))
+                NewStops = [stop_id for stop_id in signatures if stop_id not in Step1Stops]
+                if NewStops:
+                    arcpy.AddWarning("Warning! %i stops with trips in the updated GTFS data are not in the \
+Step 1 stops, so their trips will not be counted. Re-run Step 1 with the updated GTFS data to include \
+them." % len(NewStops))
 
         except:
             arcpy.AddError("Failed to count transit trips during the time window.")
@@ -91,67 +170,93 @@ def runTool(inStep1GDB, outFile, day, start_time, end_time, DepOrArrChoice):
         #----- Find which stops serve each polygon -----
         try:
             arcpy.AddMessage("Retrieving list of stops associated with each polygon...")
-            # Find the stop_ids associated with each flattened polygon and put them in
-            # a dictionary. {ORIG_FID: [stop_id, stop_id,...]}
-            stackedpointdict = {}
-            GetStackedPtsStmt = "SELECT * FROM StackedPoints"
-            c.execute(GetStackedPtsStmt)
-            for PolyFID in c:
-                stackedpointdict.setdefault(PolyFID[0], []).append(str(PolyFID[1]))
+            # The polygon->stops relation is stored as CSR arrays: the stops serving
+            # poly_ids[i] are stop_ids[indices[offsets[i]:offsets[i+1]]].
+            if BBB_SharedFunctions.StopSetArraysExist(inStep1GDB, PolysName):
+                poly_ids, offsets, indices, stop_ids = BBB_SharedFunctions.LoadStopSetArrays(inStep1GDB, PolysName)
+            else:
+                # Step 1 output from an earlier version of the tool. Build the
+                # relation from the StackedPoints table instead.
+                GetStackedPtsStmt = "SELECT Polygon_FID, stop_id FROM StackedPoints"
+                Step1Cursor = Step1Conn.cursor()
+                Step1Cursor.execute(GetStackedPtsStmt)
+                poly_ids, offsets, indices, stop_ids = BBB_SharedFunctions.MakeStopSetArrays(Step1Cursor)
         except:
             arcpy.AddError("Error retrieving list of stops associated with each polygon.")
             raise
 
 
+        #----- Calculate statistics for all polygons at once -----
+        try:
+            arcpy.AddMessage("Calculating statistics for each polygon...")
+            if Incremental:
+                # Keep only the polygons served by stops whose events changed
+                rows, offsets, indices = BBB_SharedFunctions.SubsetStopSetArrays(
+                                                offsets, indices, stop_ids, changed_stops)
+                arcpy.AddMessage("%i stops have changed since this output was last calculated. \
+Updating %i of %i polygons (%.1f%%)." % (len(changed_stops), len(rows), len(poly_ids),
+                                        100.0 * len(rows) / max(len(poly_ids), 1)))
+                poly_ids = np.asarray(poly_ids)[rows]
+            NumTrips, NumTripsPerHr, NumStopsInRange, MaxWaitTime = \
+                            BBB_SharedFunctions.RetrieveStatsForStopSets(
+                                offsets, indices, stop_ids, stoptimedict, CalcWaitTime,
+                                start_sec, end_sec)
+        except:
+            arcpy.AddError("Error calculating statistics for polygons.")
+            raise
+
+
         # ----- Generate output data -----
         try:
             arcpy.AddMessage("Writing output data...")
 
-            # Create the output file from FlatPolys.  We don't want to overwrite the
-            # original Step 1 template file.
-            arcpy.management.CopyFeatures(FlatPolys, outFile)
-            badpolys = []
-
             if ".shp" in outFilename:
-                ucursor = arcpy.da.UpdateCursor(outFile,
-                                                ["PolyID", "NumTrips",
-                                                "NumTripsPe", "NumStopsIn",
-                                                "MaxWaitTim"])
+                fieldnames = ["NumTrips", "NumTripsPe", "NumStopsIn", "MaxWaitTim"]
             else:
-                ucursor = arcpy.da.UpdateCursor(outFile,
-                                            ["PolyID", "NumTrips",
-                                            "NumTripsPerHr", "NumStopsInRange",
-                                            "MaxWaitTime"])
-            for row in ucursor:
-                try:
-                    ImportantStops = stackedpointdict[int(row[0])]
-                except KeyError:
-                    # If we got a KeyError here, then an output polygon never
-                    # got a point associated with it, probably the result of a
-                    # geometry problem because of the large cluster tolerance
-                    # used to generate the polygons in Step 1. Just skip this
-                    # polygon and alert the user.
-                    badpolys.append(row[0])
-                    continue
-                NumTrips, NumTripsPerHr, NumStopsInRange, MaxWaitTime = \
-                                BBB_SharedFunctions.RetrieveStatsForSetOfStops(
-                                    ImportantStops, stoptimedict, CalcWaitTime,
-                                    start_sec, end_sec)
-                row[1] = NumTrips
-                row[2] = NumTripsPerHr
-                row[3] = NumStopsInRange
-                if ".shp" in outFilename and MaxWaitTime == None:
-                    row[4] = -1
+                fieldnames = ["NumTrips", "NumTripsPerHr", "NumStopsInRange", "MaxWaitTime"]
+            fields = list(zip(fieldnames, [NumTrips.astype("int32"), NumTripsPerHr,
+                                           NumStopsInRange.astype("int32"), MaxWaitTime]))
+
+            if Incremental:
+                # Update the changed polygons in the existing output
+                BBB_SharedFunctions.UpdateStatsInFeatureClass(outFile, IDField, poly_ids, fields)
+
+            elif BBB_SharedFunctions.GetOutputTableType(outFile):
+                # Write a columnar table keyed by the polygon id. It can be joined
+                # to the Step 1 polygons if the geometry is needed.
+                BBB_SharedFunctions.WriteStatsToTable(outFile, IDField, poly_ids, fields)
+
+            else:
+                # Create the output file from the Step 1 polygons.  We don't want to
+                # overwrite the original Step 1 template file.  If the output was
+                # already made from these polygons by an earlier run, reuse its
+                # geometry and only replace the statistics.  The statistics are
+                # added in one bulk write instead of updating the rows one by one.
+                if OutputHasStep1Polygons(outFile, Polys, IDField):
+                    arcpy.AddMessage("Reusing the polygons in the existing output...")
                 else:
-                    row[4] = MaxWaitTime
-                ucursor.updateRow(row)
+                    arcpy.management.CopyFeatures(Polys, outFile)
+                BBB_SharedFunctions.WriteStatsToFeatureClass(outFile, IDField, poly_ids, fields)
 
-            if badpolys:
-                arcpy.AddWarning("Warning! BetterBusBuffers could not calculate trip \
+            if not UseGrid and not Incremental and not BBB_SharedFunctions.GetOutputTableType(outFile):
+                # If an output polygon never got a point associated with it, it's
+                # probably the result of a geometry problem because of the large
+                # cluster tolerance used to generate the polygons in Step 1. Alert
+                # the user.
+                with arcpy.da.SearchCursor(outFile, [IDField]) as cur:
+                    out_ids = [row[0] for row in cur]
+                badpolys = np.setdiff1d(np.array(out_ids, dtype=np.int64), poly_ids).tolist()
+                if badpolys:
+                    arcpy.AddWarning("Warning! BetterBusBuffers could not calculate trip \
 statistics for one or more polygons due to a geometry issue. These polygons will \
 appear in your output data, but all output values will be null. Bad polygon \
 PolyID values: " + str(badpolys))
 
+            if not BBB_SharedFunctions.GetOutputTableType(outFile):
+                SigConn = sqlite3.connect(SigFile)
+                BBB_SharedFunctions.SaveStopEventSignatures(SigConn, TimeWindowKey, signatures)
+                SigConn.close()
+
         except:
             arcpy.AddMessage("Error writing output.")
             raise
@@ -0,0 +1,124 @@
+############################################################################
+## Tool name: BetterBusBuffers
+## Service scenarios
+############################################################################
+''' This file applies what-if service scenarios to the stop events counted by
+the BetterBusBuffers tools. It doesn't use arcpy or the GTFS SQL database, so
+the scenario logic can be tested on its own. BBB_SharedFunctions reads the
+scenario file and the trip information the functions here need.'''
+################################################################################
+'''Copyright 2018 Esri
+   Licensed under the Apache License, Version 2.0 (the "License");
+   you may not use this file except in compliance with the License.
+   You may obtain a copy of the License at
+       http://www.apache.org/licenses/LICENSE-2.0
+   Unless required by applicable law or agreed to in writing, software
+   distributed under the License is distributed on an "AS IS" BASIS,
+   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+   See the License for the specific language governing permissions and
+   limitations under the License.'''
+################################################################################
+
+SecsInDay = 86400
+
+# Keys allowed in a scenario file.  See BBB_SharedFunctions.LoadScenario.
+ScenarioKeys = ["remove_routes", "remove_trips", "shift_trips", "headway_multipliers", "add_trips"]
+
+
+def GetScenarioTimeWindow(scenario, start_sec, end_sec):
+    '''Return the (start, end) time window to fetch stop events for, so that
+    ApplyScenario gets every trip the scenario can move into the time window
+    [start_sec, end_sec]. Shifts can bring in trips from up to the largest shift
+    before or after the time window, and a headway multiplier below 1 packs the
+    trips from a longer part of the day into the time window. The time window is
+    widened by at most a day in each direction.'''
+
+    if not scenario:
+        return start_sec, end_sec
+    shifts = [float(shift) for shift in scenario.get("shift_trips", {}).values()]
+    multipliers = [float(multiplier) for multiplier in scenario.get("headway_multipliers", {}).values()]
+    min_multiplier = min([1.0] + multipliers)
+    fetch_start = start_sec - max([0.0] + shifts)
+    fetch_end = start_sec + (end_sec - start_sec) / min_multiplier - min([0.0] + shifts)
+    return max(fetch_start, start_sec - SecsInDay), min(fetch_end, end_sec + SecsInDay)
+
+
+def GetTripInfo(trip_id, trip_dict):
+    '''Look up a trip in a {trip_id: value} dictionary. Trips from
+    frequencies.txt get a suffix added to their trip_id, so fall back to the
+    trip_id without it.'''
+    if trip_id in trip_dict:
+        return trip_dict[trip_id]
+    return trip_dict.get(trip_id.rsplit("_", 1)[0])
+
+
+def ApplyScenario(stoptimedict, scenario, start_sec, end_sec, triproute_dict, tripdirection_dict):
+    '''Apply a scenario loaded with LoadScenario to a dictionary of stop events
+    {stop_id: [[trip_id, stop_time]]} fetched for the time window returned by
+    GetScenarioTimeWindow. Returns a new dictionary of the events in the time
+    window [start_sec, end_sec] and leaves stoptimedict unchanged, so one set of
+    events from the GTFS data can be used for many scenarios.
+
+    Headway multipliers scale the time between each trip of a route and
+    direction and the first trip of that route and direction starting in the
+    time window. Trips from later in the day take the place of the trips that a
+    multiplier below 1 moves earlier, so the whole time window keeps service at
+    the scaled headway. Trips that started before the time window keep their
+    times. triproute_dict is {trip_id: route_id} and tripdirection_dict is
+    {trip_id: direction_id}.'''
+
+    headway_multipliers = scenario.get("headway_multipliers", {})
+    remove_routes = set(scenario.get("remove_routes", []))
+    remove_trips = set(scenario.get("remove_trips", []))
+    shift_trips = scenario.get("shift_trips", {})
+
+    def get_route(trip_id):
+        return GetTripInfo(trip_id, triproute_dict)
+
+    # ----- Regroup the events by trip, applying removals and shifts -----
+    # {trip_id: [[stop_id, stop_time]]}
+    trips = {}
+    for stop_id in stoptimedict:
+        for trip_id, stop_time in stoptimedict[stop_id]:
+            if trip_id in remove_trips or get_route(trip_id) in remove_routes:
+                continue
+            trips.setdefault(trip_id, []).append([stop_id, stop_time + shift_trips.get(trip_id, 0)])
+
+    # ----- Rescale the headways of routes -----
+    # Each direction of a route is rescaled separately.
+    # {(route_id, direction_id): [[first stop time, trip_id]]} for trips starting in the time window
+    rtdir_trips = {}
+    for trip_id in trips:
+        route_id = get_route(trip_id)
+        if route_id in headway_multipliers:
+            start = min(stop_time for stop_id, stop_time in trips[trip_id])
+            if start < start_sec:
+                continue
+            rtdir = (route_id, GetTripInfo(trip_id, tripdirection_dict))
+            rtdir_trips.setdefault(rtdir, []).append([start, trip_id])
+    for rtdir in rtdir_trips:
+        multiplier = float(headway_multipliers[rtdir[0]])
+        first = min(start for start, trip_id in rtdir_trips[rtdir])
+        for start, trip_id in rtdir_trips[rtdir]:
+            # Move the trip so its gap from the first trip is multiplied
+            offset = int(round((start - first) * (multiplier - 1)))
+            trips[trip_id] = [[stop_id, stop_time + offset] for stop_id, stop_time in trips[trip_id]]
+
+    # ----- Add new trips -----
+    for trip in scenario.get("add_trips", []):
+        first = trip["stop_times"][0][1]
+        repeats = [0]
+        if trip.get("headway_secs"):
+            repeats = range(0, int(trip["end_time"] - first) + 1, int(trip["headway_secs"]))
+        for i, offset in enumerate(repeats):
+            trip_id = trip["trip_id"] if len(repeats) == 1 else "%s_%i" % (trip["trip_id"], i)
+            trips[trip_id] = [[stop_id, stop_time + offset] for stop_id, stop_time in trip["stop_times"]]
+
+    # ----- Back to {stop_id: [[trip_id, stop_time]]} -----
+    newstoptimedict = {}
+    for trip_id in trips:
+        for stop_id, stop_time in trips[trip_id]:
+            if start_sec <= stop_time <= end_sec:
+                newstoptimedict.setdefault(stop_id, []).append([trip_id, stop_time])
+
+    return newstoptimedict
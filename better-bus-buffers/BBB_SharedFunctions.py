@@ -18,8 +18,10 @@
    limitations under the License.'''
 ################################################################################
 
-import sqlite3, os, operator, datetime
+import sqlite3, os, sys, operator, datetime, csv, math, hashlib, json, uuid
+import numpy as np
 import arcpy
+import BBB_Scenarios
 
 # sqlite cursor - must be set from the script calling the functions explicitly
 # or using the ConnectToSQLDatabase() function
@@ -50,6 +52,18 @@ UNIT['Meter',1.0]];-20037700 -6364000 10000;-100000 10000;-100000 10000; \
 # Number of seconds in a day.
 SecsInDay = 86400
 
+ispy3 = sys.version_info >= (3, 0)
+
+# Output file extensions that write results to a columnar table instead of a feature class
+OutputTableExtensions = {".csv": "CSV",
+                         ".sqlite": "SQLITE",
+                         ".db": "SQLITE",
+                         ".npy": "NPY",
+                         ".parquet": "PARQUET"}
+
+# Choice in the route list of the individual route tools to analyze all routes at once
+AllRoutesText = "<All routes>"
+
 # Days of the week
 days = ["Monday", "Tuesday", "Wednesday", "Thursday", "Friday", "Saturday", "Sunday"]
 
@@ -243,6 +257,18 @@ def MakeTripRouteDict():
     return triproute_dict
 
 
+def MakeTripDirectionDict():
+    '''Make dictionary of {trip_id: direction_id}'''
+
+    tripdirection_dict = {}
+    ctd = conn.cursor()
+    ctd.execute("SELECT trip_id, direction_id FROM trips;")
+    for trip in ctd:
+        tripdirection_dict[trip[0]] = trip[1]
+
+    return tripdirection_dict
+
+
 def MakeFrequenciesDict():
     '''Put the frequencies.txt information into a dictionary'''
 
@@ -348,8 +374,106 @@ def GetStopTimesForStopsInTimeWindow(start, end, DepOrArr, triplist, day, freque
     return stoptimedict
 
 
+def GetStopTimeEventsByRouteDirection(start_sec, end_sec, DepOrArr, serviceidlist, serviceidlist_yest,
+                                      serviceidlist_tom, frequencies_dict):
+    '''Fetch every stop visit in the time window for trips running on the given
+    service_ids in a single query, tagged with the trip's route and direction.
+    Returns a list of (route_id, direction_id) tuples and parallel numpy arrays
+    (rtdir_idx, stop_ids, trip_ids, stop_times, from_frequencies), one entry per
+    stop visit. rtdir_idx indexes the list of tuples, and from_frequencies is True
+    for visits extrapolated from frequencies.txt, which are only fetched strictly
+    inside the time window (see GetStopTimesForStopsInTimeWindow). Times from yesterday's and tomorrow's
+    trips are adjusted to today's time of day. A route-direction pair with an
+    empty direction_id also gets the visits of every other trip of the route,
+    since direction is ignored for it.'''
+
+    # Stage the active service_ids with the offset that converts their times
+    # to today's time of day.
+    day_offsets = {"today": 0, "yesterday": -SecsInDay, "tomorrow": SecsInDay}
+    cse = conn.cursor()
+    cse.execute("DROP TABLE IF EXISTS temp.active_services;")
+    cse.execute("CREATE TEMP TABLE active_services (service_id TEXT, time_offset INTEGER);")
+    for serviceids, dayname in [(serviceidlist, "today"), (serviceidlist_yest, "yesterday"),
+                                (serviceidlist_tom, "tomorrow")]:
+        cse.executemany("INSERT INTO active_services (service_id, time_offset) VALUES (?, ?);",
+                        [(service_id, day_offsets[dayname]) for service_id in serviceids])
+
+    rtdir_dict = {} # {(route_id, direction_id): rtdir_idx}
+    rtdir_idx = []
+    stop_ids = []
+    trip_ids = []
+    stop_times = []
+
+    # Get the stop visits within the time window for all trips at once
+    eventsfetch = '''
+        SELECT trips.route_id, trips.direction_id, stop_times.stop_id, stop_times.trip_id,
+            CAST(stop_times.%s AS INTEGER) + active_services.time_offset
+        FROM active_services
+        JOIN trips ON trips.service_id = active_services.service_id
+        JOIN stop_times ON stop_times.trip_id = trips.trip_id
+        AND stop_times.%s BETWEEN ? - active_services.time_offset AND ? - active_services.time_offset
+        ;''' % (DepOrArr, DepOrArr)
+    cse.execute(eventsfetch, (start_sec, end_sec))
+    for event in cse:
+        if event[3] in frequencies_dict:
+            # Handled below
+            continue
+        rtdir_idx.append(rtdir_dict.setdefault((event[0], event[1]), len(rtdir_dict)))
+        stop_ids.append(event[2])
+        trip_ids.append(event[3])
+        stop_times.append(event[4])
+
+    # If trips use the frequencies.txt file, extrapolate their stop_times
+    num_scheduled = len(rtdir_idx)
+    if frequencies_dict:
+        freqtripsfetch = '''
+            SELECT trips.trip_id, trips.route_id, trips.direction_id, active_services.time_offset
+            FROM active_services
+            JOIN trips ON trips.service_id = active_services.service_id
+            ;'''
+        cse.execute(freqtripsfetch)
+        freqtrips = [trip for trip in cse.fetchall() if trip[0] in frequencies_dict]
+        for trip in freqtrips:
+            dayname = [d for d in day_offsets if day_offsets[d] == trip[3]][0]
+            stoptimedict = GetStopTimesForStopsInTimeWindow(start_sec, end_sec, DepOrArr, [trip[0]], dayname, frequencies_dict)
+            idx = rtdir_dict.setdefault((trip[1], trip[2]), len(rtdir_dict))
+            for stop_id in stoptimedict:
+                for stoptime in stoptimedict[stop_id]:
+                    rtdir_idx.append(idx)
+                    stop_ids.append(stop_id)
+                    trip_ids.append(stoptime[0])
+                    stop_times.append(stoptime[1])
+
+    cse.execute("DROP TABLE temp.active_services;")
+
+    rtdirs = sorted(rtdir_dict, key=rtdir_dict.get)
+    rtdir_idx = np.array(rtdir_idx, dtype=np.int64)
+    stop_ids = np.array(stop_ids, dtype="U")
+    trip_ids = np.array(trip_ids, dtype="U")
+    stop_times = np.array(stop_times, dtype=np.float64)
+    from_frequencies = np.arange(len(rtdir_idx)) >= num_scheduled
+
+    # Trips without a direction_id are counted together with all the trips of
+    # their route, ignoring direction, as the earlier per-route queries did.
+    # This only matters for routes that mix trips with and without a direction_id.
+    copies = [] # [(rtdir index, visits to copy)]
+    for idx, (route_id, direction_id) in enumerate(rtdirs):
+        if direction_id not in [None, ""]:
+            continue
+        others = [other_idx for other_idx, rtdir in enumerate(rtdirs) if rtdir[0] == route_id and other_idx != idx]
+        if others:
+            copies.append((idx, np.flatnonzero(IsIn(rtdir_idx, others))))
+    if copies:
+        visits = np.concatenate([np.arange(len(rtdir_idx))] + [copy for idx, copy in copies])
+        rtdir_idx = np.concatenate([rtdir_idx] + [np.repeat(np.int64(idx), len(copy)) for idx, copy in copies])
+        stop_ids, trip_ids, stop_times = stop_ids[visits], trip_ids[visits], stop_times[visits]
+        from_frequencies = from_frequencies[visits]
+
+    return rtdirs, rtdir_idx, stop_ids, trip_ids, stop_times, from_frequencies
+
+
 def GetLineTimesInTimeWindow(start, end, DepOrArr, triplist, day, frequencies_dict):
-    '''Return a dictionary of {line_key: [[trip_id, start_time, end_time]]} for trips and
+    '''Return a dictionary of {segment_id: [[trip_id, start_time, end_time]]} for trips and
     stop_times in the time window. Adjust the stop_time value to today's time of
     day if it is a trip from yesterday or tomorrow.'''
 
@@ -361,7 +485,7 @@ def GetLineTimesInTimeWindow(start, end, DepOrArr, triplist, day, frequencies_di
         start = start - SecsInDay
         end = end - SecsInDay
 
-    linetimedict = {} # {line_key: [[trip_id, start_time, end_time]]}
+    linetimedict = {} # {segment_id: [[trip_id, start_time, end_time]]}
     for trip in triplist:
 
         # If the trip uses the frequencies.txt file, extrapolate the stop_times
@@ -371,7 +495,7 @@ def GetLineTimesInTimeWindow(start, end, DepOrArr, triplist, day, frequencies_di
 
             # Grab the stops stop_times for this trip
             linesfetch = '''
-                SELECT key, start_time, end_time FROM schedules
+                SELECT segment_id, start_time, end_time FROM schedules
                 WHERE trip_id == ?
                 ;'''
             c.execute(linesfetch, (trip,))
@@ -415,7 +539,7 @@ def GetLineTimesInTimeWindow(start, end, DepOrArr, triplist, day, frequencies_di
         else:
             # Grab the line schedules fully within the time window
             linesfetch = '''
-                SELECT key, start_time, end_time FROM schedules
+                SELECT segment_id, start_time, end_time FROM schedules
                 WHERE trip_id == ?
                 AND start_time BETWEEN ? AND ?
                 AND end_time BETWEEN ? AND ?
@@ -535,8 +659,74 @@ def CountTripsAtStops(day, start_sec, end_sec, DepOrArr, Specific=False):
     return stoptimedict
 
 
+def LoadScenario(ScenarioFile):
+    '''Read a what-if service scenario from a JSON file. A scenario is a small
+    set of changes applied to the stop events from the GTFS data at analysis time
+    (see ApplyScenario), so the GTFS data doesn't have to be edited and
+    preprocessed again. All keys are optional:
+        "remove_routes": [route_id, ...]
+        "remove_trips": [trip_id, ...]
+        "shift_trips": {trip_id: seconds to add to all the trip's stop times}
+        "headway_multipliers": {route_id: multiplier for the time between trips}
+        "add_trips": [{"trip_id": ..., "route_id": ...,
+                       "stop_times": [[stop_id, "HH:MM:SS"], ...],
+                       "headway_secs": ..., "end_time": "HH:MM:SS"}]
+    For added trips, headway_secs and end_time are optional.  If they are given,
+    the trip is repeated every headway_secs until its first stop time passes
+    end_time.  Fetch the stop events for the time window returned by
+    BBB_Scenarios.GetScenarioTimeWindow so shifts and headway multipliers can
+    bring in trips scheduled outside the analysis time window.'''
+
+    try:
+        with open(ScenarioFile) as f:
+            scenario = json.load(f)
+    except Exception as ex:
+        arcpy.AddError("Could not read the scenario file %s: %s" % (ScenarioFile, str(ex)))
+        raise CustomError
+
+    if not isinstance(scenario, dict):
+        arcpy.AddError("The scenario file must contain a JSON object.")
+        raise CustomError
+    badkeys = [key for key in scenario if key not in BBB_Scenarios.ScenarioKeys]
+    if badkeys:
+        arcpy.AddError("The scenario file contains unknown keys: %s. Valid keys are: %s." % \
+                       (", ".join(badkeys), ", ".join(BBB_Scenarios.ScenarioKeys)))
+        raise CustomError
+
+    try:
+        for route_id in scenario.get("headway_multipliers", {}):
+            if float(scenario["headway_multipliers"][route_id]) <= 0:
+                arcpy.AddError("Headway multipliers in the scenario file must be greater than 0.")
+                raise CustomError
+        for trip in scenario.get("add_trips", []):
+            trip["stop_times"] = [[stop_id, parse_time(stop_time)] for stop_id, stop_time in trip["stop_times"]]
+            if trip.get("headway_secs"):
+                if float(trip["headway_secs"]) <= 0:
+                    arcpy.AddError("Headways for added trips in the scenario file must be greater than 0.")
+                    raise CustomError
+                trip["end_time"] = parse_time(trip["end_time"])
+    except CustomError:
+        raise
+    except Exception as ex:
+        arcpy.AddError("The scenario file is not formatted correctly: %s" % str(ex))
+        raise CustomError
+
+    return scenario
+
+
+def ApplyScenario(stoptimedict, scenario, start_sec, end_sec):
+    '''Apply a scenario loaded with LoadScenario to a dictionary of stop events
+    {stop_id: [[trip_id, stop_time]]} fetched for the time window returned by
+    BBB_Scenarios.GetScenarioTimeWindow, using the trips table for the trips'
+    routes and directions. See BBB_Scenarios.ApplyScenario.'''
+
+    triproute_dict = MakeTripRouteDict()
+    tripdirection_dict = MakeTripDirectionDict() if scenario.get("headway_multipliers") else {}
+    return BBB_Scenarios.ApplyScenario(stoptimedict, scenario, start_sec, end_sec, triproute_dict, tripdirection_dict)
+
+
 def CountTripsOnLines(day, start_sec, end_sec, DepOrArr, Specific=False):
-    '''Given a time window, return a dictionary of {line_key: [[trip_id, start_time, end_time]]}'''
+    '''Given a time window, return a dictionary of {segment_id: [[trip_id, start_time, end_time]]}'''
 
     triplist, triplist_yest, triplist_tom = GetTripLists(day, start_sec, end_sec, DepOrArr, Specific)
 
@@ -561,6 +751,107 @@ def CountTripsOnLines(day, start_sec, end_sec, DepOrArr, Specific=False):
     return linetimedict
 
 
+def MakeLineTimeArrays(day, start_sec, end_sec, DepOrArr, Specific=False):
+    '''Fetch every trip traversal of a line segment fully within the time window
+    in a single pass over the schedules table. Returns parallel numpy arrays
+    (segment_ids, route_ids, trip_ids, start_times), one entry per traversal, with
+    times adjusted to today's time of day for trips from yesterday or tomorrow.'''
+
+    triplist, triplist_yest, triplist_tom = GetTripLists(day, start_sec, end_sec, DepOrArr, Specific)
+
+    try:
+        frequencies_dict = MakeFrequenciesDict()
+        triproute_dict = MakeTripRouteDict()
+
+        # Stage the trips running in the time window with their route and the offset
+        # that converts their times to today's time of day. Frequency-based trips
+        # are handled separately below because their times must be extrapolated.
+        ct = conn.cursor()
+        ct.execute("DROP TABLE IF EXISTS temp.window_trips;")
+        ct.execute("CREATE TEMP TABLE window_trips (trip_id TEXT, route_id TEXT, time_offset INTEGER);")
+        for trips, offset in [(triplist, 0), (triplist_yest, -SecsInDay), (triplist_tom, SecsInDay)]:
+            ct.executemany("INSERT INTO window_trips (trip_id, route_id, time_offset) VALUES (?, ?, ?);",
+                           [(trip, triproute_dict[trip], offset) for trip in trips if trip not in frequencies_dict])
+
+        linesfetch = '''
+            SELECT schedules.segment_id, window_trips.route_id, schedules.trip_id,
+                schedules.start_time + window_trips.time_offset
+            FROM window_trips
+            JOIN schedules ON schedules.trip_id = window_trips.trip_id
+            AND schedules.start_time BETWEEN ? - window_trips.time_offset AND ? - window_trips.time_offset
+            AND schedules.end_time BETWEEN ? - window_trips.time_offset AND ? - window_trips.time_offset
+            ;'''
+        ct.execute(linesfetch, (start_sec, end_sec, start_sec, end_sec))
+        rows = ct.fetchall()
+        ct.execute("DROP TABLE temp.window_trips;")
+
+        # Extrapolate the frequency-based trips
+        freq_trips = [[trip for trip in trips if trip in frequencies_dict] for trips in
+                      [triplist, triplist_yest, triplist_tom]]
+        if any(freq_trips):
+            for trips, dayname in zip(freq_trips, ["today", "yesterday", "tomorrow"]):
+                freqtimedict = GetLineTimesInTimeWindow(start_sec, end_sec, DepOrArr, trips, dayname, frequencies_dict)
+                for segment_id in freqtimedict:
+                    for linetime in freqtimedict[segment_id]:
+                        # The special trip name is trip_id_DayStartTime
+                        trip = linetime[0].rsplit("_" + dayname, 1)[0]
+                        rows.append((segment_id, triproute_dict[trip], linetime[0], linetime[1]))
+
+    except:
+        arcpy.AddError("Error creating dictionary of lines and trips in time window.")
+        raise CustomError
+
+    if not rows:
+        return (np.zeros(0, dtype=np.int64), np.zeros(0, dtype="U1"),
+                np.zeros(0, dtype="U1"), np.zeros(0, dtype=np.float64))
+    segment_ids, route_ids, trip_ids, start_times = zip(*rows)
+    return (np.array(segment_ids, dtype=np.int64), np.array([str(r) for r in route_ids], dtype="U"),
+            np.array(trip_ids, dtype="U"), np.array(start_times, dtype=np.float64))
+
+
+def RetrieveStatsForLineFeatures(line_segments, line_routes, linetimearrays, start_sec, end_sec):
+    '''Vectorized version of RetrieveStatsForLines for all line features at once.
+    line_segments holds each feature's segment_id, and line_routes its route_id,
+    or None if trips on all routes are combined. linetimearrays comes from
+    MakeLineTimeArrays. Returns numpy arrays NumTrips, NumTripsPerHr, MaxWaitTime,
+    and AvgHeadway, one entry per feature. MaxWaitTime and AvgHeadway are in
+    minutes and are NaN where they can't be calculated.'''
+
+    segment_ids, route_ids, trip_ids, start_times = linetimearrays
+    line_segments = np.asarray(line_segments, dtype=np.int64)
+    nfeatures = len(line_segments)
+
+    # Build integer keys for the (segment, route) groups
+    if line_routes is None:
+        keys = segment_ids
+        feature_keys = line_segments
+    else:
+        line_routes = np.array([str(r) for r in line_routes], dtype="U")
+        route_names, route_idx = np.unique(np.concatenate([route_ids, line_routes]), return_inverse=True)
+        nroutes = len(route_names)
+        keys = segment_ids * nroutes + route_idx[:len(route_ids)]
+        feature_keys = line_segments * nroutes + route_idx[len(route_ids):]
+
+    group_keys, group_idx = np.unique(keys, return_inverse=True)
+    trip_idx = np.unique(trip_ids, return_inverse=True)[1]
+    GroupNumTrips, GroupNumVisits, GroupMaxWait, GroupHeadway = CalculateGroupedTimeStats(
+        group_idx, trip_idx, start_times, len(group_keys), start_sec, end_sec)
+
+    # Look up each feature's group. Features with no trips keep the defaults.
+    NumTrips = np.zeros(nfeatures, dtype=np.int64)
+    MaxWaitTime = MakeNaNArray(nfeatures)
+    AvgHeadway = MakeNaNArray(nfeatures)
+    if len(group_keys):
+        pos = np.minimum(np.searchsorted(group_keys, feature_keys), len(group_keys) - 1)
+        found = group_keys[pos] == feature_keys
+        NumTrips[found] = GroupNumTrips[pos[found]]
+        MaxWaitTime[found] = SecondsToMinutes(GroupMaxWait[pos[found]])
+        AvgHeadway[found] = SecondsToMinutes(GroupHeadway[pos[found]])
+    NumTripsPerHr = RoundHalfUp(NumTrips / ((end_sec - start_sec) / 3600.0), 2)
+
+    return NumTrips, NumTripsPerHr, MaxWaitTime, AvgHeadway
+
+
 def RetrieveStatsForSetOfStops(stoplist, stoptimedict, CalcWaitTime, start_sec, end_sec):
     '''For a set of stops, query the stoptimedict {stop_id: [[trip_id, stop_time]]}
     and return the NumTrips, NumTripsPerHr, NumStopsInRange, and MaxWaitTime for
@@ -592,24 +883,19 @@ def RetrieveStatsForSetOfStops(stoplist, stoptimedict, CalcWaitTime, start_sec,
     return NumTrips, NumTripsPerHr, NumStopsInRange, MaxWaitTime
 
 
-def RetrieveStatsForLines(linekey, linetimedict, start_sec, end_sec, combine_corridors, triproute_dict=None):
-    '''For a set of lines, query the linetimedict {line_key: [[trip_id, start_time, end_time]]}
+def RetrieveStatsForLines(segment_id, linetimedict, start_sec, end_sec, route_id=None, triproute_dict=None):
+    '''For a line segment, query the linetimedict {segment_id: [[trip_id, start_time, end_time]]}
     and return the NumTrips, NumTripsPerHr, MaxWaitTime, and AvgHeadway for
-    that set of lines.'''
+    that segment. If route_id is given, only count trips on that route.'''
 
     # Find the list of unique trips
     triplist = []
     StartTimesOnThisLine = []
-    route_id = None
-    if not combine_corridors:
-        linekeyparts = linekey.split(" , ")
-        linekey = linekeyparts[0] + " , " + linekeyparts[1]
-        route_id = linekeyparts[2]
     try:
-        linetimelist = linetimedict[linekey]
+        linetimelist = linetimedict[segment_id]
         for linetime in linetimelist:
             trip = linetime[0]
-            if combine_corridors or triproute_dict[trip] == route_id:
+            if route_id is None or triproute_dict[trip] == route_id:
                 triplist.append(trip)
                 StartTimesOnThisLine.append(linetime[1])
     except KeyError:
@@ -659,6 +945,571 @@ def CalculateAvgHeadway(TimeList):
         return None
 
 
+# Names of the .npy files making up a saved feature->stops CSR relation
+StopSetArrayNames = ["ids", "offsets", "indices", "stops"]
+
+# Upper bound on the number of expanded stop visits handled in one vectorized
+# batch by RetrieveStatsForStopSets.  Keeps memory use bounded for large regions.
+MaxVisitsPerBatch = 5000000
+
+
+def MakeStopSetArrays(pairs, all_feature_ids=None):
+    '''Convert an iterable of (feature_id, stop_id) pairs into a compact CSR
+    (compressed sparse row) representation of the feature->stops relation.
+    Returns feature_ids, offsets, indices, and stop_ids numpy arrays. The stops
+    serving feature_ids[i] are stop_ids[indices[offsets[i]:offsets[i+1]]].
+    If all_feature_ids (sorted ascending) is given, the result has a row for each
+    of them, including features with no stops.'''
+
+    feature_list = []
+    stop_list = []
+    for feature_id, stop_id in pairs:
+        feature_list.append(feature_id)
+        stop_list.append(stop_id)
+
+    if not feature_list:
+        feature_ids = np.zeros(0, dtype=np.int32)
+        if all_feature_ids is not None:
+            feature_ids = np.asarray(all_feature_ids, dtype=np.int32)
+        return feature_ids, np.zeros(len(feature_ids) + 1, dtype=np.int64), \
+               np.zeros(0, dtype=np.int32), np.zeros(0, dtype="U1")
+
+    feature_arr = np.array(feature_list, dtype=np.int64)
+    stop_ids, stop_idx = np.unique(np.array(stop_list, dtype="U"), return_inverse=True)
+    stop_idx = stop_idx.ravel()
+
+    # Sort by feature, then stop, and drop duplicate pairs
+    order = np.lexsort((stop_idx, feature_arr))
+    feature_arr = feature_arr[order]
+    stop_idx = stop_idx[order]
+    keep = np.ones(len(feature_arr), dtype=bool)
+    keep[1:] = (feature_arr[1:] != feature_arr[:-1]) | (stop_idx[1:] != stop_idx[:-1])
+    feature_arr = feature_arr[keep]
+    stop_idx = stop_idx[keep]
+
+    # Row boundaries for each feature
+    is_first = np.ones(len(feature_arr), dtype=bool)
+    is_first[1:] = feature_arr[1:] != feature_arr[:-1]
+    boundaries = np.flatnonzero(is_first)
+    if all_feature_ids is None:
+        feature_ids = feature_arr[boundaries].astype(np.int32)
+        offsets = np.append(boundaries, len(feature_arr)).astype(np.int64)
+    else:
+        feature_ids = np.asarray(all_feature_ids, dtype=np.int32)
+        offsets = np.append(np.searchsorted(feature_arr, feature_ids, side="left"),
+                            len(feature_arr)).astype(np.int64)
+
+    return feature_ids, offsets, stop_idx.astype(np.int32), stop_ids
+
+
+def SaveStopSetArrays(outDir, basename, feature_ids, offsets, indices, stop_ids):
+    '''Write a feature->stops CSR relation to .npy files in outDir.'''
+    for name, arr in zip(StopSetArrayNames, [feature_ids, offsets, indices, stop_ids]):
+        np.save(os.path.join(outDir, "%s_%s.npy" % (basename, name)), arr)
+
+
+def StopSetArraysExist(inDir, basename):
+    '''Check whether a feature->stops CSR relation was saved to inDir.'''
+    for name in StopSetArrayNames:
+        if not os.path.exists(os.path.join(inDir, "%s_%s.npy" % (basename, name))):
+            return False
+    return True
+
+
+def LoadStopSetArrays(inDir, basename):
+    '''Load a feature->stops CSR relation saved with SaveStopSetArrays. The
+    arrays are memory-mapped rather than read into memory.'''
+    return [np.load(os.path.join(inDir, "%s_%s.npy" % (basename, name)), mmap_mode="r")
+            for name in StopSetArrayNames]
+
+
+def MakeStopVisitArrays(stoptimedict, stop_ids):
+    '''Flatten stoptimedict {stop_id: [[trip_id, stop_time]]} into arrays of
+    stop visits grouped by the position of the stop in stop_ids. Returns
+    visit_offsets, visit_trips (integer trip indices), and visit_times. The
+    visits for stop_ids[i] are at visit_offsets[i]:visit_offsets[i+1].'''
+
+    trip_index = {}
+    counts = np.zeros(len(stop_ids), dtype=np.int64)
+    trips = []
+    times = []
+    for i, stop_id in enumerate(stop_ids):
+        stoptimelist = stoptimedict.get(stop_id)
+        if not stoptimelist:
+            continue
+        counts[i] = len(stoptimelist)
+        for stoptime in stoptimelist:
+            trips.append(trip_index.setdefault(stoptime[0], len(trip_index)))
+            times.append(stoptime[1])
+
+    visit_offsets = np.zeros(len(stop_ids) + 1, dtype=np.int64)
+    visit_offsets[1:] = np.cumsum(counts)
+    return visit_offsets, np.array(trips, dtype=np.int64), np.array(times, dtype=np.float64)
+
+
+def MakeNaNArray(n):
+    '''Return a float array of n NaN values. (np.full needs numpy 1.8, newer than
+    the numpy in ArcGIS 10.1-10.3.)'''
+    arr = np.empty(n, dtype=np.float64)
+    arr.fill(np.nan)
+    return arr
+
+
+def IsIn(values, test_values):
+    '''Return a boolean array telling whether each of values is in test_values.
+    np.isin needs numpy 1.13, newer than the numpy in ArcMap, and np.in1d was
+    removed in numpy 2.4.'''
+    if hasattr(np, "isin"):
+        return np.isin(values, test_values)
+    return np.in1d(values, test_values)
+
+
+def RoundHalfUp(values, decimals=0):
+    '''Round an array the way Python 2's round() does for positive numbers, with
+    halves rounded up. np.round rounds halves to even.'''
+    scale = 10.0 ** decimals
+    return np.floor(np.asarray(values, dtype=np.float64) * scale + 0.5) / scale
+
+
+def CalculateGroupedTimeStats(group_idx, trip_idx, times, ngroups, start_sec, end_sec, CalcWaitTime=True):
+    '''Vectorized trip statistics for many groups of stop visits at once.
+    group_idx, trip_idx, and times are parallel arrays with one entry per visit.
+    Returns numpy arrays of length ngroups: NumTrips (unique trips), NumVisits,
+    MaxWaitTime and AvgHeadway. MaxWaitTime and AvgHeadway are in seconds and
+    are NaN where they can't be calculated, following the same rules as
+    CalculateMaxWaitTime and CalculateAvgHeadway.'''
+
+    group_idx = np.asarray(group_idx, dtype=np.int64)
+    trip_idx = np.asarray(trip_idx, dtype=np.int64)
+    times = np.asarray(times, dtype=np.float64)
+
+    NumVisits = np.bincount(group_idx, minlength=ngroups)
+    MaxWaitTime = MakeNaNArray(ngroups)
+    AvgHeadway = MakeNaNArray(ngroups)
+    if not len(group_idx):
+        return np.zeros(ngroups, dtype=np.int64), NumVisits, MaxWaitTime, AvgHeadway
+
+    # Count unique trips per group
+    ntrips = int(trip_idx.max()) + 1
+    group_trips = np.unique(group_idx * ntrips + trip_idx)
+    NumTrips = np.bincount(group_trips // ntrips, minlength=ngroups)
+
+    # Sort visits by group and then by time
+    order = np.lexsort((times, group_idx))
+    sorted_groups = group_idx[order]
+    sorted_times = times[order]
+    ends = np.cumsum(NumVisits)
+    starts = ends - NumVisits
+    multi = np.flatnonzero(NumVisits > 1)
+    first = sorted_times[starts[multi]]
+    last = sorted_times[ends[multi] - 1]
+
+    # With sorted times, the mean gap between adjacent visits is the span over the number of gaps
+    AvgHeadway[multi] = (last - first) / (NumVisits[multi] - 1)
+
+    if CalcWaitTime:
+        # Largest gap between adjacent visits within each group. Gaps between
+        # visits of different groups are zeroed, so the maximum over the gaps from
+        # the start of one group to the start of the next is that group's largest gap.
+        gaps = sorted_times[1:] - sorted_times[:-1]
+        gaps[sorted_groups[1:] != sorted_groups[:-1]] = 0
+        MaxGap = np.zeros(ngroups)
+        if len(multi):
+            MaxGap[multi] = np.maximum.reduceat(gaps, starts[multi])
+        # Exclude cases where the time to the time window boundaries is
+        # > MaxWaitTime because we can't properly determine MaxWaitTime.
+        MaxEdge = np.maximum(first - start_sec, end_sec - last)
+        valid = multi[MaxEdge < MaxGap[multi]]
+        MaxWaitTime[valid] = MaxGap[valid]
+
+    return NumTrips, NumVisits, MaxWaitTime, AvgHeadway
+
+
+def SecondsToMinutes(secs):
+    '''Convert an array of durations in seconds to whole minutes, keeping NaN.'''
+    return RoundHalfUp(np.asarray(secs, dtype=np.float64) / 60.0)
+
+
+def RetrieveStatsForStopSets(offsets, indices, stop_ids, stoptimedict, CalcWaitTime, start_sec, end_sec):
+    '''Vectorized version of RetrieveStatsForSetOfStops for every feature in a
+    feature->stops CSR relation (see MakeStopSetArrays). Returns numpy arrays
+    NumTrips, NumTripsPerHr, NumStopsInRange, and MaxWaitTime, one entry per
+    feature. MaxWaitTime is NaN where it can't be calculated.'''
+
+    offsets = np.asarray(offsets, dtype=np.int64)
+    indices = np.asarray(indices, dtype=np.int64)
+    nfeatures = len(offsets) - 1
+
+    visit_offsets, visit_trips, visit_times = MakeStopVisitArrays(stoptimedict, stop_ids)
+    visit_counts = np.diff(visit_offsets)
+
+    NumStopsInRange = np.diff(offsets)
+    NumTrips = np.zeros(nfeatures, dtype=np.int64)
+    MaxWaitTime = MakeNaNArray(nfeatures)
+
+    # Number of visits contributed by each feature-stop pair, and the running
+    # total at the start of each feature, used to split the work into batches.
+    pair_visits = visit_counts[indices]
+    pair_cum = np.zeros(len(indices) + 1, dtype=np.int64)
+    pair_cum[1:] = np.cumsum(pair_visits)
+    feature_cum = pair_cum[offsets]
+
+    f0 = 0
+    while f0 < nfeatures:
+        f1 = int(np.searchsorted(feature_cum, feature_cum[f0] + MaxVisitsPerBatch, side="right")) - 1
+        f1 = min(max(f1, f0 + 1), nfeatures)
+        p0 = offsets[f0]
+        p1 = offsets[f1]
+        counts = pair_visits[p0:p1]
+        total = int(counts.sum())
+        if total:
+            # Expand feature-stop pairs into one row per stop visit
+            pair_feature = np.repeat(np.arange(f1 - f0), np.diff(offsets[f0:f1 + 1]))
+            visit_feature = np.repeat(pair_feature, counts)
+            pair_first = np.cumsum(counts) - counts
+            visit_pos = np.arange(total) - np.repeat(pair_first, counts) + \
+                        np.repeat(visit_offsets[indices[p0:p1]], counts)
+            NumTrips[f0:f1], _, MaxWaitTime[f0:f1], _ = CalculateGroupedTimeStats(
+                visit_feature, visit_trips[visit_pos], visit_times[visit_pos], f1 - f0,
+                start_sec, end_sec, CalcWaitTime)
+        f0 = f1
+
+    NumTripsPerHr = RoundHalfUp(NumTrips / ((end_sec - start_sec) / 3600.0), 2)
+    MaxWaitTime = SecondsToMinutes(MaxWaitTime)
+
+    return NumTrips, NumTripsPerHr, NumStopsInRange, MaxWaitTime
+
+
+def MakeStopEventSignatures(stoptimedict, triproute_dict):
+    '''Make a signature for each stop in stoptimedict {stop_id: [[trip_id, stop_time]]}
+    by hashing the route_id and time of its sorted stop events. trip_ids are left
+    out, so a new version of the GTFS data that only renames trips doesn't change
+    the signatures. Returns {stop_id: signature}.'''
+    signatures = {}
+    for stop_id in stoptimedict:
+        events = sorted("%s,%s" % (BBB_Scenarios.GetTripInfo(trip_id, triproute_dict) or "", stop_time)
+                        for trip_id, stop_time in stoptimedict[stop_id])
+        signatures[stop_id] = hashlib.md5("\n".join(events).encode("utf-8")).hexdigest()
+    return signatures
+
+
+def GetStopEventSignaturesFile(outFile):
+    '''Return the path of the SQL database where the stop event signatures of an
+    output are recorded. It is written next to the output, in the folder or file
+    geodatabase that contains it.'''
+    outDir, outName = os.path.split(outFile)
+    # Feature datasets aren't folders on disk
+    while outDir and not os.path.isdir(outDir):
+        outDir = os.path.dirname(outDir)
+    return os.path.join(outDir, os.path.splitext(outName)[0] + "_StopSignatures.sql")
+
+
+def SaveStopEventSignatures(sigconn, time_window, signatures):
+    '''Record the stop event signatures used to calculate an output for a time
+    window in the StopSignatures table of the SQL database sigconn. Signatures
+    recorded earlier are replaced, since the output now holds this time window.'''
+    sigcur = sigconn.cursor()
+    sigcur.execute("CREATE TABLE IF NOT EXISTS StopSignatures \
+(time_window TEXT, stop_id TEXT, signature TEXT);")
+    sigcur.execute("DELETE FROM StopSignatures;")
+    sigcur.executemany("INSERT INTO StopSignatures (time_window, stop_id, signature) VALUES (?, ?, ?);",
+                    ((time_window, stop_id, signatures[stop_id]) for stop_id in signatures))
+    sigconn.commit()
+
+
+def LoadStopEventSignatures(sigconn, time_window):
+    '''Return the stop event signatures {stop_id: signature} recorded with
+    SaveStopEventSignatures for a time window, or None if none were recorded.'''
+    sigcur = sigconn.cursor()
+    sigcur.execute("SELECT name FROM sqlite_master WHERE type='table' AND name='StopSignatures';")
+    if not sigcur.fetchone():
+        return None
+    sigcur.execute("SELECT stop_id, signature FROM StopSignatures WHERE time_window=?;", (time_window,))
+    signatures = dict(sigcur.fetchall())
+    return signatures or None
+
+
+def FindChangedStops(old_signatures, new_signatures):
+    '''Return the set of stop_ids whose events were added, removed, or changed
+    between two sets of stop event signatures.'''
+    return set(stop_id for stop_id in set(old_signatures) | set(new_signatures)
+               if old_signatures.get(stop_id) != new_signatures.get(stop_id))
+
+
+def SubsetStopSetArrays(offsets, indices, stop_ids, changed_stops):
+    '''Find the features in a feature->stops CSR relation (see MakeStopSetArrays)
+    served by any of changed_stops. Returns the row numbers of those features and
+    the offsets and indices of a CSR relation containing only those rows.'''
+    offsets = np.asarray(offsets, dtype=np.int64)
+    indices = np.asarray(indices)
+    changed_idx = np.flatnonzero(IsIn(np.asarray(stop_ids), list(changed_stops)))
+    pair_rows = np.repeat(np.arange(len(offsets) - 1), np.diff(offsets))
+    rows = np.unique(pair_rows[IsIn(indices, changed_idx)])
+
+    counts = offsets[rows + 1] - offsets[rows]
+    sub_offsets = np.zeros(len(rows) + 1, dtype=np.int64)
+    sub_offsets[1:] = np.cumsum(counts)
+    # Position of each kept pair in the original indices array
+    pair_pos = np.arange(sub_offsets[-1]) - np.repeat(sub_offsets[:-1], counts) + \
+               np.repeat(offsets[rows], counts)
+    return rows, sub_offsets, indices[pair_pos]
+
+
+def WriteStatsToFeatureClass(outFC, join_field, ids, fields):
+    '''Write result fields to an existing feature class or table in one bulk
+    ExtendTable call rather than updating it row by row. ids holds the join_field
+    value for each result, and fields is a list of (field name, numpy array)
+    tuples in the same order as ids. Existing fields with the same names are
+    replaced. For shapefiles, NaN values are written as -1.'''
+
+    records = np.empty(len(ids), dtype=[(join_field, np.asarray(ids).dtype)] + \
+                       [(name, np.asarray(values).dtype) for name, values in fields])
+    records[join_field] = ids
+    for name, values in fields:
+        values = np.asarray(values)
+        if ".shp" in os.path.basename(outFC) and values.dtype.kind == "f":
+            values = np.where(np.isnan(values), -1, values)
+        records[name] = values
+
+    existing_fields = dict((f.name, f.type) for f in arcpy.ListFields(outFC))
+    fields_to_replace = [name for name, values in fields if name in existing_fields]
+    if fields_to_replace:
+        arcpy.management.DeleteField(outFC, fields_to_replace)
+
+    if existing_fields.get(join_field) in ["GUID", "GlobalID", "Date"]:
+        # ExtendTable can't join on these field types, so add the fields and
+        # fill them in with a lookup by the string value of the join field.
+        fieldtypes = {"i": "LONG", "u": "LONG", "f": "DOUBLE", "b": "SHORT"}
+        for name, values in fields:
+            arcpy.management.AddField(outFC, name, fieldtypes.get(records[name].dtype.kind, "TEXT"))
+        lookup = dict((str(record[0]), record.tolist()[1:]) for record in records)
+        with arcpy.da.UpdateCursor(outFC, [join_field] + [name for name, values in fields]) as ucursor:
+            for row in ucursor:
+                try:
+                    values = lookup[str(row[0])]
+                except KeyError:
+                    continue
+                ucursor.updateRow([row[0]] + [None if value != value else value for value in values])
+        return
+
+    arcpy.da.ExtendTable(outFC, join_field, records, join_field, append_only=False)
+
+
+def UpdateStatsInFeatureClass(outFC, join_field, ids, fields):
+    '''Update the result fields of the rows of an existing output whose join_field
+    value is in ids, leaving all other rows alone. ids and fields are as in
+    WriteStatsToFeatureClass, and the fields must already exist.'''
+    IsShapefile = ".shp" in os.path.basename(outFC)
+    columns = []
+    for name, values in fields:
+        values = np.asarray(values)
+        if values.dtype.kind == "f":
+            values = np.where(np.isnan(values), -1 if IsShapefile else np.nan, values)
+        columns.append(values.tolist())
+    lookup = dict((str(ID), [None if value != value else value for value in row])
+                  for ID, row in zip(np.asarray(ids).tolist(), zip(*columns)))
+    with arcpy.da.UpdateCursor(outFC, [join_field] + [name for name, values in fields]) as ucursor:
+        for row in ucursor:
+            try:
+                values = lookup[str(row[0])]
+            except KeyError:
+                continue
+            ucursor.updateRow([row[0]] + values)
+
+
+def GetOutputTableType(outFile):
+    '''Return the columnar table format implied by the extension of outFile, or
+    None if outFile should be written as a feature class.'''
+    return OutputTableExtensions.get(os.path.splitext(outFile)[1].lower())
+
+
+def WriteStatsToTable(outFile, id_field, ids, fields):
+    '''Write result fields keyed by id_field to a CSV file, a table in a SQLite
+    database, a NumPy structured array (.npy), or a Parquet file, depending on
+    the extension of outFile. This needs no ArcGIS workspace, and the results can
+    be joined back to the input features by id_field if desired. fields is a list
+    of (field name, numpy array) tuples in the same order as ids. NaN values are
+    written as empty values or NULL.'''
+
+    table_type = GetOutputTableType(outFile)
+    names = [id_field] + [name for name, values in fields]
+    columns = [np.asarray(ids)] + [np.asarray(values) for name, values in fields]
+
+    if table_type == "NPY":
+        records = np.empty(len(ids), dtype=[(str(name), col.dtype) for name, col in zip(names, columns)])
+        for name, col in zip(names, columns):
+            records[str(name)] = col
+        np.save(outFile, records)
+        return
+
+    if table_type == "PARQUET":
+        try:
+            import pandas as pd
+            pd.DataFrame(dict(zip(names, columns)), columns=names).to_parquet(outFile, index=False)
+        except ImportError:
+            arcpy.AddError("Writing Parquet output requires the python libraries pandas and pyarrow \
+or fastparquet, but the tool was unable to import them. Please choose a different output format.")
+            raise CustomError
+        return
+
+    # Plain python values with None for missing values
+    column_lists = []
+    for col in columns:
+        values = col.tolist()
+        if col.dtype.kind == "f":
+            values = [None if value != value else value for value in values]
+        column_lists.append(values)
+    rows = list(zip(*column_lists))
+
+    if table_type == "CSV":
+        if ispy3:
+            f = open(outFile, "w", newline="", encoding="utf-8")
+            def csv_value(value):
+                return "" if value is None else value
+        else:
+            # The python 2 csv module only writes byte strings, so encode text as UTF-8
+            f = open(outFile, "wb")
+            def csv_value(value):
+                if value is None:
+                    return ""
+                if isinstance(value, unicode):
+                    return value.encode("utf-8")
+                return value
+        with f:
+            writer = csv.writer(f)
+            writer.writerow([csv_value(name) for name in names])
+            for row in rows:
+                writer.writerow([csv_value(value) for value in row])
+
+    elif table_type == "SQLITE":
+        # The table is named after the database file
+        table_name = os.path.splitext(os.path.basename(outFile))[0]
+        sqltypes = {"i": "INTEGER", "u": "INTEGER", "f": "REAL", "b": "INTEGER"}
+        schema = ", ".join(['"%s" %s' % (name, sqltypes.get(col.dtype.kind, "TEXT"))
+                            for name, col in zip(names, columns)])
+        out_conn = sqlite3.connect(outFile)
+        out_cursor = out_conn.cursor()
+        out_cursor.execute('DROP TABLE IF EXISTS "%s";' % table_name)
+        out_cursor.execute('CREATE TABLE "%s" (%s);' % (table_name, schema))
+        out_cursor.executemany('INSERT INTO "%s" VALUES (%s);' % (table_name, ", ".join(["?"] * len(names))), rows)
+        out_cursor.execute('CREATE INDEX "%s_index_%s" ON "%s" ("%s");' % (table_name, id_field, table_name, id_field))
+        out_conn.commit()
+        out_conn.close()
+
+
+# Mean radius of the earth in meters, for converting stop lat/lon to local distances
+EarthRadius = 6371008.8
+
+# Meters in one unit of a network dataset length attribute
+MetersPerLengthUnit = {"Meters": 1.0,
+                        "Kilometers": 1000.0,
+                        "Centimeters": 0.01,
+                        "Millimeters": 0.001,
+                        "Decimeters": 0.1,
+                        "Feet": 0.3048,
+                        "Yards": 0.9144,
+                        "Miles": 1609.344,
+                        "Inches": 0.0254,
+                        "NauticalMiles": 1852.0}
+
+
+def MakeStopClusters(tolerance, UseParentStation=False):
+    '''Group GTFS stops that are close enough together to share a single network
+    location. Stops are assigned to the nearest cluster representative within
+    tolerance meters, found with a grid hash, so every stop is within the tolerance
+    of its representative. If UseParentStation is True, stops that share a
+    parent_station are grouped together first, regardless of the tolerance.
+    Returns {rep_stop_id: [(stop_id, distance_to_rep_in_meters), ...]}. Each
+    representative is a member of its own cluster with distance 0.'''
+
+    c.execute("SELECT stop_id, stop_lat, stop_lon, parent_station FROM stops;")
+    StopTable = c.fetchall()
+
+    # Project lat/lon to local x/y in meters.  An equirectangular projection is
+    # plenty accurate over the short distances we compare here.
+    coords = {}
+    for stop_id, lat, lon, parent in StopTable:
+        lat = math.radians(float(lat))
+        lon = math.radians(float(lon))
+        coords[stop_id] = (EarthRadius * lon * math.cos(lat), EarthRadius * lat)
+
+    def distance(stop1, stop2):
+        x1, y1 = coords[stop1]
+        x2, y2 = coords[stop2]
+        return math.hypot(x1 - x2, y1 - y2)
+
+    clusters = {}
+    assigned = set()
+
+    # ----- Group platforms of the same station -----
+    if UseParentStation:
+        stations = {}
+        for stop_id, lat, lon, parent in StopTable:
+            if parent:
+                stations.setdefault(parent, []).append(stop_id)
+        for parent in stations:
+            # The first platform listed serves as the representative.  The station
+            # itself joins its platforms.
+            members = stations[parent]
+            if parent in coords:
+                members = members + [parent]
+            members = [stop_id for stop_id in members if stop_id not in assigned]
+            if not members:
+                continue
+            rep = members[0]
+            clusters[rep] = [(stop_id, distance(stop_id, rep)) for stop_id in members]
+            assigned.update(members)
+
+    # ----- Cluster the remaining stops by distance -----
+    # Each grid cell is tolerance meters on a side, so any representative within
+    # the tolerance of a stop is in the stop's cell or one of its eight neighbors.
+    grid = {}
+    for stop_id, lat, lon, parent in StopTable:
+        if stop_id in assigned:
+            continue
+        x, y = coords[stop_id]
+        if tolerance and tolerance > 0:
+            cell = (int(math.floor(x / tolerance)), int(math.floor(y / tolerance)))
+            nearest = None
+            nearest_dist = tolerance
+            for i in (-1, 0, 1):
+                for j in (-1, 0, 1):
+                    for rep in grid.get((cell[0] + i, cell[1] + j), []):
+                        dist = distance(stop_id, rep)
+                        if dist <= nearest_dist:
+                            nearest = rep
+                            nearest_dist = dist
+            if nearest is not None:
+                clusters[nearest].append((stop_id, nearest_dist))
+                assigned.add(stop_id)
+                continue
+            grid.setdefault(cell, []).append(stop_id)
+        clusters[stop_id] = [(stop_id, 0.0)]
+        assigned.add(stop_id)
+
+    return clusters
+
+
+def ExpandStopClusters(pairs, clusters):
+    '''Fan out (feature_id, rep_stop_id) pairs from an analysis of cluster
+    representatives to (feature_id, stop_id) pairs for every member stop.'''
+    for feature_id, rep in pairs:
+        for stop_id, dist in clusters.get(rep, [(rep, 0.0)]):
+            yield feature_id, stop_id
+
+
+def GetMetersPerImpedanceUnit(imp):
+    '''Return the number of meters in one unit of the impedance attribute, or None
+    if the impedance is not a length (for example, a travel time).'''
+    # The input is formatted as "[Impedance] (Units: [Units])"
+    if " (Units: " not in imp:
+        return None
+    units = imp.split(" (Units: ")[1].split(")")[0]
+    if units.startswith("esriNAU"):
+        units = units[len("esriNAU"):]
+    return MetersPerLengthUnit.get(units)
+
+
 def MakeStopsFeatureClass(stopsfc, stoplist=None):
     '''Make a feature class of GTFS stops from the SQL table. Returns the path
     to the feature class and a list of stop IDs.'''
@@ -673,32 +1524,29 @@ def MakeStopsFeatureClass(stopsfc, stoplist=None):
     else:
         output_coords = WGSCoords
 
-    # Create a points feature class for the point pairs.
-    StopsLayer = arcpy.management.CreateFeatureclass(stopsfc_path, stopsfc_name, "POINT", spatial_reference=output_coords)
-    arcpy.management.AddField(StopsLayer, "stop_id", "TEXT")
-    arcpy.management.AddField(StopsLayer, "stop_code", "TEXT")
-    arcpy.management.AddField(StopsLayer, "stop_name", "TEXT")
-    arcpy.management.AddField(StopsLayer, "stop_desc", "TEXT")
-    arcpy.management.AddField(StopsLayer, "zone_id", "TEXT")
-    arcpy.management.AddField(StopsLayer, "stop_url", "TEXT")
-    if ".shp" in stopsfc_name:
-        arcpy.management.AddField(StopsLayer, "loc_type", "TEXT")
-        arcpy.management.AddField(StopsLayer, "parent_sta", "TEXT")
-    else:
-        arcpy.management.AddField(StopsLayer, "location_type", "TEXT")
-        arcpy.management.AddField(StopsLayer, "parent_station", "TEXT")
-
     # Get the stop info from the GTFS SQL file
+    selectstoptablestmt = "SELECT stop_id, stop_code, stop_name, stop_desc, stop_lat, stop_lon, zone_id, stop_url, location_type, parent_station FROM stops"
     if stoplist:
-        StopTable = []
-        for stop_id in stoplist:
-            selectstoptablestmt = "SELECT stop_id, stop_code, stop_name, stop_desc, stop_lat, stop_lon, zone_id, stop_url, location_type, parent_station FROM stops WHERE stop_id='%s';" % stop_id
-            c.execute(selectstoptablestmt)
-            StopInfo = c.fetchall()
-            StopTable.append(StopInfo[0])
+        # Fetch all the requested stops in one query by joining to a temporary
+        # table of their stop_ids
+        c.execute("DROP TABLE IF EXISTS temp.stoplist;")
+        c.execute("CREATE TEMP TABLE stoplist (stop_id TEXT PRIMARY KEY);")
+        c.executemany("INSERT OR IGNORE INTO temp.stoplist (stop_id) VALUES (?);",
+                        ((stop_id,) for stop_id in stoplist))
+        c.execute(selectstoptablestmt.replace("FROM stops", "FROM stops JOIN temp.stoplist USING (stop_id)") + ";")
+        StopTable = c.fetchall()
+        c.execute("DROP TABLE temp.stoplist;")
+        # Keep the order of the input list
+        stoporder = dict((stop_id, i) for i, stop_id in enumerate(stoplist))
+        StopTable.sort(key=lambda stop: stoporder[stop[0]])
+        # Warn about requested stops that aren't in the stops table
+        found = set(stop[0] for stop in StopTable)
+        missing = sorted(set(stop_id for stop_id in stoplist if stop_id not in found))
+        if missing:
+            arcpy.AddWarning("Warning! %i stop_ids in your GTFS data are not in the stops table, \
+so they will not appear in the output stops. Missing stop_ids: %s" % (len(missing), str(missing[:10])))
     else:
-        selectstoptablestmt = "SELECT stop_id, stop_code, stop_name, stop_desc, stop_lat, stop_lon, zone_id, stop_url, location_type, parent_station FROM stops;"
-        c.execute(selectstoptablestmt)
+        c.execute(selectstoptablestmt + ";")
         StopTable = c.fetchall()
     possiblenulls = [1, 3, 6, 7, 8, 9]
 
@@ -710,49 +1558,106 @@ def MakeStopsFeatureClass(stopsfc, stoplist=None):
     if not ArcVersion:
         DetermineArcVersion()
 
-    # Add the stops table to a feature class.
-    if ".shp" in stopsfc_name:
-        cur3 = arcpy.da.InsertCursor(StopsLayer, ["SHAPE@", "stop_id",
-                                                    "stop_code", "stop_name", "stop_desc",
-                                                    "zone_id", "stop_url", "loc_type",
-                                                    "parent_sta"])
+    # GTFS stop lat/lon is written in WGS1984.  If the output needs a different
+    # coordinate system, write the points to a temporary in-memory feature class
+    # first and project them all at once.  Give it a unique name so it can't
+    # conflict with one left over from an earlier run or another tool.
+    ProjectPoints = output_coords != WGSCoords
+    if ProjectPoints:
+        StopsLayer = arcpy.management.CreateFeatureclass("in_memory", "TempStopsWGS_" + uuid.uuid4().hex, "POINT",
+                                                            spatial_reference=WGSCoords)
     else:
-        cur3 = arcpy.da.InsertCursor(StopsLayer, ["SHAPE@", "stop_id",
-                                                    "stop_code", "stop_name", "stop_desc",
-                                                    "zone_id", "stop_url", "location_type",
-                                                    "parent_station"])
-    # Schema of stops table
-    ##   0 - stop_id
-    ##   1 - stop_code
-    ##   2 - stop_name
-    ##   3 - stop_desc
-    ##   4 - stop_lat
-    ##   5 - stop_lon
-    ##   6 - zone_id
-    ##   7 - stop_url
-    ##   8 - location_type
-    ##   9 - parent_station
-    for stopitem in StopTable:
-        stop = list(stopitem)
-        pt = arcpy.Point()
-        pt.X = float(stop[5])
-        pt.Y = float(stop[4])
-        # GTFS stop lat/lon is written in WGS1984
-        ptGeometry = arcpy.PointGeometry(pt, WGSCoords)
-        if output_coords != WGSCoords:
-            ptGeometry = ptGeometry.projectAs(output_coords)
-        # Shapefile output can't handle null values, so make them empty strings.
+        StopsLayer = arcpy.management.CreateFeatureclass(stopsfc_path, stopsfc_name, "POINT",
+                                                            spatial_reference=output_coords)
+
+    try:
+        arcpy.management.AddField(StopsLayer, "stop_id", "TEXT")
+        arcpy.management.AddField(StopsLayer, "stop_code", "TEXT")
+        arcpy.management.AddField(StopsLayer, "stop_name", "TEXT")
+        arcpy.management.AddField(StopsLayer, "stop_desc", "TEXT")
+        arcpy.management.AddField(StopsLayer, "zone_id", "TEXT")
+        arcpy.management.AddField(StopsLayer, "stop_url", "TEXT")
         if ".shp" in stopsfc_name:
-            for idx in possiblenulls:
-                if not stop[idx]:
-                    stop[idx] = ""
-        cur3.insertRow((ptGeometry, stop[0], stop[1],
-                            stop[2], stop[3], stop[6], stop[7], stop[8], stop[9]))
-    del cur3
+            arcpy.management.AddField(StopsLayer, "loc_type", "TEXT")
+            arcpy.management.AddField(StopsLayer, "parent_sta", "TEXT")
+            fields = ["SHAPE@XY", "stop_id", "stop_code", "stop_name", "stop_desc",
+                      "zone_id", "stop_url", "loc_type", "parent_sta"]
+        else:
+            arcpy.management.AddField(StopsLayer, "location_type", "TEXT")
+            arcpy.management.AddField(StopsLayer, "parent_station", "TEXT")
+            fields = ["SHAPE@XY", "stop_id", "stop_code", "stop_name", "stop_desc",
+                      "zone_id", "stop_url", "location_type", "parent_station"]
+
+        # Add the stops table to a feature class.
+        # Schema of stops table
+        ##   0 - stop_id
+        ##   1 - stop_code
+        ##   2 - stop_name
+        ##   3 - stop_desc
+        ##   4 - stop_lat
+        ##   5 - stop_lon
+        ##   6 - zone_id
+        ##   7 - stop_url
+        ##   8 - location_type
+        ##   9 - parent_station
+        with arcpy.da.InsertCursor(StopsLayer, fields) as cur3:
+            for stopitem in StopTable:
+                stop = list(stopitem)
+                # Shapefile output can't handle null values, so make them empty strings.
+                if ".shp" in stopsfc_name:
+                    for idx in possiblenulls:
+                        if not stop[idx]:
+                            stop[idx] = ""
+                cur3.insertRow(((float(stop[5]), float(stop[4])), stop[0], stop[1],
+                                    stop[2], stop[3], stop[6], stop[7], stop[8], stop[9]))
+
+        if ProjectPoints:
+            arcpy.management.Project(StopsLayer, stopsfc, output_coords)
+
+    finally:
+        if ProjectPoints:
+            arcpy.management.Delete(StopsLayer)
 
     return stopsfc, StopIDList
 
 
+def MakeUniquePointLocations(inPointsLayer, inLocUniqueID, SnapPrecision, outFC):
+    '''Snap input points to a square grid SnapPrecision meters on a side and write
+    one point per occupied grid location to outFC, with a LocGroup field numbering
+    the locations. Returns a list of the input points' unique IDs, an array giving
+    the LocGroup of each of those points, and the number of LocGroups.  Points with
+    no geometry get a LocGroup of their own with no feature in outFC.'''
+
+    LocIDs = []
+    point_groups = []
+    groups = {}
+    NumGroups = 0
+    # Read the coordinates in meters so the precision means the same thing everywhere
+    with arcpy.da.SearchCursor(inPointsLayer, [inLocUniqueID, "SHAPE@XY"],
+                                spatial_reference=WorldCylindrical) as cur:
+        for LocID, (x, y) in cur:
+            if x is None or y is None:
+                group = NumGroups
+                NumGroups += 1
+            else:
+                key = (int(round(x / SnapPrecision)), int(round(y / SnapPrecision)))
+                group = groups.get(key)
+                if group is None:
+                    group = groups[key] = NumGroups
+                    NumGroups += 1
+            LocIDs.append(LocID)
+            point_groups.append(group)
+
+    arcpy.management.CreateFeatureclass(os.path.dirname(outFC), os.path.basename(outFC),
+                                        "POINT", spatial_reference=WorldCylindrical)
+    arcpy.management.AddField(outFC, "LocGroup", "LONG")
+    with arcpy.da.InsertCursor(outFC, ["SHAPE@XY", "LocGroup"]) as cur:
+        for key, group in groups.items():
+            cur.insertRow(((key[0] * SnapPrecision, key[1] * SnapPrecision), group))
+
+    return LocIDs, np.array(point_groups, dtype=np.int64), NumGroups
+
+
 def MakeServiceAreasAroundStops(StopsLayer, inNetworkDataset, impedanceAttribute, BufferSize, restrictions, TrimPolys, TrimPolysValue):
     '''Make Service Area polygons around transit stops and join the stop_id
     field to the output polygons. Note: Assume NA license is checked out.'''
@@ -878,6 +1783,16 @@ def ConnectToSQLDatabase(SQLDbase):
     c = conn.cursor()
 
 
+def HasLineSegmentSchedules():
+    '''Check whether the SQL database has the segments table and the segment_id
+    field in the schedules table written by Count Trips on Lines Step 1.'''
+    if "segments" not in GetGTFSTableNames():
+        return False
+    chs = conn.cursor()
+    chs.execute("PRAGMA table_info(schedules);")
+    return "segment_id" in [col[1] for col in chs.fetchall()]
+
+
 def GetGTFSTableNames():
     '''Return a list of SQL database table names'''
     ctn = conn.cursor()
@@ -976,6 +1891,14 @@ def CleanUpDepOrArr(DepOrArrChoice):
         return "departure_time"
     return None
 
+def CleanUpPolygonType(PolygonType):
+    '''Return the grid cell shape for the chosen polygon output type, or None for flattened service areas.'''
+    if PolygonType == "Square grid cells":
+        return "SQUARE"
+    elif PolygonType == "Hexagon grid cells":
+        return "HEXAGON"
+    return None
+
 def CheckSpecificDate(day):
     '''Is the chosen day a specific date or a generic weekday?'''
     # Note: Datetime format check is in tool validation code
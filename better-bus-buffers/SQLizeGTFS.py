@@ -74,6 +74,9 @@ def runTool(inGTFSdir, SQLDbase):
         # Create indices to make queries faster.
         sqlize_csv.create_indices()
 
+        # Record a summary of the data for the tool validation code.
+        sqlize_csv.metadata()
+
         # Check for non-overlapping date ranges to prevent double-counting.
         overlapwarning = sqlize_csv.check_nonoverlapping_dateranges()
         if overlapwarning:
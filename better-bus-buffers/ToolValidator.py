@@ -23,8 +23,9 @@ import sys
 import re
 import sqlite3
 import datetime
+import json
 import arcpy
-from BBB_SharedFunctions import days
+from BBB_SharedFunctions import days, OutputTableExtensions, AllRoutesText
 
 ispy3 = sys.version_info >= (3, 0)
 
@@ -87,15 +88,62 @@ calendar_dates.txt, or both."
             param_GTFSDirs.setErrorMessage(message)
 
 
-def checkSQLtables(SQLDbase, required_tables, one_required=[]):
-        # Connect to SQL file.
-        conn = sqlite3.connect(SQLDbase)
+# Summaries of the SQL databases validated so far, so we don't have to reopen
+# and query them every time a parameter changes.
+# {SQLDbase: [(modification time, size), summary]}
+SQLMetadataCache = {}
+
+
+def get_SQL_metadata(SQLDbase):
+    '''Return a summary of a GTFS SQL database: a dictionary with the table names
+    ("tables"), the number of rows in calendar ("calendar_count"), the weekdays
+    with service in calendar ("service_weekdays", or None if unknown), the date
+    range of the service ("date_range"), and the routes ("routes").  The summary written
+    by Preprocess GTFS is used if it is there, so the large tables are never
+    queried.  The result is cached until the file's modification time or size
+    changes.'''
+
+    filestat = os.stat(SQLDbase)
+    filekey = (filestat.st_mtime, filestat.st_size)
+    cached = SQLMetadataCache.get(SQLDbase)
+    if cached and cached[0] == filekey:
+        return cached[1]
+
+    conn = sqlite3.connect(SQLDbase)
+    try:
         c = conn.cursor()
-        # Get the table info
-        gettablesstmt = "SELECT * FROM sqlite_master WHERE type='table';"
-        c.execute(gettablesstmt)
-        existing_tables = [t[1] for t in c.fetchall()]
+        c.execute("SELECT name FROM sqlite_master WHERE type='table';")
+        summary = {"tables": [t[0] for t in c.fetchall()]}
+        stored = {}
+        if "metadata" in summary["tables"]:
+            c.execute("SELECT key, value FROM metadata;")
+            stored = dict(c.fetchall())
+        summary["service_weekdays"] = None
+        for key in ["calendar_count", "service_weekdays", "date_range", "routes"]:
+            if key in stored:
+                summary[key] = json.loads(stored[key])
+        # Databases from older versions of Preprocess GTFS don't have the summary
+        if "calendar_count" not in summary:
+            summary["calendar_count"] = 0
+            if "calendar" in summary["tables"]:
+                c.execute("SELECT COUNT(*) FROM calendar;")
+                summary["calendar_count"] = c.fetchone()[0]
+        if "date_range" not in summary:
+            summary["date_range"] = []
+        if "routes" not in summary:
+            summary["routes"] = []
+            if "routes" in summary["tables"]:
+                c.execute("SELECT route_short_name, route_long_name, route_id FROM routes;")
+                summary["routes"] = [list(route) for route in c.fetchall()]
+    finally:
         conn.close()
+
+    SQLMetadataCache[SQLDbase] = [filekey, summary]
+    return summary
+
+
+def checkSQLtables(SQLDbase, required_tables, one_required=[]):
+        existing_tables = get_SQL_metadata(SQLDbase)["tables"]
         tablesgood = True
         if one_required:
             # At least one of the tables in this list must be present (typically calendar and calendar_dates).
@@ -145,11 +193,7 @@ def check_SQL_for_generic_weekday(param_day, SQLDbase):
 
 
 def check_calendar_existence(SQLDbase):
-    conn = sqlite3.connect(SQLDbase)
-    c = conn.cursor()
-    countcalendar = "SELECT COUNT(*) FROM calendar;"
-    c.execute(countcalendar)
-    count = c.fetchone()[0]
+    count = get_SQL_metadata(SQLDbase)["calendar_count"]
     if count == 0:
         return False
     else:
@@ -172,6 +216,12 @@ def allow_YYYYMMDD_day(param_day, SQLDbase):
             # If it's not one of the weekday strings, it must be in YYYYMMDD format
             try:
                 datetime.datetime.strptime(param_day.valueAsText, '%Y%m%d')
+                # Warn if the date is outside the range of dates in the GTFS data
+                if SQLDbase and os.path.exists(SQLDbase):
+                    date_range = get_SQL_metadata(SQLDbase)["date_range"]
+                    if date_range and not date_range[0] <= param_day.valueAsText <= date_range[1]:
+                        param_day.setWarningMessage("The date %s is outside the range of dates \
+in your GTFS data (%s to %s)." % (param_day.valueAsText, date_range[0], date_range[1]))
                 # This is a valid YYYYMMDD date, so clear the filter list error
                 if param_day.hasError():
                     msg_id = param_day.message.split(':')[0]
@@ -188,8 +238,14 @@ date falls within the date range covered by your GTFS data.")
                 param_day.setErrorMessage("Please enter a date in YYYYMMDD format or a weekday.")
         else:
             # If it's a generic weekday, the SQL file must have a calendar file
-            if SQLDbase and os.path.exists(SQLDbase) and not check_calendar_existence(SQLDbase):
-                param_day.setErrorMessage(specificDatesRequiredMessage)
+            if SQLDbase and os.path.exists(SQLDbase):
+                if not check_calendar_existence(SQLDbase):
+                    param_day.setErrorMessage(specificDatesRequiredMessage)
+                else:
+                    service_weekdays = get_SQL_metadata(SQLDbase)["service_weekdays"]
+                    if service_weekdays is not None and param_day.valueAsText not in service_weekdays:
+                        param_day.setWarningMessage("None of the service_ids in your calendar.txt file \
+run on %s, so no trips will be counted for this weekday." % param_day.valueAsText)
 
 
 def check_time_window(param_starttime, param_endtime):
@@ -229,13 +285,49 @@ For example, 2am is 02:00, and 2pm is 14:00.")
 time window end is later than the time window start.")
 
 
-def forbid_shapefile(param_outfc):
-    '''Make sure output location is a file geodatabase feature class and not a shapefile.'''
+def check_time_periods(param_periods):
+    '''Make sure the named time periods have valid, unique names, days, and time windows.'''
+    if not param_periods.altered or not param_periods.values:
+        return
+    names = []
+    for period in param_periods.values:
+        name, day, start_time, end_time = [str(val).strip() for val in period]
+        if not re.match("^[A-Za-z0-9_]+$", name):
+            param_periods.setErrorMessage("Time period names must contain only letters, numbers, or the underscore.")
+            return
+        if name in names:
+            param_periods.setErrorMessage("Time period names must be unique. %s is used more than once." % name)
+            return
+        names.append(name)
+        if day not in days:
+            try:
+                datetime.datetime.strptime(day, '%Y%m%d')
+            except ValueError:
+                param_periods.setErrorMessage("Time period %s: Please enter a date in YYYYMMDD format or a weekday." % name)
+                return
+        times = []
+        for time_of_day in [start_time, end_time]:
+            m = re.match("^([0-9]{2}):([0-9]{2})$", time_of_day)
+            if not m or int(m.group(1)) > 48 or int(m.group(2)) > 59:
+                param_periods.setErrorMessage("Time period %s: Time of day format should be HH:MM (24-hour time). \
+Hours cannot be > 48; minutes cannot be > 59." % name)
+                return
+            times.append(int(m.group(1)) * 3600 + int(m.group(2)) * 60)
+        if times[1] <= times[0]:
+            param_periods.setErrorMessage("Time period %s: Time window end time must be later than time window start time." % name)
+            return
+
+
+def forbid_shapefile(param_outfc, allow_table_files=False):
+    '''Make sure output location is a file geodatabase feature class and not a shapefile.
+    If allow_table_files is True, columnar table files (csv, sqlite, npy, parquet) are also okay.'''
     if param_outfc.altered:
         if ispy3:
             outfc = str(param_outfc.value)
         else:
             outfc = unicode(param_outfc.value)
+        if allow_table_files and os.path.splitext(outfc)[1].lower() in OutputTableExtensions:
+            return
         outdir = os.path.dirname(outfc)
         if not outdir:
             param_outfc.setErrorMessage("Invalid output feature class path.")
@@ -298,17 +390,22 @@ def check_Step1_gdb(param_inGDB, param_day):
         # Check presence of correct gdb contents
         SQLDbase = os.path.join(inStep1GDB, "Step1_GTFS.sql")
         FlatPolys = os.path.join(inStep1GDB, "Step1_FlatPolys")
+        GridCells = os.path.join(inStep1GDB, "Step1_GridCells")
         InputErrorMessage = "Step 1 geodatabase does not contain the \
 required files.  Please choose the correct geodatabase or re-run \
-Step 1.  Required files: Step1_GTFS.sql; Step1_FlatPolys"
+Step 1.  Required files: Step1_GTFS.sql; Step1_FlatPolys or Step1_GridCells"
+        UseGrid = arcpy.Exists(GridCells) and os.path.exists(os.path.join(inStep1GDB, "Step1_GridCells_offsets.npy"))
         if not os.path.exists(SQLDbase):
             SQLDbase = ""
             param_inGDB.setErrorMessage(InputErrorMessage)
-        elif not arcpy.Exists(FlatPolys):
+        elif not UseGrid and not arcpy.Exists(FlatPolys):
             param_inGDB.setErrorMessage(InputErrorMessage)
         else:
             # Check the SQL database has the required tables in it
-            if not checkSQLtables(SQLDbase, ["stops", "trips", "stop_times", "StackedPoints"], ["calendar", "calendar_dates"]):
+            required_tables = ["stops", "trips", "stop_times"]
+            if not UseGrid:
+                required_tables.append("StackedPoints")
+            if not checkSQLtables(SQLDbase, required_tables, ["calendar", "calendar_dates"]):
                 message = "The SQL database in your input geodatabase from Step 1 does not have the \
 correct tables.  Please choose a valid geodatabase generated using Step 1 of the Count Trips in Polygon Buffers \
 around Stops tool."
@@ -380,19 +477,14 @@ def populate_GTFS_routes(param_SQLDbase, param_routes):
             SQLDbase = unicode(param_SQLDbase.value)
         if os.path.exists(SQLDbase):
             try:
-                # Connect to or create the SQL file.
-                conn = sqlite3.connect(SQLDbase)
-                c = conn.cursor()
                 # Get list of routes in the GTFS data
-                routefetch = "SELECT route_short_name, route_long_name, route_id FROM routes;"
-                c.execute(routefetch)
-                routestuff = c.fetchall()
+                routestuff = get_SQL_metadata(SQLDbase)["routes"]
                 routelist = []
                 for route in routestuff:
                     routelist.append(route[0] + ": " + route[1] + " [" + route[2] + "]")
                 routelist.sort()
+                routelist.insert(0, AllRoutesText)
                 # Put the value list of routes into the GUI field.
                 param_routes.filter.list = routelist
-                conn.close()
             except:
                 param_routes.filter.list = []
@@ -32,6 +32,7 @@
 import csv
 import datetime
 import itertools
+import json
 import os
 import re
 import sqlite3
@@ -453,8 +454,32 @@ def metadata():
     db.execute("""INSERT INTO metadata (key, value) VALUES ("sql_format", "1");""")
     db.execute("""INSERT INTO metadata (key, value) VALUES ("sqlize_csv", "$Id: sqlize_csv.py 59 2013-05-13 14:41:37Z luitien $");""")
     db.execute("""INSERT INTO metadata (key, value) VALUES ("timestamp", ?);""", (datetime.datetime.now().isoformat(),))
+    # A small summary of the GTFS data so the tool validation code can check
+    # the database without querying its tables.
+    for key, value in summarize_gtfs():
+        db.execute("""INSERT INTO metadata (key, value) VALUES (?, ?);""", (key, json.dumps(value)))
     db.commit()
 
+def summarize_gtfs():
+    '''Return (key, value) pairs summarizing the GTFS data: the number of calendar
+    rows, the weekdays with service in calendar.txt, the range of service dates,
+    and the list of routes.'''
+    cur = db.cursor()
+    weekdays = [day.lower() for day in BBB_SharedFunctions.days]
+    cur.execute("SELECT COUNT(*), MIN(start_date), MAX(end_date), %s FROM calendar;" % \
+                ", ".join("MAX(%s)" % day for day in weekdays))
+    calendar = cur.fetchone()
+    cur.execute("SELECT MIN(date), MAX(date) FROM calendar_dates;")
+    calendar_dates = cur.fetchone()
+    dates = [date for date in list(calendar[1:3]) + list(calendar_dates) if date]
+    cur.execute("SELECT route_short_name, route_long_name, route_id FROM routes;")
+    routes = [list(route) for route in cur.fetchall()]
+    cur.close()
+    return [("calendar_count", calendar[0]),
+            ("service_weekdays", [day for day, running in zip(BBB_SharedFunctions.days, calendar[3:]) if running]),
+            ("date_range", [min(dates), max(dates)] if dates else []),
+            ("routes", routes)]
+
 def check_nonoverlapping_dateranges():
     '''Check for non-overlapping date ranges in calendar.txt to prevent
     double-counting in analyses that use generic weekdays.'''
@@ -0,0 +1,66 @@
+'''Tests for the what-if service scenarios in BBB_Scenarios.'''
+
+import os, sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import BBB_Scenarios
+
+# Route A runs in both directions with uneven headways
+StopTimeDict = {
+    "stop_1": [["A1", 25200], ["A2", 25800], ["A3", 28800], ["B1", 27000]],
+    "stop_2": [["A1", 25500], ["A2", 26100], ["A3", 29100], ["B1", 26700]],
+    "stop_3": [["A4", 25300], ["A5", 26500]],
+}
+TripRouteDict = {"A1": "A", "A2": "A", "A3": "A", "A4": "A", "A5": "A", "B1": "B"}
+TripDirectionDict = {"A1": 0, "A2": 0, "A3": 0, "A4": 1, "A5": 1, "B1": 0}
+
+
+def sorted_events(stoptimedict):
+    return dict((stop_id, sorted(events)) for stop_id, events in stoptimedict.items())
+
+
+def apply_scenario(scenario, stoptimedict=StopTimeDict, start_sec=0, end_sec=86400):
+    return BBB_Scenarios.ApplyScenario(stoptimedict, scenario, start_sec, end_sec, TripRouteDict, TripDirectionDict)
+
+
+def test_headway_multiplier_of_one_keeps_schedule():
+    result = apply_scenario({"headway_multipliers": {"A": 1.0}})
+    assert sorted_events(result) == sorted_events(StopTimeDict)
+
+
+def test_headway_multiplier_scales_each_direction():
+    result = sorted_events(apply_scenario({"headway_multipliers": {"A": 2}}))
+    # Direction 0 is scaled from A1 and direction 1 from A4
+    assert result["stop_1"] == [["A1", 25200], ["A2", 26400], ["A3", 32400], ["B1", 27000]]
+    assert result["stop_3"] == [["A4", 25300], ["A5", 27700]]
+
+
+def test_headway_multiplier_below_one_fills_time_window():
+    # Route C runs every 10 minutes from 7:00 to 10:00.  The time window is 7:00 to 8:00.
+    stoptimedict = {"stop_1": [["C%i" % i, 25200 + 600 * i] for i in range(19)]}
+    scenario = {"headway_multipliers": {"C": 0.5}}
+    fetch_start, fetch_end = BBB_Scenarios.GetScenarioTimeWindow(scenario, 25200, 28800)
+    assert (fetch_start, fetch_end) == (25200, 32400)
+    fetched = {"stop_1": [event for event in stoptimedict["stop_1"] if fetch_start <= event[1] <= fetch_end]}
+    triproute_dict = dict(("C%i" % i, "C") for i in range(19))
+    result = BBB_Scenarios.ApplyScenario(fetched, scenario, 25200, 28800, triproute_dict, {})
+    assert sorted(stop_time for trip_id, stop_time in result["stop_1"]) == list(range(25200, 28801, 300))
+
+
+def test_trips_from_before_time_window_keep_their_times():
+    stoptimedict = {"stop_1": [["A1", 25000]], "stop_2": [["A1", 25300], ["A2", 25800]], "stop_3": [["A2", 26100]]}
+    result = sorted_events(apply_scenario({"headway_multipliers": {"A": 2}}, stoptimedict, 25200, 86400))
+    assert result == {"stop_2": [["A1", 25300], ["A2", 25800]], "stop_3": [["A2", 26100]]}
+
+
+def test_shift_brings_in_trip_from_outside_time_window():
+    scenario = {"shift_trips": {"A3": -3000}}
+    assert BBB_Scenarios.GetScenarioTimeWindow(scenario, 25200, 27000) == (25200, 30000)
+    result = sorted_events(apply_scenario(scenario, StopTimeDict, 25200, 27000))
+    assert ["A3", 25800] in result["stop_1"]
+    assert ["A3", 26100] in result["stop_2"]
+
+
+def test_time_window_unchanged_without_scenario():
+    assert BBB_Scenarios.GetScenarioTimeWindow(None, 25200, 28800) == (25200, 28800)
+    assert BBB_Scenarios.GetScenarioTimeWindow({"remove_routes": ["A"]}, 25200, 28800) == (25200, 28800)